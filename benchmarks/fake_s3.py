@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local in-memory stand-in for an S3 compatible remote that only uses the standard library. It implements the requests that s3dbm and the s3func locks make (object get/put/head/delete, delete objects, and the object and version listings) with versioned buckets. Unauthenticated GETs are answered like a B2 public url, so the same server can be used for remote_url (plain http) access. A fixed latency can be added to every request to simulate a real network.
+
+python benchmarks/fake_s3.py --port 9000
+"""
+import io
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+############################################
+### Parameters
+
+s3_ns = 'http://s3.amazonaws.com/doc/2006-03-01/'
+max_list_keys = 1000
+
+############################################
+### Classes
+
+
+class ObjectVersion:
+    """
+
+    """
+    def __init__(self, data: bytes, metadata: dict, content_type: str):
+        """
+
+        """
+        ms = int(time.time() * 1000)
+        self.data = data
+        self.metadata = metadata
+        self.content_type = content_type
+        self.etag = hashlib.md5(data).hexdigest()
+        self.version_id = f'{uuid.uuid4().hex[:16]}_u{ms}'
+        self.last_modified = datetime.fromtimestamp(ms * 0.001, timezone.utc)
+
+
+class Store:
+    """
+    The buckets of the server. Each key has a list of versions with the latest at the end.
+    """
+    def __init__(self):
+        """
+
+        """
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def put(self, bucket, key, obj):
+        with self._lock:
+            self._buckets.setdefault(bucket, {}).setdefault(key, []).append(obj)
+
+    def get(self, bucket, key, version_id=None):
+        with self._lock:
+            versions = self._buckets.get(bucket, {}).get(key)
+            if not versions:
+                return None
+            if version_id is None:
+                return versions[-1]
+            for obj in versions:
+                if obj.version_id == version_id:
+                    return obj
+
+    def delete(self, bucket, key, version_id=None):
+        """
+        Deleting without a version id removes all of the versions as buckets don't have delete markers here.
+        """
+        with self._lock:
+            objs = self._buckets.get(bucket, {})
+            if key not in objs:
+                return
+            if version_id:
+                objs[key] = [obj for obj in objs[key] if obj.version_id != version_id]
+            else:
+                objs[key] = []
+            if not objs[key]:
+                del objs[key]
+
+    def list(self, bucket, prefix='', start_after='', versions=False):
+        with self._lock:
+            objs = self._buckets.get(bucket, {})
+            keys = sorted(key for key in objs if key.startswith(prefix) and key > start_after)
+            if versions:
+                return [(key, obj, obj is objs[key][-1]) for key in keys for obj in reversed(objs[key])]
+            else:
+                return [(key, objs[key][-1], True) for key in keys]
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(len(obj.data) for objs in self._buckets.values() for versions in objs.values() for obj in versions)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    ############################################
+    ### Request parsing
+
+    def _parse(self):
+        """
+
+        """
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = urllib.parse.unquote(parts[0])
+        key = urllib.parse.unquote(parts[1]) if len(parts) > 1 else ''
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query, keep_blank_values=True).items()}
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.count_request(self.command)
+
+        return bucket, key, query
+
+    def _read_body(self):
+        """
+        Read the body, which might use http chunked and/or aws chunked encoding.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            body = io.BytesIO()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            body = body.getvalue()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if ('aws-chunked' in self.headers.get('Content-Encoding', '')) or self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'):
+            stream = io.BytesIO(body)
+            data = io.BytesIO()
+            while True:
+                line = stream.readline()
+                if not line:
+                    break
+                size = int(line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    break
+                data.write(stream.read(size))
+                stream.readline()
+            body = data.getvalue()
+
+        return body
+
+    def _is_public(self):
+        return 'Authorization' not in self.headers
+
+    ############################################
+    ### Responses
+
+    def _send(self, status, body=b'', headers={}):
+        """
+
+        """
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_error(self, status, code, message):
+        """
+        S3 errors are xml, while the errors of public urls are json like B2.
+        """
+        if self._is_public():
+            body = f'{{"status": {status}, "code": "{code}", "message": "{message}"}}'.encode()
+            content_type = 'application/json'
+        else:
+            body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>'.encode()
+            content_type = 'application/xml'
+
+        self._send(status, body, {'Content-Type': content_type})
+
+    def _send_xml(self, xml):
+        self._send(200, ('<?xml version="1.0" encoding="UTF-8"?>' + xml).encode(), {'Content-Type': 'application/xml'})
+
+    def _object_headers(self, obj):
+        """
+        Both the S3 and B2 style headers are returned for the metadata.
+        """
+        headers = {
+            'Content-Type': obj.content_type,
+            'ETag': f'"{obj.etag}"',
+            'Last-Modified': formatdate(obj.last_modified.timestamp(), usegmt=True),
+            'x-amz-version-id': obj.version_id,
+            'X-Bz-Upload-Timestamp': str(int(obj.last_modified.timestamp() * 1000)),
+            'Accept-Ranges': 'bytes',
+            }
+        for name, value in obj.metadata.items():
+            headers['x-amz-meta-' + name] = value
+            headers['x-bz-info-' + name] = value
+
+        return headers
+
+    ############################################
+    ### Methods
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if not key:
+            self._send(200)
+            return
+
+        metadata = {name[11:].lower(): value for name, value in self.headers.items() if name.lower().startswith('x-amz-meta-')}
+        obj = ObjectVersion(body, metadata, self.headers.get('Content-Type', 'binary/octet-stream'))
+        self.server.store.put(bucket, key, obj)
+        self._send(200, b'', {'ETag': f'"{obj.etag}"', 'x-amz-version-id': obj.version_id})
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not key:
+            if 'versions' in query:
+                self._list_versions(bucket, query)
+            else:
+                self._list_objects(bucket, query)
+            return
+
+        obj = self.server.store.get(bucket, key, query.get('versionId'))
+        if obj is None:
+            self._send_error(404, 'NoSuchKey' if not self._is_public() else 'not_found', f'{key} does not exist.')
+            return
+
+        headers = self._object_headers(obj)
+        if_none_match = self.headers.get('If-None-Match')
+        if (if_none_match is not None) and (if_none_match.strip('"') == obj.etag):
+            self._send(304, b'', {'ETag': headers['ETag']})
+            return
+
+        data = obj.data
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start, end = range_header[6:].split('-')
+            size = len(data)
+            if start == '':
+                start = max(size - int(end), 0)
+                end = size - 1
+            else:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+            if start >= size:
+                self._send_error(416, 'InvalidRange', 'The requested range is not satisfiable.')
+                return
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self._send(206, data[start:end + 1], headers)
+        else:
+            self._send(200, data, headers)
+
+    def do_HEAD(self):
+        bucket, key, query = self._parse()
+        obj = self.server.store.get(bucket, key, query.get('versionId'))
+        if obj is None:
+            self._send(404)
+        else:
+            headers = self._object_headers(obj)
+            headers['Content-Length'] = str(len(obj.data))
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        self._read_body()
+        self.server.store.delete(bucket, key, query.get('versionId'))
+        self._send(204)
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if 'delete' not in query:
+            self._send_error(501, 'NotImplemented', 'Only the delete objects POST request is implemented.')
+            return
+
+        root = ET.fromstring(body)
+        deleted = []
+        for elem in root.iter():
+            if elem.tag.endswith('Object'):
+                key0 = None
+                version_id = None
+                for child in elem:
+                    if child.tag.endswith('Key'):
+                        key0 = child.text
+                    elif child.tag.endswith('VersionId'):
+                        version_id = child.text
+                self.server.store.delete(bucket, key0, version_id)
+                deleted.append(key0)
+
+        xml = f'<DeleteResult xmlns="{s3_ns}">' + ''.join(f'<Deleted><Key>{escape(k)}</Key></Deleted>' for k in deleted) + '</DeleteResult>'
+        self._send_xml(xml)
+
+    ############################################
+    ### Listings
+
+    def _list_objects(self, bucket, query):
+        """
+        ListObjectsV2 (and v1 without markers).
+        """
+        prefix = query.get('prefix', '')
+        start_after = query.get('continuation-token') or query.get('start-after') or query.get('marker') or ''
+        max_keys = min(int(query.get('max-keys', max_list_keys)), max_list_keys)
+
+        objs = self.server.store.list(bucket, prefix, start_after)
+        truncated = len(objs) > max_keys
+        objs = objs[:max_keys]
+
+        xml = f'<ListBucketResult xmlns="{s3_ns}"><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(objs)}</KeyCount><MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+        for key, obj, _ in objs:
+            xml += f'<Contents><Key>{escape(key)}</Key><LastModified>{obj.last_modified.isoformat(timespec="milliseconds").replace("+00:00", "Z")}</LastModified><ETag>"{obj.etag}"</ETag><Size>{len(obj.data)}</Size><StorageClass>STANDARD</StorageClass></Contents>'
+        if truncated:
+            xml += f'<NextContinuationToken>{escape(objs[-1][0])}</NextContinuationToken>'
+        xml += '</ListBucketResult>'
+
+        self._send_xml(xml)
+
+    def _list_versions(self, bucket, query):
+        """
+
+        """
+        prefix = query.get('prefix', '')
+        key_marker = query.get('key-marker', '')
+        max_keys = min(int(query.get('max-keys', max_list_keys)), max_list_keys)
+
+        objs = self.server.store.list(bucket, prefix, key_marker, versions=True)
+
+        ## Only whole keys are returned in a page
+        truncated = False
+        if len(objs) > max_keys:
+            last_key = objs[max_keys - 1][0]
+            objs = [obj for obj in objs if obj[0] <= last_key]
+            truncated = True
+
+        xml = f'<ListVersionsResult xmlns="{s3_ns}"><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+        for key, obj, is_latest in objs:
+            xml += f'<Version><Key>{escape(key)}</Key><VersionId>{obj.version_id}</VersionId><IsLatest>{str(is_latest).lower()}</IsLatest><LastModified>{obj.last_modified.isoformat(timespec="milliseconds").replace("+00:00", "Z")}</LastModified><ETag>"{obj.etag}"</ETag><Size>{len(obj.data)}</Size><Owner><ID>fake</ID></Owner><StorageClass>STANDARD</StorageClass></Version>'
+        if truncated:
+            xml += f'<NextKeyMarker>{escape(objs[-1][0])}</NextKeyMarker>'
+        xml += '</ListVersionsResult>'
+
+        self._send_xml(xml)
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    """
+    The server runs in a background thread. Pass port=0 to use a free port.
+
+    Parameters
+    ----------
+    host : str
+        The host to bind to.
+    port : int
+        The port to bind to.
+    latency : float
+        The number of seconds to wait before answering each request.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str='127.0.0.1', port: int=0, latency: float=0):
+        """
+
+        """
+        super().__init__((host, port), Handler)
+        self.store = Store()
+        self.latency = latency
+        self.request_counts = {}
+        self._counts_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def connection_config(self):
+        """
+        The connection_config to pass to s3dbm for this server.
+        """
+        return {'service_name': 's3', 'endpoint_url': self.endpoint_url, 'aws_access_key_id': 'fake', 'aws_secret_access_key': 'fake'}
+
+    def count_request(self, method):
+        with self._counts_lock:
+            self.request_counts[method] = self.request_counts.get(method, 0) + 1
+
+    def reset_counts(self):
+        with self._counts_lock:
+            counts = self.request_counts
+            self.request_counts = {}
+
+        return counts
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeS3Server(args.host, args.port, args.latency_ms * 0.001)
+    print(f'Serving on {server.endpoint_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
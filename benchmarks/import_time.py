@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import time budget for s3dbm. The import is run in fresh interpreters with python -X importtime and the figures of the slowest modules are reported. The script fails if the import is over the budget or if any of the remote backends are imported.
+
+python benchmarks/import_time.py --budget-ms 300
+"""
+import sys
+import os
+import pathlib
+import argparse
+import subprocess
+import statistics
+
+############################################
+### Parameters
+
+repo_path = pathlib.Path(__file__).resolve().parent.parent
+
+## These must only be imported when a remote session is created
+deferred_modules = ('boto3', 'botocore', 's3func', 'pydantic', 'urllib3', 'multiprocessing')
+
+default_budget_ms = 300
+default_repeats = 5
+default_top = 15
+
+check_code = 'import sys, s3dbm; print(",".join(m for m in {mods} if m in sys.modules))'
+
+############################################
+### Functions
+
+
+def run_importtime(module='s3dbm'):
+    """
+    Import the module in a fresh interpreter and parse the -X importtime output.
+
+    Returns
+    -------
+    dict of module name: (self us, cumulative us)
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(repo_path) + os.pathsep + env.get('PYTHONPATH', '')
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, env=env, check=True)
+
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[12:].split('|')
+        times[name.strip()] = (int(self_us), int(cum_us))
+
+    return times
+
+
+def find_deferred_imports():
+    """
+    The deferred modules that are imported by import s3dbm.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(repo_path) + os.pathsep + env.get('PYTHONPATH', '')
+    p = subprocess.run([sys.executable, '-c', check_code.format(mods=deferred_modules)], capture_output=True, text=True, env=env, check=True)
+    out = p.stdout.strip()
+
+    return out.split(',') if out else []
+
+
+def main(budget_ms=default_budget_ms, repeats=default_repeats, top=default_top):
+    """
+
+    """
+    runs = [run_importtime() for _ in range(repeats)]
+    totals = [run['s3dbm'][1] for run in runs]
+    total_ms = statistics.median(totals) * 0.001
+
+    ## Report the median cumulative time of the slowest modules
+    names = set().union(*runs)
+    cum = {name: statistics.median(run[name][1] for run in runs if name in run) for name in names}
+    slowest = sorted(cum.items(), key=lambda x: x[1], reverse=True)[:top]
+
+    print(f'python -X importtime -c "import s3dbm" (median of {repeats} runs)')
+    print(f'{"cumulative ms":>14}  module')
+    for name, cum_us in slowest:
+        print(f'{cum_us * 0.001:14.1f}  {name}')
+    print(f'\ns3dbm total: {total_ms:.1f} ms (budget {budget_ms} ms)')
+
+    failed = False
+    deferred = find_deferred_imports()
+    if deferred:
+        print(f'These modules should only be imported with a remote session: {", ".join(deferred)}')
+        failed = True
+    if total_ms > budget_ms:
+        print('The import is over the budget.')
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget-ms', type=float, default=default_budget_ms)
+    parser.add_argument('--repeats', type=int, default=default_repeats)
+    parser.add_argument('--top', type=int, default=default_top)
+    args = parser.parse_args()
+
+    sys.exit(main(args.budget_ms, args.repeats, args.top))
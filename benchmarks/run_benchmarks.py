@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of s3dbm against the local fake S3 server (fake_s3.py) across value sizes and thread counts. Each scenario runs in a fresh interpreter with its own server process, so the memory high-water marks (max rss) belong to that scenario only. The results are written as json.
+
+python benchmarks/run_benchmarks.py --output bench_output.json
+python benchmarks/run_benchmarks.py --sizes 1024 65536 --threads 1 16 --latency-ms 20
+"""
+import sys
+import os
+import json
+import time
+import pathlib
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import resource
+import tracemalloc
+
+############################################
+### Parameters
+
+bench_path = pathlib.Path(__file__).resolve().parent
+repo_path = bench_path.parent
+
+default_sizes = [2**10, 2**16, 2**20]
+default_threads = [1, 8, 32]
+default_scenario_bytes = 2**25
+default_max_values = 5000
+default_n_gets = 200
+default_latency_ms = 0
+
+bucket = 'bench'
+remote_db_key = 'bench/db.s3dbm'
+
+############################################
+### Functions
+
+
+def percentiles(times):
+    """
+    The latency percentiles in ms.
+    """
+    times = sorted(t * 1000 for t in times)
+    if len(times) < 2:
+        return {'n': len(times), 'p50': times[0] if times else None}
+    q = statistics.quantiles(times, n=100, method='inclusive')
+
+    return {'n': len(times), 'mean': statistics.fmean(times), 'p50': q[49], 'p90': q[89], 'p99': q[98], 'max': times[-1]}
+
+
+def max_rss_mb():
+    """
+    The max resident set size of the process so far (kB on linux and bytes on mac).
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+
+    return round(rss / 1024, 1)
+
+
+class Phase:
+    """
+    Times a phase of a scenario and records the memory high-water marks after it.
+    """
+    def __init__(self, results, name, n_bytes=None, use_tracemalloc=False):
+        self._results = results
+        self._name = name
+        self._n_bytes = n_bytes
+        self._tracemalloc = use_tracemalloc
+
+    def __enter__(self):
+        if self._tracemalloc:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self._start
+        res = {'seconds': round(duration, 4), 'max_rss_mb': max_rss_mb()}
+        if self._n_bytes:
+            res['mb_per_s'] = round(self._n_bytes / duration / 2**20, 2)
+        if self._tracemalloc:
+            res['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+        self._results[self._name] = res
+
+
+def run_scenario(endpoint_url, value_size, n_values, threads, n_gets, use_tracemalloc=False):
+    """
+    Run all of the phases of a scenario in this process.
+    """
+    sys.path.insert(0, str(repo_path))
+    import random
+    from s3dbm import main
+
+    connection_config = {'service_name': 's3', 'endpoint_url': endpoint_url, 'aws_access_key_id': 'fake', 'aws_secret_access_key': 'fake'}
+    remote_url = f'{endpoint_url}/{bucket}/{remote_db_key}'
+    kwargs = dict(value_serializer='bytes', threads=threads)
+    s3_kwargs = dict(remote_db_key=remote_db_key, bucket=bucket, connection_config=connection_config, **kwargs)
+
+    keys = [f'{i:08}' for i in range(n_values)]
+    rng = random.Random(0)
+    get_keys = [rng.choice(keys) for _ in range(n_gets)]
+    total_bytes = value_size * n_values
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+
+        ## Writer
+        with Phase(results, 'open_writer'):
+            session = main.Session(tmp.joinpath('writer.s3dbm'), flag='n', **s3_kwargs)
+            db = session.open()
+
+        with Phase(results, 'bulk_write', total_bytes, use_tracemalloc):
+            db.update((key, os.urandom(value_size)) for key in keys)
+            db.sync()
+
+        with Phase(results, 'push', total_bytes, use_tracemalloc):
+            db.push()
+
+        with Phase(results, 'push_no_changes'):
+            db.push()
+
+        db.close()
+        session.close()
+
+        ## Readers
+        with Phase(results, 'open_reader_cold'):
+            session = main.Session(tmp.joinpath('reader.s3dbm'), flag='r', **s3_kwargs)
+            db = session.open()
+
+        times = []
+        for key in get_keys:
+            start = time.perf_counter()
+            db[key]
+            times.append(time.perf_counter() - start)
+        results['get_remote_latency_ms'] = percentiles(times)
+
+        times = []
+        for key in get_keys:
+            start = time.perf_counter()
+            db[key]
+            times.append(time.perf_counter() - start)
+        results['get_local_latency_ms'] = percentiles(times)
+
+        with Phase(results, 'count_keys'):
+            len(db)
+
+        db.close()
+        session.close()
+
+        with Phase(results, 'open_reader_warm'):
+            session = main.Session(tmp.joinpath('reader.s3dbm'), flag='r', **s3_kwargs)
+            db = session.open()
+        db.close()
+        session.close()
+
+        with Phase(results, 'open_reader_lazy'):
+            session = main.Session(tmp.joinpath('reader.s3dbm'), flag='r', lazy=True, **s3_kwargs)
+            db = session.open()
+        session.stale
+        db.close()
+        session.close()
+
+        with Phase(results, 'items_remote', total_bytes, use_tracemalloc):
+            session = main.Session(tmp.joinpath('items.s3dbm'), flag='r', **s3_kwargs)
+            db = session.open()
+            for key, value in db.items():
+                pass
+        db.close()
+        session.close()
+
+        with Phase(results, 'pull', total_bytes, use_tracemalloc):
+            session = main.Session(tmp.joinpath('pull.s3dbm'), flag='r', **s3_kwargs)
+            db = session.open()
+            db.pull()
+        db.close()
+        session.close()
+
+        with Phase(results, 'pull_http', total_bytes, use_tracemalloc):
+            session = main.Session(tmp.joinpath('http.s3dbm'), flag='r', remote_url=remote_url, **kwargs)
+            db = session.open()
+            db.pull()
+        db.close()
+        session.close()
+
+    return results
+
+
+def start_server(latency_ms):
+    """
+    Start the fake S3 server in another process so that it doesn't compete with the benchmark for the GIL.
+    """
+    proc = subprocess.Popen([sys.executable, '-u', str(bench_path.joinpath('fake_s3.py')), '--port', '0', '--latency-ms', str(latency_ms)], stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith('Serving on '):
+        proc.kill()
+        raise RuntimeError('The fake S3 server did not start.')
+
+    return proc, line.strip()[11:]
+
+
+def main(sizes=default_sizes, thread_counts=default_threads, scenario_bytes=default_scenario_bytes, max_values=default_max_values, n_gets=default_n_gets, latency_ms=default_latency_ms, use_tracemalloc=False):
+    """
+    Run every scenario in its own interpreter and collect the results.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    output = {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'latency_ms': latency_ms,
+        'scenarios': [],
+        }
+
+    for value_size in sizes:
+        n_values = max(min(scenario_bytes // value_size, max_values), 1)
+        for threads in thread_counts:
+            proc, endpoint_url = start_server(latency_ms)
+            try:
+                args = [sys.executable, __file__, '--scenario', endpoint_url, str(value_size), str(n_values), str(threads), str(n_gets)]
+                if use_tracemalloc:
+                    args.append('--tracemalloc')
+                p = subprocess.run(args, capture_output=True, text=True)
+            finally:
+                proc.kill()
+                proc.wait()
+
+            scenario = {'value_size': value_size, 'n_values': n_values, 'threads': threads}
+            if p.returncode == 0:
+                scenario['results'] = json.loads(p.stdout.strip().splitlines()[-1])
+            else:
+                scenario['error'] = p.stderr.strip().splitlines()[-1] if p.stderr.strip() else f'exit code {p.returncode}'
+            output['scenarios'].append(scenario)
+            print(f'value_size={value_size} n_values={n_values} threads={threads}: {"ok" if "results" in scenario else scenario["error"]}', file=sys.stderr)
+
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='The value sizes in bytes.')
+    parser.add_argument('--threads', type=int, nargs='+', default=default_threads, help='The thread counts.')
+    parser.add_argument('--scenario-bytes', type=int, default=default_scenario_bytes, help='The total value bytes of a scenario.')
+    parser.add_argument('--max-values', type=int, default=default_max_values, help='The max number of values of a scenario.')
+    parser.add_argument('--n-gets', type=int, default=default_n_gets, help='The number of gets for the latency percentiles.')
+    parser.add_argument('--latency-ms', type=float, default=default_latency_ms, help='The latency the fake server adds to every request.')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also record the python memory peaks of the bulk phases (slows them down).')
+    parser.add_argument('--output', default=None, help='The json output file. Defaults to stdout.')
+    parser.add_argument('--scenario', nargs=5, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        endpoint_url, value_size, n_values, threads, n_gets = args.scenario
+        results = run_scenario(endpoint_url, int(value_size), int(n_values), int(threads), int(n_gets), args.tracemalloc)
+        print(json.dumps(results))
+    else:
+        output = main(args.sizes, args.threads, args.scenario_bytes, args.max_values, args.n_gets, args.latency_ms, args.tracemalloc)
+        output_json = json.dumps(output, indent=2)
+        if args.output is None:
+            print(output_json)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(output_json)
@@ -3,25 +3,33 @@
 """
 
 """
+from __future__ import annotations
 import io
 import os
 from collections.abc import Mapping, MutableMapping
-from typing import Any, Generic, Iterator, Union, List, Dict
+from typing import Any, Generic, Iterator, Union, List, Dict, TYPE_CHECKING
 import pathlib
-import botocore
 # from botocore import exceptions as bc_exceptions
-from pydantic import HttpUrl
 import concurrent.futures
-import multiprocessing
 import threading
+import time
+import itertools
+import contextlib
+import logging
 import booklet
-import s3func
 import zstandard as zstd
 import orjson
-import pprint
 
-import utils
-# from . import utils
+# import utils
+from . import utils
+
+## The remote backends (s3func, boto3, and urllib3) and pydantic are slow to import, so they are only imported when a remote session is created
+if TYPE_CHECKING:
+    from pydantic import HttpUrl
+    import botocore
+    import s3func
+
+logger = logging.getLogger(__name__)
 
 # uuid_s3dbm = b'K=d:\xa89F(\xbc\xf5 \xd7$\xbd;\xf2'
 # version = 1
@@ -65,6 +73,8 @@ class UserMetadata(MutableMapping):
         """
 
         """
+        import pprint
+
         return pprint.pformat(self._user_meta)
 
     def __setitem__(self, key, value):
@@ -180,6 +190,16 @@ class Session:
                  threads: int=20,
                  lock_timeout=-1,
                  break_other_locks=False,
+                 value_cache_size: int=0,
+                 value_cache_policy: str='lru',
+                 remote_layout: str=None,
+                 lazy: bool=False,
+                 metrics: bool=False,
+                 metrics_hooks: list=None,
+                 retries: int=utils.default_retries,
+                 retry_backoff: float=utils.default_retry_backoff,
+                 hedge_after=None,
+                 shared: bool=False,
                  **local_storage_kwargs,
                  ):
         """
@@ -200,6 +220,8 @@ class Session:
         local_meta_path = pathlib.Path(local_db_path)
         remote_keys_name = local_meta_path.name + '.remote_keys'
         remote_keys_path = local_meta_path.parent.joinpath(remote_keys_name)
+        key_index_path = local_meta_path.parent.joinpath(local_meta_path.name + '.key_index')
+        lock_path = local_meta_path.parent.joinpath(local_meta_path.name + '.lock')
 
         if 'n_buckets' not in local_storage_kwargs:
             n_buckets = utils.default_n_buckets
@@ -212,29 +234,85 @@ class Session:
         else:
             raise ValueError(f'value_serializer must be one of {booklet.available_serializers}.')
 
-        ## Check the remote config
-        http_session, s3_session, remote_s3_access, remote_http_access, host_url, remote_base_url = utils.init_remote_config(flag, bucket, connection_config, remote_url, threads, read_timeout)
+        retry_policy = utils.RetryPolicy(retries, retry_backoff, hedge_after, threads)
 
-        ## Create S3 lock for writes
-        # TODO : Should I create shared locks for readers that have remote_s3_access?
-        if flag != 'r':
-            lock = s3func.s3.S3Lock(connection_config, bucket, remote_db_key, read_timeout=read_timeout)
-            if break_other_locks:
-                lock.break_other_locks()
-            lock.aquire(timeout=lock_timeout)
-        else:
-            lock = None
+        ## A lazy session opens from the local files and checks the remote in the background. It needs a local copy of the database to open from, otherwise it's opened normally.
+        if lazy and write:
+            raise ValueError("lazy can only be used when flag == 'r'.")
 
-        ## Init metadata
-        meta, meta_in_remote, version_date = utils.init_metadata(local_meta_path, remote_keys_path, http_session, s3_session, remote_s3_access, remote_http_access, remote_url, remote_db_key, value_serializer, local_storage_kwargs)
+        ## A shared session lets many processes read the same local cache. Only one process at a time can update the local files, which is coordinated by a lock file.
+        if shared and write:
+            raise ValueError("shared can only be used when flag == 'r'.")
+        if shared:
+            coordinator = utils.CoordinatorLock(lock_path)
+        else:
+            coordinator = contextlib.nullcontext()
+
+        with coordinator:
+            lazy = lazy and local_meta_path.exists()
+
+            if lazy:
+                remote_s3_access, remote_http_access, host_url, remote_base_url = utils.get_remote_access(flag, bucket, connection_config, remote_url)
+                lock = None
+                meta = utils.read_metadata(local_meta_path)
+                meta_in_remote = remote_keys_path.exists()
+                version_date = meta['versions'][-1]['version_date']
+                remote_last_modified = meta['last_modified'] if meta_in_remote else None
+                journal_changes = None
+
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                remote_check = executor.submit(utils.check_remote_metadata, meta, meta_in_remote, bucket, connection_config, remote_url, remote_db_key, threads, read_timeout)
+                executor.shutdown(wait=False)
+            else:
+                ## Check the remote config
+                http_session, s3_session, remote_s3_access, remote_http_access, host_url, remote_base_url = utils.init_remote_config(flag, bucket, connection_config, remote_url, threads, read_timeout)
+
+                ## Create S3 lock for writes
+                # TODO : Should I create shared locks for readers that have remote_s3_access?
+                if flag != 'r':
+                    lock = s3_session.s3lock(remote_db_key)
+                    if break_other_locks:
+                        lock.break_other_locks()
+                    lock.aquire(timeout=lock_timeout)
+                else:
+                    lock = None
+
+                ## Init metadata. If the remote keys are updated from the journal, then the changes are kept so that the key index can be updated rather than rebuilt.
+                remote_keys_stamp = utils.get_key_index_stamp(remote_keys_path)
+                meta, meta_in_remote, version_date, remote_last_modified, journal_changes = utils.init_metadata(local_meta_path, remote_keys_path, http_session, s3_session, remote_s3_access, remote_http_access, remote_url, remote_db_key, value_serializer, local_storage_kwargs)
+                if journal_changes is not None:
+                    journal_changes = (remote_keys_stamp,) + journal_changes
+                remote_check = None
+
+            ## The remote layout is set when the database is created and can't be changed afterwards
+            if 'remote_layout' not in meta:
+                if remote_layout is None:
+                    remote_layout = 'object'
+                elif remote_layout not in utils.remote_layouts:
+                    raise ValueError(f'remote_layout must be one of {utils.remote_layouts}.')
+                meta['remote_layout'] = remote_layout
+            elif (remote_layout is not None) and (remote_layout != meta['remote_layout']):
+                raise ValueError(f"The remote_layout of the database is {meta['remote_layout']}.")
+
+            utils.check_header_version(meta)
+
+            if remote_db_key is not None:
+                remote_db_name = pathlib.PurePosixPath(remote_db_key).name
+            elif remote_url is not None:
+                remote_db_name = pathlib.PurePosixPath(utils.parse_url(remote_url).path).name
+            else:
+                remote_db_name = None
 
-        ## Init local storage
-        local_data_path = utils.init_local_storage(local_meta_path, flag, meta)
+            ## Init local storage
+            local_data_path = utils.init_local_storage(local_meta_path, flag, meta)
 
         ## Assign properties
         self._meta_in_remote = meta_in_remote
+        self._remote_last_modified = remote_last_modified
+        self._journal_changes = journal_changes
         self._version_date = version_date
         self._remote_db_key = remote_db_key
+        self._remote_db_name = remote_db_name
         self._flag = flag
         self._n_buckets = n_buckets
         self._write = write
@@ -244,19 +322,47 @@ class Session:
         self._lock = lock
         self._remote_s3_access = remote_s3_access
         self._remote_http_access = remote_http_access
+        self._host_url = host_url
+        self._remote_base_url = remote_base_url
         self._bucket = bucket
         self._meta = meta
         self._threads = threads
         self._local_meta_path = local_meta_path
         self._remote_keys_path = remote_keys_path
+        self._key_index_path = key_index_path
+        self._remote_bloom_path = utils.make_bloom_path(remote_keys_path)
+        self._zstd_dicts_path = utils.make_zstd_dicts_path(local_meta_path)
         self._local_data_path = local_data_path
         self._value_serializer_code = value_serializer_code
+        self._value_cache_size = value_cache_size
+        self._value_cache_policy = value_cache_policy
         self._local_storage_kwargs = local_storage_kwargs
+        self._remote_check = remote_check
+        self._metrics = metrics or bool(metrics_hooks)
+        self._metrics_hooks = metrics_hooks
+        self._retry_policy = retry_policy
+        self._shared = shared
+        self._lock_path = lock_path
 
         ## Assign the metadata object for global
         self.metadata = UserMetadata(local_meta_path, meta)
 
 
+    @property
+    def stale(self):
+        """
+        Whether the remote has been modified since the local copy was last updated. Only lazy sessions check the remote after opening, so this waits for the check to finish. None is returned if the remote couldn't be checked. Open the session again without lazy to update the local copy.
+        """
+        if self._remote_check is None:
+            return False
+
+        try:
+            return self._remote_check.result()
+        except Exception as err:
+            logger.warning('The remote check failed: %s', err)
+            return None
+
+
     def open(self):
         """
 
@@ -306,31 +412,26 @@ class S3dbm(MutableMapping):
 
         """
         ## Open local data
-        local_data = booklet.VariableValue(session._local_data_path, flag='w')
+        if session._shared:
+            local_data = utils.SharedLocalData(session._local_data_path, session._lock_path)
+        else:
+            local_data = booklet.VariableValue(session._local_data_path, flag='w')
 
         ## Open remote keys file
         if session._meta_in_remote:
             remote_keys = booklet.FixedValue(session._remote_keys_path)
+            if session._shared:
+                utils.release_file_lock(remote_keys)
         else:
             remote_keys = None
 
-        ## Init the remote sessions
-        if session._remote_http_access:
-            http_session = s3func.HttpSession(session._threads, read_timeout=session._read_timeout, stream=False)
-        else:
-            http_session = None
-        if session._remote_s3_access:
-            s3_session = s3func.S3Session(session._connection_config, session._bucket, session._threads, read_timeout=session._read_timeout, stream=False)
-        else:
-            s3_session = None
-
         ## Assign properties
         # self._n_buckets = session._n_buckets
         self._changelog = None
-        # self._write = session._write
+        self._write = session._write
         # self._buffer_size = session._buffer_size
-        self._s3_session = s3_session
-        self._http_session = http_session
+        self._remote_sessions = {}
+        self._remote_sessions_lock = threading.Lock()
         # self._remote_s3_access = session._remote_s3_access
         # self._remote_http_access = session._remote_http_access
         # self._bucket = bucket
@@ -340,75 +441,301 @@ class S3dbm(MutableMapping):
         # self._local_meta_path = session._local_meta_path
         # self._local_data_path = session._local_data_path
         # self._remote_keys_path = session._remote_keys_path
+        ## The operations are only measured if metrics are enabled as the wrappers add a little overhead to every call
+        if session._metrics:
+            self._metrics = utils.Metrics(session._metrics_hooks)
+            local_data = utils.MeasuredLocalData(local_data, self._metrics)
+        else:
+            self._metrics = None
         self._local_data = local_data
         self._remote_keys = remote_keys
-        self._deletes = list()
-        self._value_serializer = booklet.serializers.serial_int_dict[session._value_serializer_code]
+        self._local_ranges = None
+        self._local_view = None
+        if session._value_cache_size > 0:
+            self._value_cache = utils.ValueCache(session._value_cache_size, session._value_cache_policy)
+        else:
+            self._value_cache = None
+        self._deletes = set()
+        self._unsynced_keys = set()
+        self._value_serializer = utils.init_value_serializer(session._value_serializer_code, session._meta, self._load_zstd_dict)
         # self._value_serializer = session._value_serializer
 
         # self._manager = multiprocessing.Manager()
         # self._lock = self._manager.Lock()
         self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=session._threads)
 
+        with self._coordinate():
+            ## Load the bloom filter of the remote keys so that most lookups of missing keys are answered from memory
+            if remote_keys is not None:
+                self._remote_bloom = utils.load_remote_bloom(remote_keys, session._remote_keys_path, session._remote_bloom_path)
+            else:
+                self._remote_bloom = None
+
+            ## Open the sorted key index and rebuild it if the remote keys have changed or it wasn't flushed. Readers only index the remote keys as their local data is only a cache of the remote.
+            key_index = utils.KeyIndex(session._key_index_path)
+            key_index_stamp = utils.get_key_index_stamp(session._remote_keys_path)
+            journal_changes = session._journal_changes
+            if (journal_changes is not None) and key_index.is_current(journal_changes[0]):
+                _, set_keys, delete_keys = journal_changes
+                for key in set_keys:
+                    key_index.add(key)
+                for key in delete_keys:
+                    key_index.remove(key)
+                key_index.flush(key_index_stamp)
+            elif not key_index.is_current(key_index_stamp):
+                if remote_keys is None:
+                    keys = local_data.keys()
+                elif session._write:
+                    keys = itertools.chain(remote_keys.keys(), local_data.keys())
+                else:
+                    keys = remote_keys.keys()
+                key_index.build(keys, key_index_stamp)
+            self._key_index = key_index
+
+        ## The number of keys is maintained on every write so that len is constant time. It starts from the key index rather than the metadata as the metadata count isn't updated if a writer wasn't closed, while a dirty index is rebuilt.
+        self._n_keys = len(key_index)
+
         ## Assign the metadata object for the version
         self.metadata = UserMetadata(session._local_meta_path, session._meta, session._version_date)
 
 
+    def _coordinate(self):
+        """
+        The local files of a shared session can only be changed while holding the coordinator lock.
+        """
+        if self._session._shared:
+            return utils.CoordinatorLock(self._session._lock_path)
+
+        return contextlib.nullcontext()
+
+
+    def _get_remote_session(self, name):
+        """
+        The remote sessions are only created on the first remote access as creating the clients is slow. They share the process-wide connection pools and are sized by the number of requests that can be in flight (the executor threads plus the hedged requests). The responses are streamed so that the bodies are only read when needed.
+        """
+        if name not in self._remote_sessions:
+            session = self._session
+            with self._remote_sessions_lock:
+                if name not in self._remote_sessions:
+                    max_connections = session._threads
+                    if session._retry_policy.hedge_after is not None:
+                        max_connections += session._threads
+                    remote_session = None
+                    if name == 'http' and session._remote_http_access:
+                        remote_session = utils.remote_pools.get_session('http', None, None, max_connections, session._read_timeout, True)
+                    elif name == 's3' and session._remote_s3_access:
+                        remote_session = utils.remote_pools.get_session('s3', session._connection_config, session._bucket, max_connections, session._read_timeout, True)
+                    if (remote_session is not None) and (self._metrics is not None):
+                        remote_session = utils.MeasuredRemoteSession(remote_session, self._metrics, name)
+                    self._remote_sessions[name] = remote_session
+
+        return self._remote_sessions[name]
+
+    @property
+    def _s3_session(self):
+        return self._get_remote_session('s3')
+
+    @property
+    def _http_session(self):
+        return self._get_remote_session('http')
+
     def _pre_value(self, value) -> bytes:
 
         ## Serialize to bytes
         try:
-            value = self._session._value_serializer.dumps(value)
+            value = self._dumps(value)
         except Exception as exc:
-            raise utils.SerializeError(exc, self)
+            raise utils.S3dbmSerializeError(exc, [self])
 
         return value
 
+    def _dumps(self, value):
+        """
+
+        """
+        if self._metrics is None:
+            return self._value_serializer.dumps(value)
+
+        start = time.perf_counter()
+        val_bytes = self._value_serializer.dumps(value)
+        self._metrics.record('serialize', start, len(val_bytes))
+
+        return val_bytes
+
+    def train_zstd_dict(self, n_samples: int=utils.default_zstd_dict_samples, dict_size: int=utils.default_zstd_dict_size):
+        """
+        Train a zstd dictionary from a random sample of the local values and use it to compress all of the values that are written afterwards. This only applies to the value serializers that use zstd (e.g. pickle_zstd). The dictionaries are saved as their own objects next to the db and only their ids are stored in the metadata, so older dictionaries are kept for the values that were written with them without making the metadata bigger. The dictionary is uploaded on the next push. Readers download a dictionary (and save it locally) when they first read a value that was compressed with it.
+
+        Parameters
+        ----------
+        n_samples : int
+            The max number of values to sample.
+        dict_size : int
+            The max size of the dictionary in bytes.
+
+        Returns
+        -------
+        int
+            The dictionary id.
+        """
+        if not self._write:
+            raise ValueError('File is open for read only.')
+
+        session = self._session
+        if utils.get_zstd_base_serializer(session._value_serializer_code) is None:
+            raise ValueError('The value serializer must use zstd to train a zstd dictionary.')
+
+        ## The samples must be uncompressed
+        self.sync()
+        samples = []
+        for key in self._key_index.sample(n_samples):
+            local_val = self._local_data.get(key)
+            if local_val is not None:
+                samples.append(self._value_serializer.decompress(local_val[utils.header_len:]))
+
+        dict_ids = session._meta.setdefault('zstd_dict_ids', [])
+        try:
+            dict_id, dict_bytes = utils.train_zstd_dict(samples, dict_size, dict_ids)
+        except zstd.ZstdError as err:
+            raise utils.S3dbmValueError(f'The zstd dictionary could not be trained from {len(samples)} samples: {err}')
+
+        utils.save_zstd_dict(session._zstd_dicts_path, dict_id, dict_bytes)
+        dict_ids.append(dict_id)
+        session._meta.setdefault('zstd_dicts_pending', []).append(dict_id)
+        session._meta['zstd_dict_id'] = dict_id
+
+        self._value_serializer = utils.init_value_serializer(session._value_serializer_code, session._meta, self._load_zstd_dict)
+        if self._value_cache is not None:
+            self._value_cache.clear()
+
+        utils.write_metadata(session._local_meta_path, session._meta)
+
+        return dict_id
+
+
+    def _load_zstd_dict(self, dict_id):
+        """
+
+        """
+        session = self._session
+
+        return utils.load_zstd_dict(session._zstd_dicts_path, dict_id, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, session._remote_db_name, session._retry_policy)
+
+
     def _post_value(self, value: bytes):
 
         ## Serialize from bytes
-        value = self._session._value_serializer.loads(value)
+        if self._metrics is None:
+            return self._value_serializer.loads(value)
 
-        return value
+        start = time.perf_counter()
+        obj = self._value_serializer.loads(value)
+        self._metrics.record('deserialize', start, len(value))
 
+        return obj
 
-    def keys(self):
+
+    def _sync_local_data(self):
         """
 
         """
-        if self._remote_keys:
-            return self._remote_keys.keys()
-        else:
-            return self._local_data.keys()
+        self._local_data.sync()
+        self._unsynced_keys.clear()
 
 
-    def items(self, keys: List[str]=None):
+    def keys(self, prefix: str=None, start_after: str=None, end_before: str=None, delimiter: str=None):
         """
+        Iterate over the keys in sorted order. The keys come from the local sorted key index, which includes the keys in the remote and the keys that only exist locally. Only the matching part of the index is read.
+
+        Parameters
+        ----------
+        prefix : str or None
+            Only return the keys that start with this prefix.
+        start_after : str or None
+            Only return the keys that are greater than this key.
+        end_before : str or None
+            Only return the keys that are less than this key.
+        delimiter : str or None
+            Roll up the keys that contain the delimiter after the prefix into a single common prefix ending in the delimiter (like S3 list_objects).
+
+        Returns
+        -------
+        Generator of str
+        """
+        return self._key_index.iter_keys(prefix, start_after, end_before, delimiter)
+
 
+    def count(self, prefix: str=None):
         """
-        if self._remote_keys:
-            pass
-        if keys is None:
-            keys = self.keys(prefix, start_after, delimiter)
-        futures = {}
-        for key in keys:
-            f = self._executor.submit(utils.get_object_final, key, self._bucket, self._client, self._public_url, self._buffer_size, self._read_timeout, self._provider, self._compression, self._cache, self._return_bytes)
-            futures[f] = key
+        Count the keys. This is answered from the local files and never lists the remote.
+
+        Parameters
+        ----------
+        prefix : str or None
+            Only count the keys that start with this prefix. None will return the same as len.
 
-        for f in concurrent.futures.as_completed(futures):
-            yield futures[f], f.result()
+        Returns
+        -------
+        int
+        """
+        if not prefix:
+            return self._n_keys
 
+        return self._key_index.count(prefix)
+
+
+    def _iter_values_bytes(self, keys, window, ordered):
+        """
+
+        """
+        session = self._session
+        if window is None:
+            window = session._threads * 2
+        elif window < 1:
+            raise ValueError('window must be at least 1.')
+
+        ## booklet only reads the values that have been written to the file
+        if self._write:
+            self._sync_local_data()
 
-    def values(self, keys: List[str]=None):
         if keys is None:
-            keys = self.keys(prefix, start_after, delimiter)
-        futures = {}
-        for key in keys:
-            f = self._executor.submit(utils.get_object_final, key, self._bucket, self._client, self._public_url, self._buffer_size, self._read_timeout, self._provider, self._compression, self._cache, self._return_bytes)
-            futures[f] = key
+            keys = self.keys()
+        elif (self._remote_keys is not None) and (not self._write):
+            ## The local data of a reader is only a cache of the remote
+            keys = (key for key in keys if self._in_remote(key))
+        elif self._deletes:
+            keys = (key for key in keys if key not in self._deletes)
+
+        yield from utils.iter_values(self._local_data, self._remote_keys, keys, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, self._executor, window, ordered, session._remote_db_name, session._retry_policy)
+
+
+    def items(self, keys: List[str]=None, window: int=None, ordered: bool=True):
+        """
+        Iterate over the keys and values. Values that need to come from the remote are prefetched concurrently, but never more than window ahead of the consumer.
+
+        Parameters
+        ----------
+        keys : list of str or None
+            The keys to iterate over. Any iterable will do (including a generator) as it is consumed lazily. Keys that don't exist are skipped. None will iterate over all keys.
+        window : int or None
+            The max number of keys that are fetched ahead of the consumer. None will use twice the number of threads.
+        ordered : bool
+            Should the items be yielded in the order of the keys? If False, the items are yielded as soon as they are available.
+
+        Returns
+        -------
+        Generator of tuples of key and value
+        """
+        for key, value_bytes in self._iter_values_bytes(keys, window, ordered):
+            yield key, self._post_value(value_bytes)
 
-        for f in concurrent.futures.as_completed(futures):
-            yield f.result()
+
+    def values(self, keys: List[str]=None, window: int=None, ordered: bool=True):
+        """
+        Iterate over the values. See the items method for the parameters.
+        """
+        for key, value_bytes in self._iter_values_bytes(keys, window, ordered):
+            yield self._post_value(value_bytes)
 
 
     def __iter__(self):
@@ -416,59 +743,354 @@ class S3dbm(MutableMapping):
 
     def __len__(self):
         """
-        There really should be a better way for this...
+        The key count is maintained on every write and recalibrated on every push.
         """
-        params = {'Bucket': self._bucket}
+        return self._n_keys
 
-        count = 0
 
-        while True:
-            js1 = self._client.list_objects_v2(**params)
+    def __contains__(self, key):
+        return self._key_exists(key)
 
-            if 'Contents' in js1:
-                count += len(js1['Contents'])
 
-                if 'NextContinuationToken' in js1:
-                    params['ContinuationToken'] = js1['NextContinuationToken']
-                else:
-                    break
+    def _get_value_bytes(self, key):
+        """
+
+        """
+        session = self._session
+        self._check_unsynced(key)
+
+        ## The keys deleted since the last push are still in the remote keys until they are pushed
+        if key in self._deletes:
+            if self._metrics is not None:
+                self._metrics.incr('get.missing')
+            return None
+
+        remote_keys = self._remote_keys
+        if (remote_keys is not None) and (not self._in_remote(key)):
+            ## The local data of a reader is only a cache of the remote
+            if not self._write:
+                if self._metrics is not None:
+                    self._metrics.incr('get.missing')
+                return None
+            remote_keys = None
+
+        value = utils.get_value(self._local_data, remote_keys, key, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, session._remote_db_name, session._retry_policy)
+
+        ## A downloaded value is saved to the local data, but it's in the write buffer until the next sync
+        downloaded = (value is not None) and (remote_keys is not None) and (key not in self._local_data)
+        if downloaded:
+            self._unsynced_keys.add(key)
+
+        if self._metrics is not None:
+            if value is None:
+                self._metrics.incr('get.missing')
+            elif downloaded:
+                self._metrics.incr('get.remote')
             else:
-                break
+                self._metrics.incr('get.local')
 
-        return count
+        return value
 
 
-    def __contains__(self, key):
-        if self._remote_hash:
-            return key in self._remote_keys
+    def open_stream(self, key: str, cache: bool=True):
+        """
+        Open a read-only file-like object of the raw value bytes (before the value_serializer is applied). If the value needs to come from the remote, then it's streamed in buffer_size chunks rather than being downloaded all at once. This is meant for very large values.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value.
+        cache : bool
+            Should the remote value be saved to the local data once it has been fully read? Values larger than utils.stream_max_cache_bytes are never saved, as the whole value would need to be held in memory to write it.
+
+        Returns
+        -------
+        io.BufferedIOBase
+        """
+        session = self._session
+        self._check_unsynced(key)
+
+        ## The local data of a reader is only a cache of the remote
+        in_remote = self._in_remote(key)
+        if (not in_remote) and (not self._write) and (self._remote_keys is not None):
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        if key in self._local_data:
+            if (not in_remote) or (not utils.check_local_vs_remote(self._local_data, self._remote_keys, key)):
+                return io.BytesIO(self._local_data[key][utils.header_len:])
+
+        if not in_remote:
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        remote_value = self._remote_keys[key]
+        obj_name, offset, length = utils.get_location(key, remote_value, session._remote_db_name)
+        if offset is None:
+            range_start, range_end = None, None
+        elif length == 0:
+            return io.BytesIO(b'')
         else:
-            return key in self._local_data
+            range_start, range_end = offset, offset + length - 1
+
+        ## Only the initial response is retried as the body is streamed to the caller
+        resp = session._retry_policy.call(lambda: utils.get_remote_response(obj_name, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, range_start, range_end), hedge=False)
+        raw = utils.ValueStream(resp, key, self._local_data, utils.parse_header(remote_value)[0], cache)
+
+        return io.BufferedReader(raw, session._buffer_size)
+
+
+    def get_range(self, key: str, start: int, length: int):
+        """
+        Get a byte range of the raw value bytes (before the value_serializer is applied). If the whole value isn't in the local data, then only the requested range is downloaded with an http Range request. The downloaded ranges are saved to a local range cache file, so repeat reads of the same bytes don't go to the remote.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value.
+        start : int
+            The start byte position.
+        length : int
+            The number of bytes to read. Fewer bytes are returned if the value ends first.
+
+        Returns
+        -------
+        bytes
+        """
+        if (start < 0) or (length < 0):
+            raise ValueError('start and length must be >= 0.')
+
+        session = self._session
+        end = start + length
+        start_pos = utils.header_len + start
+        end_pos = utils.header_len + end
+        self._check_unsynced(key)
+
+        ## The local data of a reader is only a cache of the remote
+        in_remote = self._in_remote(key)
+        if (not in_remote) and (not self._write) and (self._remote_keys is not None):
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        if key in self._local_data:
+            if (not in_remote) or (not utils.check_local_vs_remote(self._local_data, self._remote_keys, key)):
+                return self._local_data[key][start_pos:end_pos]
+
+        if not in_remote:
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        if self._local_ranges is None:
+            if session._shared:
+                ## The ranges file can't be shared by processes, so a shared session only caches the ranges in memory
+                self._local_ranges = utils.MemoryData()
+            else:
+                local_ranges_path = session._local_meta_path.parent.joinpath(session._local_meta_path.name + '.ranges')
+                self._local_ranges = booklet.VariableValue(local_ranges_path, 'c', key_serializer='str', value_serializer='bytes', n_buckets=session._n_buckets)
+
+        range_bytes = utils.get_range(self._local_ranges, self._remote_keys[key], key, start, end, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, self._executor, session._remote_db_name, session._retry_policy)
+
+        return range_bytes
+
+
+    def _get_value(self, key):
+        """
+        Get the decoded value from the value cache if it's enabled. Returns utils.missing if the key doesn't exist.
+        """
+        if self._value_cache is not None:
+            value = self._value_cache.get(key, utils.missing)
+            if value is not utils.missing:
+                if self._metrics is not None:
+                    self._metrics.incr('get.cache')
+                return value
+
+        value_bytes = self._get_value_bytes(key)
+        if value_bytes is None:
+            return utils.missing
+
+        value = self._post_value(value_bytes)
+        if self._value_cache is not None:
+            self._value_cache.set(key, value, utils.estimate_value_size(value, value_bytes))
+
+        return value
+
+
+    def cache_info(self):
+        """
+        The hit, miss, and eviction counters and the size of the value cache. Returns None if the value cache isn't enabled.
+
+        Returns
+        -------
+        dict or None
+        """
+        if self._value_cache is not None:
+            return self._value_cache.info()
+
+
+    def stats(self, reset: bool=False):
+        """
+        The counters and latency histograms of the operations. Only available if the session was opened with metrics=True (or metrics_hooks).
+
+        The counters are get.cache (value cache hits), get.local (served from the local data), get.remote (downloaded), get.missing, and remote.retries. The operations are remote.get, remote.put, and remote.delete (per request, where the latency is up to the response headers), local.read, local.write, local.delete, and local.sync (booklet), and serialize and deserialize. Each has the count, errors, total_seconds, mean_ms, n_bytes, the latency percentiles, and a histogram of the latencies in power of 2 microsecond buckets.
+
+        Parameters
+        ----------
+        reset : bool
+            Reset the metrics after they have been returned.
+
+        Returns
+        -------
+        dict
+        """
+        if self._metrics is None:
+            raise ValueError('metrics=True must be passed to the Session to collect stats.')
+
+        stats = self._metrics.snapshot()
+        if self._value_cache is not None:
+            stats['value_cache'] = self._value_cache.info()
+        stats['retries'] = self._session._retry_policy.info()
+        if reset:
+            self._metrics.reset()
+
+        return stats
+
+
+    def add_hook(self, hook):
+        """
+        Add a function that is called after every measured operation with a dict of the op, start_time, seconds, n_bytes, error, and extra info like the key. It's called in the thread that ran the operation, so it must be thread safe and fast. Only available if the session was opened with metrics=True (or metrics_hooks).
+        """
+        if self._metrics is None:
+            raise ValueError('metrics=True must be passed to the Session to add hooks.')
+
+        self._metrics.add_hook(hook)
+
+
+    def remove_hook(self, hook):
+        """
+
+        """
+        if self._metrics is not None:
+            self._metrics.remove_hook(hook)
 
 
     def get(self, key, default=None):
-        value = utils.get_value(self._local_data, self._remote_keys, key, self._bucket, self._s3, self._session, self._hiost_url, self._remote_base_url)
+        value = self._get_value(key)
 
-        if value is None:
+        if value is utils.missing:
             return default
         else:
-            return self._post_value(value)
+            return value
 
 
-    def update(self, key_value_dict: Union[Dict[str, bytes], Dict[str, io.IOBase]]):
+    def _get_local_view(self):
         """
+        The memory map of the local data file is only created when it's first needed.
+        """
+        if self._local_view is None:
+            with self._remote_sessions_lock:
+                if self._local_view is None:
+                    self._local_view = utils.LocalDataView(self._session._local_data_path)
+
+        return self._local_view
+
 
+    def get_view(self, key: str):
         """
-        if self._write:
-            with self._lock:
-                futures = {}
-                for key, value in key_value_dict.items():
-                    if isinstance(value, bytes):
-                        value = io.BytesIO(value)
-                    f = self._executor.submit(utils.put_object_s3, self._client, self._bucket, key, value, self._buffer_size, self._compression)
-                    futures[f] = key
-        else:
+        Get the stored (serialized) bytes of a value as a read only memoryview. Values in the local data are read straight from a memory map of the local data file without being copied, so with the 'bytes' value serializer they can be passed to e.g. numpy.frombuffer as is. Values that are missing locally (or outdated) are downloaded first.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value.
+
+        Returns
+        -------
+        memoryview
+        """
+        self._check_unsynced(key)
+
+        ## The local data of a reader is only a cache of the remote
+        in_remote = self._in_remote(key)
+        if (not in_remote) and (not self._write) and (self._remote_keys is not None):
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        view = self._get_local_view().get(key)
+        if view is not None:
+            if (not in_remote) or (not utils.is_remote_newer(view, self._remote_keys[key])):
+                return view[utils.header_len:]
+
+        value_bytes = self._get_value_bytes(key)
+        if value_bytes is None:
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+        return memoryview(value_bytes)
+
+
+    def headers(self, remote: bool=False):
+        """
+        Load the value headers (timestamp and md5) of all of the local values or all of the remote keys as a numpy structured array, so that they can be compared across many keys at once (e.g. with numpy.isin on the keys and md5s). The remote keys of the packed and content layouts also have the location of the values. Requires numpy.
+
+        Parameters
+        ----------
+        remote : bool
+            Load the headers of the remote keys rather than the local values.
+
+        Returns
+        -------
+        numpy structured array
+        """
+        if remote:
+            if self._remote_keys is None:
+                return utils.headers_to_array([], [])
+            return utils.load_remote_headers(self._remote_keys)
+
+        if self._unsynced_keys:
+            self._sync_local_data()
+
+        ## Only the headers are read from the memory map rather than the whole values. The values of a shared session that haven't been handed off aren't in the file.
+        if self._session._shared:
+            return utils.load_local_headers(self._local_data)
+
+        return utils.load_local_headers(self._local_data, self._get_local_view())
+
+
+    def update(self, key_value_dict: Union[Dict[str, Any], Iterator], threads: int=None, window: int=None):
+        """
+        Write many keys and values. The values are serialized, compressed, and hashed in a pool of threads, while the writes to the local file happen in the calling thread in the order of the keys. zstd and md5 release the GIL, so bulk loads of large values use all of the cores.
+
+        Parameters
+        ----------
+        key_value_dict : dict or iterator of (key, value) tuples
+            The keys and values to write.
+        threads : int or None
+            The number of serialization threads. None defaults to the number of cores.
+        window : int or None
+            The max number of values that can be serialized ahead of the writes. None defaults to threads * 2.
+
+        Returns
+        -------
+        None
+        """
+        if not self._write:
             raise ValueError('File is open for read only.')
 
+        if threads is None:
+            threads = os.cpu_count() or 1
+        if window is None:
+            window = threads * 2
+        elif window < 1:
+            raise ValueError('window must be at least 1.')
+
+        if hasattr(key_value_dict, 'items'):
+            key_value_dict = key_value_dict.items()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            local_values = utils.map_ordered(self._make_local_value, key_value_dict, executor, window)
+            while True:
+                try:
+                    key, value = next(local_values)
+                except StopIteration:
+                    break
+                except Exception as exc:
+                    raise utils.S3dbmSerializeError(exc, [self])
+                self._set_local_value(key, value)
+
 
     def prune(self):
         """
@@ -499,30 +1121,100 @@ class S3dbm(MutableMapping):
 
 
     def __getitem__(self, key: str):
-        value = utils.get_value(self._local_data, self._remote_keys, key, self._bucket, self._s3, self._session, self._hiost_url, self._remote_base_url)
+        value = self._get_value(key)
 
-        if value is None:
-            raise utils.S3dbmKeyError(f'{key} does not exist.', self)
+        if value is utils.missing:
+            raise utils.S3dbmKeyError(f'{key} does not exist.')
         else:
-            return self._post_value(value)
+            return value
+
+
+    def _check_unsynced(self, key):
+        """
+        booklet only reads the values that have been written to the file, so the write buffer is synced before reading a key that has been written since the last sync.
+        """
+        if key in self._unsynced_keys:
+            self._sync_local_data()
+
+
+    def _in_remote(self, key):
+        """
+        Check the bloom filter in memory before the remote keys file. The keys deleted since the last push aren't counted as in the remote.
+        """
+        if self._remote_keys is None:
+            return False
+        if key in self._deletes:
+            return False
+        if key not in self._remote_bloom:
+            return False
+
+        return key in self._remote_keys
+
+
+    def _key_exists(self, key):
+        """
+        booklet only checks the keys that have been written to the file, so the keys written since the last sync are checked separately.
+        """
+        if key in self._unsynced_keys:
+            return True
+        ## The local data of a reader is only a cache of the remote
+        if (self._remote_keys is not None) and (not self._write):
+            return self._in_remote(key)
+        if key in self._local_data:
+            return True
+
+        return self._in_remote(key)
+
+
+    def _make_local_value(self, key_value):
+        """
+        Serialize the value and prepend the header. This can run in any thread, so the errors are left to the caller.
+        """
+        key, value = key_value
+        val_bytes = self._dumps(value)
 
+        return key, utils.make_header(val_bytes) + val_bytes
+
+    def _set_local_value(self, key, value):
+        """
+        Write the header and value bytes to the local file and update the key index.
+        """
+        if not self._key_exists(key):
+            self._n_keys += 1
+            self._key_index.add(key)
+        self._deletes.discard(key)
+        self._unsynced_keys.add(key)
+        if self._value_cache is not None:
+            self._value_cache.invalidate(key)
+        self._local_data[key] = value
 
     def __setitem__(self, key: str, value):
         if self._write:
-            dt_us_int = utils.make_timestamp()
             val_bytes = self._pre_value(value)
-            self._local_data[key] = utils.int_to_bytes(dt_us_int, 7) + val_bytes
+            self._set_local_value(key, utils.make_header(val_bytes) + val_bytes)
         else:
             raise ValueError('File is open for read only.')
 
     def __delitem__(self, key):
         if self._write:
-            if self._remote_keys:
-                del self._remote_keys[key]
-                self._deletes.append(key)
+            if not self._key_exists(key):
+                raise utils.S3dbmKeyError(f'{key} does not exist.')
+
+            self._n_keys -= 1
+            self._key_index.remove(key)
+            if self._value_cache is not None:
+                self._value_cache.invalidate(key)
 
-            if key in self._local_data:
+            if self._remote_keys is not None:
+                if self._in_remote(key):
+                    self._deletes.add(key)
+
+            ## booklet syncs the write buffer before deleting
+            try:
                 del self._local_data[key]
+            except KeyError:
+                pass
+            self._unsynced_keys.clear()
         else:
             raise ValueError('File is open for read only.')
 
@@ -556,10 +1248,31 @@ class S3dbm(MutableMapping):
         else:
             raise ValueError('File is open for read only.')
 
+    def _sync_n_keys(self):
+        """
+
+        """
+        if self._write:
+            session = self._session
+            if session._meta.get('n_keys') != self._n_keys:
+                session._meta['n_keys'] = self._n_keys
+                utils.write_metadata(session._local_meta_path, session._meta)
+
+
     def close(self, force_close=False):
         self._executor.shutdown(cancel_futures=force_close)
+        with self._coordinate():
+            self._sync_n_keys()
+            self._key_index.flush(utils.get_key_index_stamp(self._session._remote_keys_path))
+        self._key_index.close()
         # self._manager.shutdown()
         utils.close_files(self._local_data, self._remote_keys)
+        if self._local_ranges is not None:
+            self._local_ranges.close()
+        if self._local_view is not None:
+            self._local_view.close()
+        if self._value_cache is not None:
+            self._value_cache.clear()
 
 
     # def __del__(self):
@@ -568,14 +1281,209 @@ class S3dbm(MutableMapping):
     def sync(self):
         self._executor.shutdown()
         del self._executor
-        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._session._threads)
         # if self._remote_keys:
         #     self._remote_keys.sync()
-        self._local_data.sync()
+        self._sync_local_data()
+        with self._coordinate():
+            self._sync_n_keys()
+            self._key_index.flush(utils.get_key_index_stamp(self._session._remote_keys_path))
 
     # def flush(self):
     #     self.sync()
 
+    def pull(self, keys: List[str]=None, prefix: str=None, max_requests: int=None, max_buffer_bytes: int=None):
+        """
+        Download the remote values into the local data. Only the values that are missing or older in the local data are downloaded. The downloads run concurrently through the thread pool.
+
+        Parameters
+        ----------
+        keys : list of str or None
+            Only pull these keys. None will pull all of the remote keys.
+        prefix : str or None
+            Only pull the keys that start with this prefix.
+        max_requests : int or None
+            The max number of concurrent downloads. None defaults to the number of threads.
+        max_buffer_bytes : int or None
+            The max number of downloaded value bytes held in memory before they are written to the local data. None defaults to buffer_size * threads.
+
+        Returns
+        -------
+        list of the keys that were pulled
+            If any values failed to download, then the rest are still written to the local data and an S3dbmTransferError is raised afterwards with the failed keys and their errors in its failures attribute.
+        """
+        if self._remote_keys is None:
+            return []
+
+        session = self._session
+        if max_requests is None:
+            max_requests = session._threads
+        if max_buffer_bytes is None:
+            max_buffer_bytes = session._buffer_size * session._threads
+
+        ## The remote keys are read up front as the file can't be iterated over while it's also being queried
+        if keys is None:
+            keys = self._remote_keys.keys()
+        if prefix is not None:
+            keys = [key for key in keys if key.startswith(prefix)]
+        else:
+            keys = list(keys)
+        if self._deletes:
+            keys = [key for key in keys if key not in self._deletes]
+
+        ## Make sure the local data has been flushed so it can be read
+        self._sync_local_data()
+
+        pulled, failures = utils.pull_values(self._local_data, self._remote_keys, keys, session._remote_db_key, session._remote_http_access, self._s3_session, self._http_session, session._host_url, session._remote_base_url, self._executor, max_requests, max_buffer_bytes, session._remote_db_name, session._retry_policy)
+
+        if self._value_cache is not None:
+            for key in pulled:
+                self._value_cache.invalidate(key)
+
+        self._sync_local_data()
+
+        utils.check_transfer_failures(failures, 'download')
+
+        return pulled
+
+
+    def push(self, keys: List[str]=None, max_in_flight_bytes: int=None, train_zstd_dict: bool=False):
+        """
+        Upload the keys/values that have been changed locally to the remote. The changed values are determined from the changelog and are uploaded concurrently through the thread pool. Once the values have been uploaded, the remote keys file is uploaded and the metadata object is uploaded last.
+
+        Parameters
+        ----------
+        keys : list of str or None
+            Only push these keys (if they have changed). None will push all of the changed keys. Deletes are always pushed.
+        max_in_flight_bytes : int or None
+            The max number of value bytes held in memory by the queued and running uploads. None defaults to buffer_size * threads.
+        train_zstd_dict : bool
+            Retrain the zstd dictionary from the local values before pushing (see train_zstd_dict). The new dictionary is used for the values written after the push.
+
+        Returns
+        -------
+        bool
+            True if anything was pushed to the remote. If any values failed to upload, then the rest are still pushed and an S3dbmTransferError is raised afterwards with the failed keys and their errors in its failures attribute. The failed values stay in the local data and are retried on the next push.
+        """
+        if not self._write:
+            raise ValueError('File is open for read only.')
+
+        session = self._session
+        if not session._remote_s3_access:
+            raise ValueError('The remote S3 connection parameters must be passed to push to the remote.')
+
+        if max_in_flight_bytes is None:
+            max_in_flight_bytes = session._buffer_size * session._threads
+
+        if train_zstd_dict:
+            try:
+                self.train_zstd_dict()
+            except utils.S3dbmValueError as err:
+                logger.warning(err.message)
+
+        self.metadata.sync()
+        self._sync_local_data()
+
+        ## The new zstd dictionaries are uploaded before the values that were compressed with them
+        pending_dicts = session._meta.get('zstd_dicts_pending')
+        if pending_dicts:
+            for dict_id in pending_dicts:
+                dict_path = session._zstd_dicts_path.joinpath(str(dict_id))
+                utils.put_remote_file(self._s3_session, utils.make_remote_key(session._remote_db_key, utils.make_zstd_dict_name(session._remote_db_name, dict_id)), dict_path, {'timestamp': str(utils.make_timestamp())})
+            del session._meta['zstd_dicts_pending']
+
+        ## Determine what has changed
+        self._changelog = utils.create_changelog(self._local_data, self._remote_keys, session._local_meta_path, session._n_buckets, session._local_data_path, session._remote_keys_path, self._executor)
+
+        ## Upload the values
+        remote_layout = session._meta['remote_layout']
+        if remote_layout == 'packed':
+            uploaded, failures, new_packs = utils.upload_packs(self._local_data, self._changelog, self._s3_session, self._executor, session._remote_db_key, max_in_flight_bytes, keys)
+        elif remote_layout == 'content':
+            ## The content index is only rebuilt from the remote keys if they have changed since the last push
+            content_index = utils.open_content_index(self._remote_keys, session._remote_keys_path)
+            uploaded, failures = utils.upload_content(self._local_data, self._changelog, self._s3_session, self._executor, session._remote_db_key, max_in_flight_bytes, content_index, keys)
+        else:
+            uploaded, failures = utils.upload_changes(self._local_data, self._changelog, self._s3_session, self._executor, session._remote_db_key, max_in_flight_bytes, keys)
+
+        deletes = list(self._deletes)
+        if (not uploaded) and (not deletes) and session._meta_in_remote:
+            if remote_layout == 'content':
+                content_index.close()
+            utils.check_transfer_failures(failures, 'upload')
+            return False
+
+        ## Update and upload the remote keys file
+        if remote_layout == 'packed':
+            empty_packs = utils.update_pack_counts(session._meta.setdefault('packs', {}), self._remote_keys, new_packs, uploaded, deletes, session._remote_db_name)
+            value_len = utils.packed_value_len
+        elif remote_layout == 'content':
+            if self._remote_keys is not None:
+                old_remote_values = [self._remote_keys.get(key) for key in itertools.chain(uploaded, deletes)]
+            else:
+                old_remote_values = []
+            value_len = utils.content_value_len
+        else:
+            value_len = utils.header_len
+
+        if self._remote_keys is not None:
+            self._remote_keys.close()
+            self._remote_keys = None
+
+        utils.update_remote_keys(session._remote_keys_path, uploaded, deletes, session._n_buckets, session._meta_in_remote, value_len)
+        self._remote_keys = booklet.FixedValue(session._remote_keys_path)
+        if remote_layout == 'content':
+            unreferenced = utils.update_content_index(content_index, uploaded, old_remote_values, session._remote_keys_path, session._remote_db_name)
+            content_index.close()
+
+        utils.put_remote_file(self._s3_session, session._remote_db_key + '.remote_keys', session._remote_keys_path)
+
+        self._remote_bloom = utils.save_remote_bloom(self._remote_keys, session._remote_bloom_path)
+        utils.put_remote_file(self._s3_session, session._remote_db_key + '.remote_keys.bloom', session._remote_bloom_path)
+        self._key_index.flush(utils.get_key_index_stamp(session._remote_keys_path))
+
+        ## The remote key count is exact after the update. The local count also has the new keys that failed to upload as they are still in the local data.
+        session._meta['n_keys'] = len(self._remote_keys)
+        if keys is None:
+            self._n_keys = session._meta['n_keys'] + sum(1 for key in failures if key not in self._remote_keys)
+
+        ## Journal the changes so that the readers only need to download the segments that they are missing
+        last_modified = utils.make_timestamp()
+        if session._meta_in_remote and (session._remote_last_modified is not None):
+            segment = utils.put_journal_segment(self._s3_session, session._remote_db_key, session._remote_last_modified, last_modified, uploaded, deletes)
+            journal = session._meta.get('journal', []) + [segment]
+        else:
+            journal = []
+        expired = journal[:-utils.journal_max_segments]
+        session._meta['journal'] = journal[-utils.journal_max_segments:]
+
+        ## Upload the metadata last
+        utils.push_metadata(session._local_meta_path, session._meta, self._s3_session, session._remote_db_key, last_modified)
+        session._meta_in_remote = True
+        session._remote_last_modified = last_modified
+
+        if expired:
+            exp_failures = utils.delete_journal_segments(self._s3_session, session._remote_db_key, expired)
+            if exp_failures:
+                logger.warning('These journal segments failed to be deleted: %s', ', '.join(exp_failures))
+
+        ## Remove the deleted objects once they are no longer referenced by the remote keys file. Packs and content objects are only removed once none of the keys reference them.
+        if remote_layout == 'packed':
+            deletes = empty_packs
+        elif remote_layout == 'content':
+            deletes = unreferenced
+        if deletes:
+            del_failures = utils.delete_remote_values(self._s3_session, self._executor, session._remote_db_key, deletes)
+            if del_failures:
+                logger.warning('These remote objects failed to be deleted: %s', ', '.join(del_failures))
+
+        self._deletes = set()
+
+        ## The values that did upload have been committed, but the caller needs to know about the ones that didn't
+        utils.check_transfer_failures(failures, 'upload')
+
+        return True
+
 
 def open(
     bucket: str, connection_config: Union[s3func.utils.S3ConnectionConfig, s3func.utils.B2ConnectionConfig]=None, public_url: HttpUrl=None, flag: str = "r", buffer_size: int=512000, retries: int=3, read_timeout: int=120, provider: str=None, threads: int=30, compression: bool=True, cache: MutableMapping=None, return_bytes: bool=False):
@@ -0,0 +1,48 @@
+import sys
+import pathlib
+import uuid
+import pytest
+
+#################################################
+### Parameters
+
+repo_path = pathlib.Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(repo_path.joinpath('benchmarks')))
+
+import fake_s3
+
+bucket = 'test'
+
+################################################
+### Fixtures
+
+
+@pytest.fixture(scope='session')
+def s3_server():
+    """
+    A local in-memory S3 compatible server (benchmarks/fake_s3.py) for the whole test session.
+    """
+    with fake_s3.FakeS3Server() as server:
+        yield server
+
+
+@pytest.fixture
+def remote(s3_server):
+    """
+    The remote parameters of a new database. Each test gets its own remote_db_key.
+    """
+    remote_db_key = f'{uuid.uuid4().hex}/db.s3dbm'
+
+    return {
+        'remote_db_key': remote_db_key,
+        'bucket': bucket,
+        'connection_config': s3_server.connection_config(),
+        }
+
+
+@pytest.fixture
+def remote_url(s3_server, remote):
+    """
+    The public (http) url of the remote database.
+    """
+    return f"{s3_server.endpoint_url}/{bucket}/{remote['remote_db_key']}"
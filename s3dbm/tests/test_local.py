@@ -0,0 +1,303 @@
+import logging
+import time
+import concurrent.futures
+import pytest
+from s3dbm import main, utils
+
+#################################################
+### Parameters
+
+keys = ['a/1', 'a/2', 'a/b/1', 'a/b/2', 'b/1', 'b/2', 'c', 'é/1']
+
+################################################
+### Tests
+
+
+def test_key_index_queries(tmp_path):
+    """
+    The flushed keys in the file and the keys added and removed since are merged into the queries.
+    """
+    index = utils.KeyIndex(tmp_path.joinpath('keys.index'))
+    index.build(keys[:5], (1, 1))
+    index.add('b/1')
+    index.add('b/2')
+    index.add('c')
+    index.add('é/1')
+    index.remove('a/2')
+
+    def check(index):
+        assert list(index.iter_keys()) == [key for key in keys if key != 'a/2']
+        assert list(index.iter_keys(prefix='a/')) == ['a/1', 'a/b/1', 'a/b/2']
+        assert list(index.iter_keys(prefix='a/b/')) == ['a/b/1', 'a/b/2']
+        assert list(index.iter_keys(prefix='x')) == []
+        assert list(index.iter_keys(start_after='a/b/1', end_before='c')) == ['a/b/2', 'b/1', 'b/2']
+        assert list(index.iter_keys(prefix='a/', start_after='a/1')) == ['a/b/1', 'a/b/2']
+        assert list(index.iter_keys(delimiter='/')) == ['a/', 'b/', 'c', 'é/']
+        assert list(index.iter_keys(prefix='a/', delimiter='/')) == ['a/1', 'a/b/']
+        assert index.count('a/') == 3
+        assert index.count('é') == 1
+        assert len(index) == 7
+
+    check(index)
+    assert not index.is_current((1, 1))
+
+    index.flush((2, 2))
+    check(index)
+    index.close()
+
+    index = utils.KeyIndex(tmp_path.joinpath('keys.index'))
+    assert index.is_current((2, 2))
+    assert not index.is_current((1, 1))
+    check(index)
+    index.close()
+
+
+def test_db_keys_and_count(tmp_path, remote):
+    """
+
+    """
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='n', value_serializer='pickle', **remote)
+    db = session.open()
+    for key in keys:
+        db[key] = key
+    del db['a/2']
+
+    assert list(db.keys(prefix='a/')) == ['a/1', 'a/b/1', 'a/b/2']
+    assert list(db.keys(delimiter='/')) == ['a/', 'b/', 'c', 'é/']
+    assert db.count() == len(db) == 7
+    assert db.count('b/') == 2
+    db.close()
+    session.close()
+
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='r', value_serializer='pickle', **remote)
+    db = session.open()
+    assert list(db.keys()) == [key for key in keys if key != 'a/2']
+    assert len(db) == 7
+    db.close()
+    session.close()
+
+
+def test_count_after_crash(tmp_path, remote):
+    """
+    The key count of a writer that wasn't closed comes from the rebuilt key index rather than the stale metadata count.
+    """
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='n', value_serializer='pickle', **remote)
+    db = session.open()
+    for key in keys:
+        db[key] = key
+    db.close()
+
+    ## Write more keys to the local data and leave the writer without closing it
+    db = session.open()
+    db['x/1'] = 1
+    db['x/2'] = 2
+    del db['a/1']
+    db._sync_local_data()
+    db._executor.shutdown()
+    db._key_index.close()
+    utils.close_files(db._local_data, db._remote_keys)
+    session.close()
+
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='w', value_serializer='pickle', **remote)
+    db = session.open()
+    assert len(db) == db.count() == len(keys) + 1
+    assert 'x/1' in db
+    assert 'a/1' not in db
+    db.close()
+    session.close()
+
+
+def test_bloom_filter(tmp_path):
+    """
+
+    """
+    in_keys = [f'k{i}' for i in range(2000)]
+    bloom = utils.BloomFilter.from_keys(in_keys, len(in_keys))
+    assert all(key in bloom for key in in_keys)
+
+    n_false = sum(f'x{i}' in bloom for i in range(2000))
+    assert n_false < 2000 * utils.bloom_error_rate * 3
+
+    bloom_path = tmp_path.joinpath('keys.bloom')
+    bloom.save(bloom_path)
+    bloom2 = utils.BloomFilter.load(bloom_path)
+    assert all(key in bloom2 for key in in_keys)
+    assert sum(f'x{i}' in bloom2 for i in range(2000)) == n_false
+
+    tmp_path.joinpath('other').write_bytes(b'0' * 100)
+    with pytest.raises(utils.S3dbmTypeError):
+        utils.BloomFilter.load(tmp_path.joinpath('other'))
+
+
+def test_zstd_dict(tmp_path, remote):
+    """
+    The values written before and after training a dictionary can both be read.
+    """
+    path = tmp_path.joinpath('db.s3dbm')
+    session = main.Session(path, flag='n', value_serializer='pickle_zstd', **remote)
+    db = session.open()
+    for i in range(500):
+        db[f'k{i}'] = {'station': f'site {i % 20}', 'values': [i % 13] * 20}
+    dict_id = db.train_zstd_dict(dict_size=2**12)
+    assert session._meta['zstd_dict_ids'] == [dict_id]
+    assert session._zstd_dicts_path.joinpath(str(dict_id)).exists()
+    for i in range(500, 600):
+        db[f'k{i}'] = {'station': f'site {i % 20}', 'values': [i % 13] * 20}
+    db.close()
+    session.close()
+
+    session = main.Session(path, flag='r', value_serializer='pickle_zstd', **remote)
+    db = session.open()
+    assert db['k1'] == {'station': 'site 1', 'values': [1] * 20}
+    assert db['k550'] == {'station': 'site 10', 'values': [550 % 13] * 20}
+    db.close()
+    session.close()
+
+
+def test_metrics(tmp_path, remote, caplog, capsys):
+    """
+
+    """
+    events = []
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='n', value_serializer='pickle', metrics=True, **remote)
+    db = session.open()
+    db.add_hook(events.append)
+    db['a'] = 1
+    db.sync()
+    assert db['a'] == 1
+    assert db.get('b') is None
+
+    stats = db.stats()
+    assert stats['counters']['get.local'] == 1
+    assert stats['counters']['get.missing'] == 1
+    assert any(event['op'] == 'local.write' for event in events)
+
+    ## A failing hook is logged and doesn't fail the operation
+    def bad_hook(event):
+        raise ValueError('bad hook')
+
+    db.add_hook(bad_hook)
+    with caplog.at_level(logging.ERROR, logger='s3dbm.utils'):
+        assert db['a'] == 1
+    assert 'bad_hook' in caplog.text
+    assert capsys.readouterr().out == ''
+
+    db.close()
+    session.close()
+
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='r', value_serializer='pickle', **remote)
+    db = session.open()
+    with pytest.raises(ValueError):
+        db.stats()
+    db.close()
+    session.close()
+
+
+def test_hedging_queue():
+    """
+    The first requests of the hedged calls don't wait for a thread, so many concurrent callers don't trigger hedges.
+    """
+    policy = utils.RetryPolicy(hedge_after=0.15, threads=48)
+
+    def request():
+        time.sleep(0.1)
+        return 1
+
+    with concurrent.futures.ThreadPoolExecutor(48) as executor:
+        results = list(executor.map(lambda i: policy.call(request), range(96)))
+
+    assert results == [1] * 96
+    assert policy.info()['hedges'] == 0
+
+
+def test_value_cache_size(tmp_path, remote):
+    """
+    The value cache is bounded by the decoded size of the values rather than their compressed size.
+    """
+    max_size = 2**18
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='n', value_serializer='pickle_zstd', value_cache_size=max_size, **remote)
+    db = session.open()
+    for i in range(20):
+        db[f'k{i}'] = {'i': i, 'data': 'x' * 50000}
+    db.sync()
+    assert len(db._local_data['k0']) < 1000
+
+    for i in range(20):
+        assert db[f'k{i}']['i'] == i
+
+    info = db.cache_info()
+    assert info['size'] <= max_size
+    assert info['n_values'] * 50000 <= info['size']
+    assert info['evictions'] >= 15
+    db.close()
+    session.close()
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu'])
+def test_value_cache_eviction(policy):
+    """
+    lru evicts the value that was read the longest time ago and lfu the value that was read the fewest times (the oldest of them on ties).
+    """
+    cache = utils.ValueCache(3, policy)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key, 1)
+    for _ in range(3):
+        assert cache.get('a') == 'a'
+    assert cache.get('b') == 'b'
+    assert cache.get('b') == 'b'
+    assert cache.get('c') == 'c'
+
+    cache.set('d', 'd', 1)
+    if policy == 'lru':
+        assert cache.get('a') is None
+        assert cache.get('c') == 'c'
+    else:
+        assert cache.get('c') is None
+        assert cache.get('a') == 'a'
+
+    ## A new value has the lowest frequency, so it's the next one out with lfu
+    cache.set('e', 'e', 1)
+    if policy == 'lfu':
+        assert cache.get('d') is None
+        assert cache.get('b') == 'b'
+
+    cache.invalidate('e')
+    info = cache.info()
+    assert info['evictions'] == 2
+    assert info['n_values'] == len(cache) == 2
+    assert info['size'] == 2
+
+    cache.set('big', 'big', 4)
+    assert cache.get('big') is None
+
+    with pytest.raises(ValueError):
+        utils.ValueCache(3, 'fifo')
+
+
+def test_update(tmp_path, remote):
+    """
+    update serializes the values in a pool of threads and writes them in the order of the keys. The input can be a dict or an iterator of key value tuples.
+    """
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='n', value_serializer='pickle_zstd', **remote)
+    db = session.open()
+    db.update({key: {'key': key} for key in keys[:4]}, threads=4, window=2)
+    db.update(((key, {'key': key}) for key in keys[4:]), threads=2)
+    db.update({'a/1': 1})
+
+    assert len(db) == len(keys)
+    assert list(db.keys()) == keys
+    assert db['a/1'] == 1
+    assert all(db[key] == {'key': key} for key in keys[1:])
+
+    with pytest.raises(ValueError):
+        db.update({'x': 1}, window=0)
+    with pytest.raises(utils.S3dbmSerializeError):
+        db.update({'x': lambda x: x})
+    session.close()
+
+    session = main.Session(tmp_path.joinpath('db.s3dbm'), flag='r', value_serializer='pickle_zstd', **remote)
+    db = session.open()
+    with pytest.raises(ValueError):
+        db.update({'x': 1})
+    db.close()
+    session.close()
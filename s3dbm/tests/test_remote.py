@@ -0,0 +1,915 @@
+import os
+import sys
+import logging
+import time
+import pathlib
+import concurrent.futures
+import multiprocessing
+import pytest
+import booklet
+import fake_s3
+from s3dbm import main, utils
+
+#################################################
+### Parameters
+
+n_keys = 60
+
+layouts = ['object', 'packed', 'content']
+
+################################################
+### Helpers
+
+
+def open_db(path, flag='c', **kwargs):
+    """
+
+    """
+    session = main.Session(path, flag=flag, **kwargs)
+
+    return session, session.open()
+
+
+def close_db(session, db):
+    """
+
+    """
+    db.close()
+    session.close()
+
+
+def make_value(i, value_serializer='pickle'):
+    if value_serializer == 'bytes':
+        return i.to_bytes(4, 'little') * (i % 7 + 1)
+
+    return {'i': i, 'data': list(range(i % 7 + 1))}
+
+
+def write_db(path, remote, layout='object', n=n_keys, value_serializer='pickle'):
+    """
+    Create a database with n keys and push it to the remote.
+    """
+    session, db = open_db(path, 'n', remote_layout=layout, value_serializer=value_serializer, **remote)
+    for i in range(n):
+        db[f'k{i:04}'] = make_value(i, value_serializer)
+    assert db.push()
+    close_db(session, db)
+
+
+def cache_then_delete(tmp_path, remote):
+    """
+    Read k0001 into the local cache of a reader, then delete it on a writer and push. Returns the path of the reader.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    r_path = tmp_path.joinpath('cached.s3dbm')
+    write_db(w_path, remote, n=10, value_serializer='bytes')
+
+    session, db = open_db(r_path, 'r', value_serializer='bytes', **remote)
+    assert db['k0001'] == make_value(1, 'bytes')
+    close_db(session, db)
+
+    session, db = open_db(w_path, 'w', value_serializer='bytes', **remote)
+    del db['k0001']
+    assert db.push()
+    close_db(session, db)
+
+    return r_path
+
+
+################################################
+### Tests
+
+
+@pytest.mark.parametrize('layout', layouts)
+def test_push_pull_round_trip(tmp_path, remote, remote_url, layout):
+    """
+
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, layout)
+
+    ## Read with the S3 api
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert len(db) == n_keys
+    assert db['k0005'] == make_value(5)
+    ## The value that was read is already in the local data
+    pulled = db.pull()
+    assert sorted(pulled) == [f'k{i:04}' for i in range(n_keys) if i != 5]
+    assert dict(db.items()) == {f'k{i:04}': make_value(i) for i in range(n_keys)}
+    assert db.pull() == []
+    close_db(session, db)
+
+    ## Read with the public url
+    session, db = open_db(tmp_path.joinpath('h.s3dbm'), 'r', remote_url=remote_url, value_serializer='pickle')
+    assert len(db) == n_keys
+    assert [db[f'k{i:04}'] for i in range(0, n_keys, 9)] == [make_value(i) for i in range(0, n_keys, 9)]
+    close_db(session, db)
+
+
+def test_pull_download_failures(tmp_path, remote, failing_gets):
+    """
+    The values that downloaded are written to the local data and the failures are raised.
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=10)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    failing_gets['denied'].add('k0004')
+    with pytest.raises(utils.S3dbmTransferError) as err:
+        db.pull()
+    assert list(err.value.failures) == ['k0004']
+    assert db['k0001'] == make_value(1)
+
+    failing_gets['denied'].clear()
+    assert db.pull() == ['k0004']
+    close_db(session, db)
+
+
+@pytest.mark.parametrize('layout', layouts)
+def test_push_changes(tmp_path, remote, layout):
+    """
+    Only the changed values are uploaded on the next push and deleted keys are removed from the remote.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    write_db(w_path, remote, layout)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    assert db.push() is False
+    db['k0001'] = 'changed'
+    db['new'] = 'new'
+    del db['k0002']
+    assert db.push()
+    assert len(db) == n_keys
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert len(db) == n_keys
+    assert db['k0001'] == 'changed'
+    assert db['new'] == 'new'
+    assert 'k0002' not in db
+    assert db['k0003'] == make_value(3)
+    close_db(session, db)
+
+
+def test_delete_remote_key(tmp_path, remote):
+    """
+    A remote key that is deleted on a writer is missing from every read until it's pushed, and it isn't downloaded again.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    write_db(w_path, remote, n=10)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    del db['k0001']
+    assert db.get('k0001') is None
+    assert 'k0001' not in db
+    with pytest.raises(KeyError):
+        db['k0001']
+    with pytest.raises(KeyError):
+        db.get_view('k0001')
+    with pytest.raises(KeyError):
+        db.open_stream('k0001')
+    with pytest.raises(KeyError):
+        del db['k0001']
+    with pytest.raises(KeyError):
+        del db['missing']
+    assert 'k0001' not in db.pull()
+    assert [key for key, value in db.items(['k0001', 'k0002'])] == ['k0002']
+    assert len(db) == 9
+
+    ## A deleted key that is set again is uploaded rather than deleted
+    del db['k0002']
+    db['k0002'] = 'again'
+    assert db.push()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert 'k0001' not in db
+    assert db.get('k0001') is None
+    assert db['k0002'] == 'again'
+    assert len(db) == 9
+    close_db(session, db)
+
+
+class AlwaysIn:
+    """
+    A bloom filter that only has false positives.
+    """
+    def __contains__(self, key):
+        return True
+
+
+def test_bloom_false_positive(tmp_path, remote):
+    """
+    A false positive of the bloom filter on a reader doesn't make the cached copy of a key deleted from the remote readable.
+    """
+    r_path = cache_then_delete(tmp_path, remote)
+
+    session, db = open_db(r_path, 'r', value_serializer='bytes', **remote)
+    db._remote_bloom = AlwaysIn()
+    assert db.get('k0001') is None
+    assert 'k0001' not in db
+    assert [key for key, value in db.items(['k0001', 'k0002'])] == ['k0002']
+    assert db['k0002'] == make_value(2, 'bytes')
+    close_db(session, db)
+
+    ## A writer still reads its local-only keys
+    session, db = open_db(tmp_path.joinpath('w.s3dbm'), 'w', value_serializer='bytes', **remote)
+    db._remote_bloom = AlwaysIn()
+    db['local'] = b'local'
+    db.sync()
+    assert db['local'] == b'local'
+    assert 'local' in db
+    close_db(session, db)
+
+
+def test_content_index(tmp_path, remote, s3_server, monkeypatch):
+    """
+    The content layout shares the objects of equal values and deletes them when no key references them. The content index is updated by each push rather than rebuilt from the remote keys.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    content_prefix = remote['remote_db_key'] + '.content/'
+
+    session, db = open_db(w_path, 'n', remote_layout='content', value_serializer='pickle', **remote)
+    for i in range(10):
+        db[f'k{i}'] = i % 2
+    assert db.push()
+    close_db(session, db)
+    assert len(s3_server.store.list(remote['bucket'], content_prefix)) == 2
+
+    def no_scan(remote_keys):
+        raise AssertionError('The content index was rebuilt.')
+
+    monkeypatch.setattr(utils, 'count_content_hashes', no_scan)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    for i in range(0, 10, 2):
+        del db[f'k{i}']
+    db['k1'] = 'new'
+    assert db.push()
+    close_db(session, db)
+
+    with booklet.FixedValue(session._remote_keys_path) as remote_keys:
+        content_hash = remote_keys['k3'][utils.header_len:]
+    content_index = utils.ContentIndex(utils.make_content_index_path(session._remote_keys_path))
+    assert len(content_index) == 2
+    assert content_index.count(content_hash) == 4
+    content_index.close()
+    assert len(s3_server.store.list(remote['bucket'], content_prefix)) == 2
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert dict(db.items()) == {'k1': 'new', 'k3': 1, 'k5': 1, 'k7': 1, 'k9': 1}
+    close_db(session, db)
+
+
+@pytest.fixture
+def failing_puts(monkeypatch):
+    """
+    Make the uploads of the objects with these names fail.
+    """
+    names = set()
+    do_put = fake_s3.Handler.do_PUT
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        if key.rsplit('/', 1)[-1] in names:
+            self._read_body()
+            self._send_error(403, 'AccessDenied', 'denied')
+            return
+
+        return do_put(self)
+
+    monkeypatch.setattr(fake_s3.Handler, 'do_PUT', do_PUT)
+
+    return names
+
+
+def test_push_upload_failures(tmp_path, remote, failing_puts):
+    """
+    The values that uploaded are committed and the failures are raised. The failed values are pushed again on the next push.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    session, db = open_db(w_path, 'n', value_serializer='pickle', **remote)
+    for i in range(10):
+        db[f'k{i:04}'] = make_value(i)
+    failing_puts.add('k0003')
+    with pytest.raises(utils.S3dbmTransferError) as err:
+        db.push()
+    assert list(err.value.failures) == ['k0003']
+    assert len(db) == 10
+    assert list(db.keys())[3] == 'k0003'
+
+    r_session, r_db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert len(r_db) == 9
+    assert 'k0003' not in r_db
+    close_db(r_session, r_db)
+
+    failing_puts.clear()
+    assert db.push()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r2.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert len(db) == 10
+    assert db['k0003'] == make_value(3)
+    close_db(session, db)
+
+
+def test_missing_key(tmp_path, remote):
+    """
+    A missing key raises a KeyError rather than closing the database.
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    with pytest.raises(KeyError):
+        db['missing']
+    with pytest.raises(utils.S3dbmKeyError):
+        db['missing']
+    with pytest.raises(KeyError):
+        db.get_view('missing')
+    assert db.get('missing') is None
+    assert 'missing' not in db
+    assert db.pop('missing', 1) == 1
+    assert db['k0001'] == make_value(1)
+    close_db(session, db)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_items_window(tmp_path, remote, ordered):
+    """
+    The values are prefetched at most window keys ahead of the consumer. Unordered items are yielded as they're available, ordered items in the order of the keys. Missing keys are skipped.
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=30)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    ## Some of the values are already in the local data
+    for i in range(0, 30, 3):
+        db[f'k{i:04}']
+
+    window = 4
+    state = {'pulled': 0, 'ahead': 0}
+
+    def gen_keys():
+        for i in range(31):
+            state['pulled'] += 1
+            yield f'k{i:04}'
+
+    items = []
+    for key, value in db.items(gen_keys(), window=window, ordered=ordered):
+        items.append((key, value))
+        state['ahead'] = max(state['ahead'], state['pulled'] - len(items))
+
+    assert state['ahead'] <= window
+    expected = [(f'k{i:04}', make_value(i)) for i in range(30)]
+    if ordered:
+        assert items == expected
+    else:
+        assert sorted(items, key=lambda x: x[0]) == expected
+    assert sorted(db.values(window=1, ordered=ordered), key=lambda x: x['i']) == [value for _, value in expected]
+
+    with pytest.raises(ValueError):
+        list(db.items(window=0))
+    close_db(session, db)
+
+
+@pytest.mark.parametrize('access', ['s3', 'http'])
+def test_conditional_metadata_get(tmp_path, remote, remote_url, access, monkeypatch):
+    """
+    A reader that already has the current metadata only gets a 304 for it (If-None-Match with the ETag) and doesn't download the remote keys again. Once the remote changes, the new metadata is downloaded.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    r_path = tmp_path.joinpath('r.s3dbm')
+    write_db(w_path, remote, n=10)
+    if access == 's3':
+        kwargs = remote
+    else:
+        kwargs = {'remote_url': remote_url}
+
+    responses = []
+    send = fake_s3.Handler._send
+
+    def _send(self, status, body=b'', headers={}):
+        if self.command == 'GET':
+            responses.append((self.path.split('?')[0].rsplit('/', 1)[-1], status))
+        return send(self, status, body, headers)
+
+    monkeypatch.setattr(fake_s3.Handler, '_send', _send)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **kwargs)
+    close_db(session, db)
+    assert ('db.s3dbm', 200) in responses
+    assert ('db.s3dbm.remote_keys', 200) in responses
+
+    responses.clear()
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **kwargs)
+    assert db['k0001'] == make_value(1)
+    close_db(session, db)
+    assert ('db.s3dbm', 304) in responses
+    assert not any(name.startswith('db.s3dbm.') for name, _ in responses)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    db['k0001'] = 1
+    assert db.push()
+    close_db(session, db)
+
+    responses.clear()
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **kwargs)
+    assert db['k0001'] == 1
+    close_db(session, db)
+    assert ('db.s3dbm', 200) in responses
+
+
+def test_lazy_session(tmp_path, remote, caplog):
+    """
+    A lazy reader opens from its local copy without waiting for the remote and checks the remote in the background. stale says whether the remote has changed since, or None if it couldn't be checked.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    r_path = tmp_path.joinpath('r.s3dbm')
+    write_db(w_path, remote, n=10)
+
+    with pytest.raises(ValueError):
+        main.Session(tmp_path.joinpath('lazy.s3dbm'), flag='w', lazy=True, **remote)
+
+    ## Without a local copy it's opened normally
+    session, db = open_db(r_path, 'r', value_serializer='pickle', lazy=True, **remote)
+    assert session._remote_check is None
+    assert session.stale is False
+    assert db['k0001'] == make_value(1)
+    close_db(session, db)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', lazy=True, **remote)
+    assert session._remote_check is not None
+    assert session.stale is False
+    assert db['k0002'] == make_value(2)
+    close_db(session, db)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    db['k0001'] = 1
+    assert db.push()
+    close_db(session, db)
+
+    ## The local copy is used until the session is opened without lazy
+    session, db = open_db(r_path, 'r', value_serializer='pickle', lazy=True, **remote)
+    assert session.stale is True
+    assert db['k0001'] == make_value(1)
+    close_db(session, db)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **remote)
+    assert session.stale is False
+    assert db['k0001'] == 1
+    close_db(session, db)
+
+    bad_remote = dict(remote, connection_config=dict(remote['connection_config'], endpoint_url='http://127.0.0.1:1'))
+    session, db = open_db(r_path, 'r', value_serializer='pickle', lazy=True, **bad_remote)
+    with caplog.at_level(logging.WARNING, logger='s3dbm.main'):
+        assert session.stale is None
+    assert 'The remote check failed' in caplog.text
+    close_db(session, db)
+
+
+def test_journal_incremental_sync(tmp_path, remote):
+    """
+    A reader that already has the remote keys file only applies the journal segments that it's missing.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    r_path = tmp_path.joinpath('r.s3dbm')
+    write_db(w_path, remote, n=200)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **remote)
+    assert len(db) == 200
+    assert session._journal_changes is None
+    close_db(session, db)
+
+    for j in range(2):
+        session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+        for i in range(5):
+            db[f'j{j}_{i}'] = i
+        del db[f'k{j:04}']
+        db.push()
+        close_db(session, db)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **remote)
+    _, set_keys, delete_keys = session._journal_changes
+    assert sorted(set_keys) == sorted(f'j{j}_{i}' for j in range(2) for i in range(5))
+    assert sorted(delete_keys) == ['k0000', 'k0001']
+    assert len(db) == 208
+    assert db['j1_3'] == 3
+    assert 'k0001' not in db
+    assert sorted(db.keys(prefix='j0_')) == [f'j0_{i}' for i in range(5)]
+    close_db(session, db)
+
+    ## The local remote keys file must match a full download
+    with booklet.FixedValue(session._remote_keys_path) as rk:
+        journaled = dict(rk.items())
+    session, db = open_db(tmp_path.joinpath('r2.s3dbm'), 'r', value_serializer='pickle', **remote)
+    with booklet.FixedValue(session._remote_keys_path) as rk:
+        assert dict(rk.items()) == journaled
+    close_db(session, db)
+
+
+def test_journal_falls_back_to_full_download(tmp_path, remote):
+    """
+
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    r_path = tmp_path.joinpath('r.s3dbm')
+    write_db(w_path, remote, n=10)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **remote)
+    close_db(session, db)
+
+    ## More changes than the journal_max_changes_ratio of the keys
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    for i in range(20):
+        db[f'new{i}'] = i
+    db.push()
+    close_db(session, db)
+
+    session, db = open_db(r_path, 'r', value_serializer='pickle', **remote)
+    assert session._journal_changes is None
+    assert len(db) == 30
+    assert db['new19'] == 19
+    close_db(session, db)
+
+
+def test_zstd_dicts_are_remote_objects(tmp_path, remote, s3_server):
+    """
+    The trained dictionaries are their own remote objects, so retraining doesn't make the metadata bigger. Readers download a dictionary when they first read a value that uses it.
+    """
+    def make_zstd_value(i):
+        return {'station': f'site {i % 20}', 'values': [i % 13] * 20}
+
+    w_path = tmp_path.joinpath('w.s3dbm')
+    session, db = open_db(w_path, 'n', value_serializer='pickle_zstd', **remote)
+    for i in range(300):
+        db[f'k{i:04}'] = make_zstd_value(i)
+    db.push()
+    meta_size = len(utils.write_metadata(session._local_meta_path, session._meta))
+
+    dict_ids = []
+    for j in range(4):
+        dict_ids.append(db.train_zstd_dict(dict_size=2**12))
+        for i in range(300 + j * 100, 400 + j * 100):
+            db[f'k{i:04}'] = make_zstd_value(i)
+        db.push()
+
+    assert session._meta['zstd_dict_ids'] == dict_ids
+    assert 'zstd_dicts_pending' not in session._meta
+    assert len(utils.write_metadata(session._local_meta_path, session._meta)) < meta_size + 200
+    close_db(session, db)
+
+    dicts_prefix = str(pathlib.PurePosixPath(remote['remote_db_key']).parent.joinpath(session._remote_db_name + '.zstd_dicts/'))
+    assert len(s3_server.store.list(remote['bucket'], dicts_prefix)) == 4
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle_zstd', **remote)
+    assert db['k0350'] == make_zstd_value(350)
+    assert [path.name for path in session._zstd_dicts_path.iterdir()] == [str(dict_ids[0])]
+    assert dict(db.items()) == {f'k{i:04}': make_zstd_value(i) for i in range(700)}
+    assert len(list(session._zstd_dicts_path.iterdir())) == 4
+    close_db(session, db)
+
+
+def test_changelog_fast_path_matches_slow_path(tmp_path, remote):
+    """
+    The numpy changelog from the header scans must be the same as the one from the key by key comparisons.
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    write_db(w_path, remote, n=500, value_serializer='bytes')
+
+    session, db = open_db(w_path, 'w', value_serializer='bytes', **remote)
+    time.sleep(0.01)
+    for i in range(0, 500, 7):
+        db[f'k{i:04}'] = b'changed'
+    for i in range(30):
+        db[f'new{i}'] = b'new'
+    db.sync()
+
+    slow_path = utils.create_changelog(db._local_data, db._remote_keys, session._local_meta_path, session._n_buckets)
+    with booklet.FixedValue(slow_path) as f:
+        slow = dict(f.items())
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        fast_path = utils.create_changelog(db._local_data, db._remote_keys, session._local_meta_path, session._n_buckets, session._local_data_path, session._remote_keys_path, executor)
+    with booklet.FixedValue(fast_path) as f:
+        fast = dict(f.items())
+
+    assert len(slow) == len(range(0, 500, 7)) + 30
+    assert fast == slow
+    close_db(session, db)
+
+
+def test_headers(tmp_path, remote):
+    """
+
+    """
+    np = pytest.importorskip('numpy')
+
+    w_path = tmp_path.joinpath('w.s3dbm')
+    write_db(w_path, remote, 'packed', n=20, value_serializer='bytes')
+
+    session, db = open_db(w_path, 'r', value_serializer='bytes', **remote)
+    local = np.sort(db.headers(), order='key')
+    remote_headers = np.sort(db.headers(remote=True), order='key')
+    assert len(local) == len(remote_headers) == 20
+    assert (local['md5'] == remote_headers['md5']).all()
+    assert (local['timestamp'] == remote_headers['timestamp']).all()
+    assert {'pack_id', 'offset', 'length'}.issubset(remote_headers.dtype.names)
+    close_db(session, db)
+
+    with pytest.raises(utils.S3dbmValueError):
+        utils.check_header_version({'header_version': utils.header_version + 1})
+
+
+def test_without_numpy(tmp_path, remote, monkeypatch):
+    """
+    numpy is optional. Without it the changelog is made key by key and headers raises an ImportError that names the numpy extra.
+    """
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+
+    w_path = tmp_path.joinpath('w.s3dbm')
+    write_db(w_path, remote, n=20)
+
+    session, db = open_db(w_path, 'w', value_serializer='pickle', **remote)
+    db['k0001'] = 'changed'
+    assert db.push()
+    with pytest.raises(ImportError, match='s3dbm\\[numpy\\]'):
+        db.headers()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', **remote)
+    assert db['k0001'] == 'changed'
+    assert len(db) == 20
+    close_db(session, db)
+
+
+def test_get_view(tmp_path, remote):
+    """
+
+    """
+    w_path = tmp_path.joinpath('w.s3dbm')
+    session, db = open_db(w_path, 'n', value_serializer='bytes', **remote)
+    db['a'] = b'abc' * 100
+    db.push()
+    view = db.get_view('a')
+    assert isinstance(view, memoryview)
+    assert view.readonly
+    assert bytes(view) == b'abc' * 100
+    close_db(session, db)
+
+    ## Missing locally, so it's downloaded first
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='bytes', **remote)
+    assert bytes(db.get_view('a')) == b'abc' * 100
+    close_db(session, db)
+
+
+def test_get_view_remote_delete(tmp_path, remote):
+    """
+    A reader doesn't hand out a view of the cached copy of a key that has been deleted from the remote.
+    """
+    r_path = cache_then_delete(tmp_path, remote)
+
+    session, db = open_db(r_path, 'r', value_serializer='bytes', **remote)
+    with pytest.raises(KeyError):
+        db.get_view('k0001')
+    assert bytes(db.get_view('k0002')) == make_value(2, 'bytes')
+    close_db(session, db)
+
+
+def test_open_stream(tmp_path, remote):
+    """
+    A value that is missing locally is streamed from the remote.
+    """
+    value = os.urandom(10000)
+    session, db = open_db(tmp_path.joinpath('w.s3dbm'), 'n', value_serializer='bytes', **remote)
+    db['a'] = value
+    db.push()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='bytes', **remote)
+    with db.open_stream('a') as f:
+        assert f.read(100) == value[:100]
+        assert f.read() == value[100:]
+    with db.open_stream('a') as f:
+        assert f.read() == value
+    close_db(session, db)
+
+
+def test_open_stream_cache_limit(tmp_path, remote, monkeypatch):
+    """
+    Streamed values are only saved to the local data if they are no larger than stream_max_cache_bytes.
+    """
+    monkeypatch.setattr(utils, 'stream_max_cache_bytes', 5000)
+    small = os.urandom(1000)
+    large = os.urandom(10000)
+    session, db = open_db(tmp_path.joinpath('w.s3dbm'), 'n', value_serializer='bytes', **remote)
+    db['small'] = small
+    db['large'] = large
+    db.push()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='bytes', **remote)
+    with db.open_stream('small') as f:
+        assert f.read() == small
+    with db.open_stream('large') as f:
+        assert f.read() == large
+    db.sync()
+    assert 'small' in db._local_data
+    assert 'large' not in db._local_data
+    close_db(session, db)
+
+
+def test_open_stream_remote_delete(tmp_path, remote):
+    """
+    The cached copy of a key that has been deleted from the remote isn't streamed by a reader.
+    """
+    r_path = cache_then_delete(tmp_path, remote)
+
+    session, db = open_db(r_path, 'r', value_serializer='bytes', **remote)
+    assert 'k0001' not in db
+    with pytest.raises(KeyError):
+        db.open_stream('k0001')
+    with db.open_stream('k0002') as f:
+        assert f.read() == make_value(2, 'bytes')
+    close_db(session, db)
+
+
+def test_get_range(tmp_path, remote):
+    """
+    Byte ranges of a value that is missing locally are read from the remote.
+    """
+    value = os.urandom(10000)
+    session, db = open_db(tmp_path.joinpath('w.s3dbm'), 'n', value_serializer='bytes', **remote)
+    db['a'] = value
+    db.push()
+    close_db(session, db)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='bytes', **remote)
+    assert db.get_range('a', 100, 50) == value[100:150]
+    assert db.get_range('a', 9990, 50) == value[9990:]
+    assert db.get_range('a', 100, 50) == value[100:150]
+    close_db(session, db)
+
+
+def test_get_range_remote_delete(tmp_path, remote):
+    """
+    Byte ranges of the cached copy of a key that has been deleted from the remote aren't returned by a reader.
+    """
+    r_path = cache_then_delete(tmp_path, remote)
+
+    session, db = open_db(r_path, 'r', value_serializer='bytes', **remote)
+    with pytest.raises(KeyError):
+        db.get_range('k0001', 0, 2)
+    assert db.get_range('k0002', 0, 2) == make_value(2, 'bytes')[:2]
+    close_db(session, db)
+
+
+def test_value_cache(tmp_path, remote):
+    """
+
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=10)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', value_serializer='pickle', value_cache_size=2**20, **remote)
+    for _ in range(3):
+        assert db['k0001'] == make_value(1)
+    info = db.cache_info()
+    assert info['hits'] == 2
+    assert info['misses'] == 1
+    close_db(session, db)
+
+
+@pytest.fixture
+def failing_gets(monkeypatch):
+    """
+    Make the GETs of the values fail with a 503 or respond slowly. The GETs of the denied values always fail with a 403.
+    """
+    state = {'fails': 0, 'slow': 0, 'denied': set()}
+    do_get = fake_s3.Handler.do_GET
+
+    def do_GET(self):
+        name = self.path.split('?')[0].rsplit('/', 1)[-1]
+        if name in state['denied']:
+            self._send_error(403, 'AccessDenied', 'denied')
+            return
+        if name.startswith('k'):
+            if state['fails'] > 0:
+                state['fails'] -= 1
+                body = b'{"status": 503, "code": "service_unavailable", "message": "busy"}'
+                self.send_response(503)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if state['slow'] > 0:
+                state['slow'] -= 1
+                time.sleep(1)
+
+        return do_get(self)
+
+    monkeypatch.setattr(fake_s3.Handler, 'do_GET', do_GET)
+
+    return state
+
+
+def test_retries(tmp_path, remote, remote_url, failing_gets):
+    """
+
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=10)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', remote_url=remote_url, value_serializer='pickle', retry_backoff=0.01)
+    failing_gets['fails'] = 2
+    assert db['k0001'] == make_value(1)
+    assert session._retry_policy.info()['retries'] == 2
+
+    failing_gets['fails'] = 100
+    with pytest.raises(utils.S3dbmHttpError) as err:
+        db['k0002']
+    assert err.value.status == 503
+    failing_gets['fails'] = 0
+    close_db(session, db)
+
+
+def test_hedging(tmp_path, remote, remote_url, failing_gets):
+    """
+
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=10)
+
+    session, db = open_db(tmp_path.joinpath('r.s3dbm'), 'r', remote_url=remote_url, value_serializer='pickle', hedge_after=0.1)
+    failing_gets['slow'] = 1
+    start = time.perf_counter()
+    assert db['k0003'] == make_value(3)
+    assert time.perf_counter() - start < 0.9
+    info = session._retry_policy.info()
+    assert info['hedges'] == 1
+    assert info['hedge_wins'] == 1
+    close_db(session, db)
+
+
+def read_shared(args):
+    """
+    Read all of the values with a shared session in another process.
+    """
+    path, remote = args
+    utils.shared_handoff_bytes = 1000
+    session, db = open_db(pathlib.Path(path), 'r', value_serializer='pickle', shared=True, **remote)
+    values = {key: db[key] for key in sorted(db.keys())}
+    close_db(session, db)
+
+    return values
+
+
+def test_shared_sessions(tmp_path, remote):
+    """
+    Several processes read the same local cache and the downloaded values are handed off to the local data file.
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote)
+    path = tmp_path.joinpath('shared.s3dbm')
+    expected = {f'k{i:04}': make_value(i) for i in range(n_keys)}
+
+    with multiprocessing.get_context('spawn').Pool(3) as pool:
+        results = pool.map(read_shared, [(str(path), remote)] * 3)
+
+    assert all(values == expected for values in results)
+
+    with booklet.VariableValue(str(path) + '.data') as f:
+        assert len(list(f.keys())) == n_keys
+
+    with pytest.raises(ValueError):
+        main.Session(path, flag='w', shared=True, **remote)
+
+
+def test_remote_pools(tmp_path, remote, s3_server):
+    """
+    The sessions of the same endpoint and credentials share one client (and connection pool), which is only recreated when more connections are needed.
+    """
+    write_db(tmp_path.joinpath('w.s3dbm'), remote, n=10)
+
+    session1, db1 = open_db(tmp_path.joinpath('r1.s3dbm'), 'r', value_serializer='pickle', threads=4, **remote)
+    session2, db2 = open_db(tmp_path.joinpath('r2.s3dbm'), 'r', value_serializer='pickle', threads=4, **remote)
+    assert db1['k0001'] == db2['k0001'] == make_value(1)
+    assert db1._s3_session is not db2._s3_session
+    assert db1._s3_session._client is db2._s3_session._client
+    assert db1._s3_session._stream
+    close_db(session1, db1)
+    close_db(session2, db2)
+
+    pools = utils.RemotePools()
+    config = s3_server.connection_config()
+    s1 = pools.get_session('s3', config, 'b1', 4, 60, False)
+    s2 = pools.get_session('s3', config, 'b2', 2, 60, True)
+    assert s1._client is s2._client
+    assert (s1.bucket, s1._stream, s2.bucket, s2._stream) == ('b1', False, 'b2', True)
+    assert pools.info() == [{'kind': 's3', 'endpoint_url': s3_server.endpoint_url, 'max_connections': 4}]
+
+    s3 = pools.get_session('s3', config, 'b1', 8, 60, False)
+    assert s3._client is not s1._client
+    assert pools.info()[0]['max_connections'] == 8
+
+    other = pools.get_session('s3', dict(config, aws_secret_access_key='other'), 'b1', 4, 60, False)
+    assert other._client is not s3._client
+    h1 = pools.get_session('http', None, None, 4, 60, True)
+    h2 = pools.get_session('http', None, None, 4, 60, False)
+    assert h1._session is h2._session
+    assert len(pools.info()) == 3
+
+    pools.clear()
+    assert pools.info() == []
@@ -7,19 +7,30 @@ Created on Thu Jan  5 11:04:13 2023
 """
 # import os
 import io
-from pydantic import BaseModel, HttpUrl
 import pathlib
 import copy
 # from time import sleep
 import hashlib
 import booklet
 import orjson
-import portalocker
-from s3func import S3Session, HttpSession, s3
-import urllib3
 import shutil
 from datetime import datetime, timezone
 import zstandard as zstd
+import concurrent.futures
+import threading
+import collections
+import itertools
+import os
+import mmap
+import bisect
+import heapq
+import struct
+import math
+import time
+import random
+from array import array
+import logging
+import sys
 # from collections.abc import Mapping, MutableMapping
 # from __init__ import __version__ as version
 
@@ -28,10 +39,91 @@ import zstandard as zstd
 
 version = '0.1.0'
 
+logger = logging.getLogger(__name__)
+
 default_n_buckets = 10003
 
 blt_files = ('_local_data', '_remote_keys')
 
+## Returned when a key doesn't exist as None can be a valid value
+missing = object()
+
+## Bloom filter of the remote keys: magic, number of hashes, number of bits, and number of keys
+bloom_magic = b'S3DBMBF'
+bloom_header = struct.Struct('<7sBQQ')
+bloom_error_rate = 0.01
+
+## Journal of the changes to the remote keys. Readers that are further behind than these limits download the whole remote keys file.
+journal_max_segments = 100
+journal_max_changes_ratio = 0.5
+
+## Sorted key index: magic, dirty flag, remote keys file size and mtime, number of keys, and length of the keys block
+key_index_magic = b'S3DBMKI'
+key_index_header = struct.Struct('<7sBQQQQ')
+key_index_header_len = key_index_header.size
+
+## Value headers: microsecond timestamp followed by the md5 of the value. The size of the value isn't in the header as booklet stores it, and the remote layouts are told apart by the length of the remote keys values. The header version is saved in the metadata so that readers can refuse headers they don't know.
+header_version = 1
+ts_len = 7
+md5_len = 16
+header_len = ts_len + md5_len
+
+## Packed remote layout: the remote keys values also hold the pack id (a microsecond timestamp), and the offset and length of the value in the pack
+remote_layouts = ('object', 'packed', 'content')
+pack_pos_len = 6
+packed_value_len = header_len + ts_len + pack_pos_len * 2
+pack_max_size = 2**26
+pack_max_merge_gap = 2**12
+pack_max_request_size = 2**24
+
+## Content remote layout: the remote keys values also hold the blake2b hash of the value, which is the name of the remote object
+content_hash_len = 16
+content_value_len = header_len + content_hash_len
+
+## Content hash index of the content layout: magic, remote keys file size and mtime, and number of hashes. The sorted hashes follow with the number of keys that reference each.
+content_index_magic = b'S3DBMCI'
+content_index_header = struct.Struct('<7sQQQ')
+content_index_header_len = content_index_header.size
+content_index_count_len = 4
+content_index_record_len = content_hash_len + content_index_count_len
+
+## Trained zstd dictionaries. Only the ids of the dictionaries are in the metadata (which is read on every open). The dictionaries are their own remote objects next to the db, which are downloaded and saved locally when a value that was compressed with one is first read.
+zstd_level = 1
+default_zstd_dict_size = 2**16
+default_zstd_dict_samples = 2000
+
+## Values at least this big (before compression) are compressed with zstd's multithreaded mode
+zstd_mt_min_size = 2**22
+
+## Metrics latency histograms: bucket i counts the operations that took less than 2**i microseconds
+metrics_n_buckets = 28
+metrics_percentiles = (50, 90, 99)
+
+## Streamed values larger than this aren't saved to the local data. booklet writes a value from a single bytes object (and copies it), so a value that is saved is held in memory a few times over while it's written.
+stream_max_cache_bytes = 2**26
+
+## Retries of the remote reads. 429 and the 5xx statuses are retried with exponential backoff and full jitter.
+default_retries = 5
+default_retry_backoff = 0.1
+retry_backoff_max = 10
+retry_statuses = (429, 500, 502, 503, 504)
+
+## Hedged requests: with hedge_after='p95', a duplicate request is sent if the first hasn't finished by the p95 of the recent request latencies
+hedge_n_latencies = 1000
+hedge_min_latencies = 50
+hedge_quantile = 0.95
+
+## The remote clients and their connection pools are shared by all of the sessions and databases of the process that use the same endpoint and credentials. A pool grows to the concurrency of its largest user up to pool_max_connections. pool_keepalive turns on tcp keep-alive so that idle pooled connections (and their TLS sessions) aren't dropped by the network.
+pool_max_connections = 128
+pool_keepalive = True
+
+## Unread bodies up to this size are drained so that the connection can go back to the pool; larger ones close the connection
+pool_max_drain_bytes = 2**16
+
+## Shared sessions let many processes read the same local cache. The values they download are kept in memory and handed off to the local data file by whichever process gets the coordinator lock. A handoff is attempted once shared_handoff_bytes have been downloaded and it waits for the lock once shared_max_pending_bytes have been downloaded.
+shared_handoff_bytes = 2**22
+shared_max_pending_bytes = 2**26
+
 ############################################
 ### Exception classes
 
@@ -57,343 +149,3563 @@ class S3dbmValueError(BaseError):
 class S3dbmTypeError(BaseError):
     pass
 
-class S3dbmKeyError(BaseError):
+class S3dbmKeyError(BaseError, KeyError):
     pass
 
 class S3dbmHttpError(BaseError):
-    pass
+    def __init__(self, message, objs=[], status=None, *args):
+        self.status = status
+        super().__init__(message, objs, *args)
 
 class S3dbmSerializeError(BaseError):
     pass
 
+class S3dbmTransferError(BaseError):
+    def __init__(self, message, objs=[], failures=None, *args):
+        self.failures = failures if failures is not None else {}
+        super().__init__(message, objs, *args)
+
 
 ############################################
-### Functions
+### Classes
 
 
-def bytes_to_int(b, signed=False):
+class ByteLimiter:
     """
-    Remember for a single byte, I only need to do b[0] to get the int. And it's really fast as compared to the function here. This is only needed for bytes > 1.
+    A semaphore that counts bytes rather than slots. It caps the number of bytes held in memory across threads. An acquire larger than max_bytes is reduced to max_bytes so that a single large value can still proceed on its own.
     """
-    return int.from_bytes(b, 'little', signed=signed)
+    def __init__(self, max_bytes: int):
+        """
 
+        """
+        self._max_bytes = max_bytes
+        self._available = max_bytes
+        self._cond = threading.Condition()
 
-def int_to_bytes(i, byte_len, signed=False):
-    """
+    def acquire(self, n_bytes: int):
+        """
+        Blocks until n_bytes are available. Returns the number of bytes acquired, which must be passed to release.
+        """
+        n_bytes = min(n_bytes, self._max_bytes)
+        with self._cond:
+            while self._available < n_bytes:
+                self._cond.wait()
+            self._available -= n_bytes
 
-    """
-    return i.to_bytes(byte_len, 'little', signed=signed)
+        return n_bytes
 
+    def release(self, n_bytes: int):
+        """
 
-def make_timestamp(value=None):
+        """
+        with self._cond:
+            self._available += n_bytes
+            self._cond.notify_all()
+
+
+class ValueStream(io.RawIOBase):
     """
-    Milliseconds should have at least 6 bytes for storage, while microseconds should have 7 bytes.
+    A read-only file-like object over the body of a remote value. The body is read in chunks and the md5 is computed incrementally. If cache, then the chunks are also copied into a single preallocated buffer, and once the body has been fully read the buffer (with the header written at the front) is saved to the local data. booklet copies the value while it's written, so a cached value is held in memory about three times at the end. Values larger than stream_max_cache_bytes are therefore never cached and only a chunk at a time is held in memory. If the stream is closed before the body has been fully read, then nothing is saved to the local data.
     """
-    if value is None:
-        value = datetime.now(timezone.utc)
+    def __init__(self, resp, key, local_data, mod_time_int, cache=True):
+        """
 
-    int_us = int(value.timestamp() * 1000000)
+        """
+        size = resp.metadata.get('content_length')
 
-    return int_us
+        if (size is not None) and (size > stream_max_cache_bytes):
+            cache = False
 
+        if cache:
+            if size is None:
+                buffer = bytearray(header_len)
+            else:
+                buffer = bytearray(header_len + size)
+        else:
+            buffer = None
+
+        self._resp = resp
+        self._key = key
+        self._local_data = local_data
+        self._mod_time_int = mod_time_int
+        self._size = size
+        self._pos = 0
+        self._md5 = hashlib.md5()
+        self._buffer = buffer
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        """
+
+        """
+        if self._finished:
+            return 0
+
+        chunk = self._resp.stream.read(len(b))
+        n_chunk = len(chunk)
+        if n_chunk == 0:
+            self._finish()
+            return 0
+
+        b[:n_chunk] = chunk
+        self._md5.update(chunk)
+        if self._buffer is not None:
+            if (self._pos + n_chunk) > stream_max_cache_bytes:
+                ## The size wasn't known up front
+                self._buffer = None
+            else:
+                start = header_len + self._pos
+                self._buffer[start:start + n_chunk] = chunk
+        self._pos += n_chunk
 
-def close_files(local_data, remote_keys):
-    """
+        return n_chunk
 
-    """
-    local_data.close()
-    if remote_keys:
-        remote_keys.close()
+    def _finish(self):
+        """
 
+        """
+        self._finished = True
+        release_stream(self._resp)
 
-def init_remote_config(flag, bucket, connection_config, remote_url, threads, read_timeout):
+        buffer = self._buffer
+        self._buffer = None
+        if buffer is not None:
+            if (self._size is None) or (self._pos == self._size):
+                buffer[:header_len] = int_to_bytes(self._mod_time_int, ts_len) + self._md5.digest()
+                self._local_data[self._key] = buffer
+
+    def close(self):
+        """
+
+        """
+        if not self.closed:
+            if not self._finished:
+                ## The body hasn't been fully read, so the connection can't be reused
+                self._finished = True
+                self._buffer = None
+                self._resp.stream.close()
+        super().close()
+
+
+def estimate_value_size(value, value_bytes):
     """
+    Estimate the memory used by a decoded value for the value cache. Arrays and bytes have an exact size. Other objects are estimated by the size of their uncompressed serialized bytes (read from the zstd frame header for the zstd serializers), as getsizeof only counts the outer object of a container.
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+
+    size = len(value_bytes)
+    if value_bytes[:4] == zstd.FRAME_HEADER:
+        content_size = zstd.get_frame_parameters(value_bytes).content_size
+        if content_size < zstd.CONTENTSIZE_ERROR:
+            size = content_size
 
+    return max(size, sys.getsizeof(value))
+
+
+class ValueCache:
     """
-    http_session = None
-    s3_session = None
-    remote_s3_access = False
-    remote_http_access = False
-    remote_base_url = None
-    host_url = None
+    An in-memory cache of the decoded values bounded by the estimated byte size of the values (see estimate_value_size). When the cache is full, either the least recently used (lru) or the least frequently used (lfu) values are evicted first. Both policies are O(1) per operation.
+    """
+    def __init__(self, max_size: int, policy: str='lru'):
+        """
+
+        """
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be either 'lru' or 'lfu'.")
+
+        self._max_size = max_size
+        self._policy = policy
+        self._items = {}
+        self._order = collections.OrderedDict()
+        self._freqs = collections.defaultdict(collections.OrderedDict)
+        self._min_freq = 1
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            if self._policy == 'lru':
+                self._order.move_to_end(key)
+            else:
+                freq = item[2]
+                bucket = self._freqs[freq]
+                del bucket[key]
+                if not bucket:
+                    del self._freqs[freq]
+                item[2] = freq + 1
+                self._freqs[freq + 1][key] = None
+
+            return item[0]
+
+    def set(self, key, value, size: int):
+        """
+        Values larger than the max size are not cached.
+        """
+        with self._lock:
+            self._remove(key)
+            if size > self._max_size:
+                return
+
+            while self._size + size > self._max_size:
+                self._evict()
+
+            self._items[key] = [value, size, 1]
+            self._size += size
+            if self._policy == 'lru':
+                self._order[key] = None
+            else:
+                self._freqs[1][key] = None
+                self._min_freq = 1
 
-    if remote_url is not None:
-        url_grp = urllib3.util.parse_url(remote_url)
-        if url_grp.scheme is not None:
-            http_session = HttpSession(threads, read_timeout=read_timeout, stream=False)
-            url_path = pathlib.Path(url_grp.path)
-            remote_base_url = url_path.parent
-            host_url = url_grp.scheme + '://' + url_grp.host
-            remote_http_access = True
+    def _evict(self):
+        """
+
+        """
+        if self._policy == 'lru':
+            key, _ = self._order.popitem(last=False)
         else:
-            print(f'{remote_url} is not a proper url.')
-    if (bucket is not None) and (connection_config is not None):
-        s3_session = S3Session(connection_config, bucket, threads, read_timeout=read_timeout, stream=False)
-        remote_s3_access = True
+            if self._min_freq not in self._freqs:
+                self._min_freq = min(self._freqs)
+            bucket = self._freqs[self._min_freq]
+            key, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self._freqs[self._min_freq]
+
+        item = self._items.pop(key)
+        self._size -= item[1]
+        self.evictions += 1
+
+    def _remove(self, key):
+        """
+
+        """
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+            if self._policy == 'lru':
+                del self._order[key]
+            else:
+                bucket = self._freqs[item[2]]
+                del bucket[key]
+                if not bucket:
+                    del self._freqs[item[2]]
 
-    if (not remote_s3_access) and (flag != 'r'):
-        raise ValueError("If flag != 'r', then the appropriate remote write access parameters must be passed.")
+    def invalidate(self, key):
+        """
 
-    return http_session, s3_session, remote_s3_access, remote_http_access, host_url, remote_base_url
+        """
+        with self._lock:
+            self._remove(key)
 
+    def clear(self):
+        """
 
-def init_metadata(local_meta_path, remote_keys_path, http_session, s3_session, remote_s3_access, remote_http_access, remote_url, remote_db_key, value_serializer, local_storage_kwargs):
+        """
+        with self._lock:
+            self._items.clear()
+            self._order.clear()
+            self._freqs.clear()
+            self._size = 0
+
+    def info(self):
+        """
+
+        """
+        return {'policy': self._policy, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'n_values': len(self._items), 'size': self._size, 'max_size': self._max_size}
+
+
+class Metrics:
+    """
+    Thread safe counters and latency histograms of the operations of an S3dbm object. The hooks are called after every measured operation with a dict of the operation name (op), the start time (start_time as a unix timestamp), the duration (seconds), the number of bytes (n_bytes), the error (or None), and extra info like the key. Errors raised by the hooks are logged (with logger.exception) rather than raised so that they can't break the database operations.
+    """
+    def __init__(self, hooks=None):
+        """
+
+        """
+        self._lock = threading.Lock()
+        self._hooks = list(hooks) if hooks else []
+        self.reset()
+
+    def reset(self):
+        """
+
+        """
+        with self._lock:
+            self._counters = collections.Counter()
+            self._ops = {}
+
+    def add_hook(self, hook):
+        """
+
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+
+        """
+        self._hooks.remove(hook)
+
+    def incr(self, name, n=1):
+        """
+
+        """
+        with self._lock:
+            self._counters[name] += n
+
+    def record(self, op, start, n_bytes=0, error=None, **info):
+        """
+        Record an operation that started at start (from time.perf_counter).
+        """
+        seconds = time.perf_counter() - start
+        bucket = min(int(seconds * 1000000).bit_length(), metrics_n_buckets - 1)
+
+        with self._lock:
+            stat = self._ops.get(op)
+            if stat is None:
+                stat = {'count': 0, 'errors': 0, 'seconds': 0.0, 'n_bytes': 0, 'histogram': [0] * metrics_n_buckets}
+                self._ops[op] = stat
+            stat['count'] += 1
+            stat['seconds'] += seconds
+            stat['n_bytes'] += n_bytes
+            stat['histogram'][bucket] += 1
+            if error is not None:
+                stat['errors'] += 1
+
+        if self._hooks:
+            event = {'op': op, 'start_time': time.time() - seconds, 'seconds': seconds, 'n_bytes': n_bytes, 'error': error}
+            event.update(info)
+            for hook in self._hooks:
+                try:
+                    hook(event)
+                except Exception:
+                    logger.exception('The metrics hook %r failed.', hook)
+
+    def snapshot(self):
+        """
+        The counters and the summaries of the operations. The latency percentiles are the upper bounds of the histogram buckets, so they're within a factor of 2.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            ops = {op: dict(stat, histogram=list(stat['histogram'])) for op, stat in self._ops.items()}
+
+        operations = {}
+        for op, stat in ops.items():
+            count = stat['count']
+            hist = stat['histogram']
+            latency = {}
+            for q in metrics_percentiles:
+                target = math.ceil(count * q / 100)
+                cum = 0
+                for i, n in enumerate(hist):
+                    cum += n
+                    if cum >= target:
+                        latency[f'p{q}_ms'] = (2**i) * 0.001
+                        break
+
+            operations[op] = {
+                'count': count,
+                'errors': stat['errors'],
+                'total_seconds': stat['seconds'],
+                'mean_ms': stat['seconds'] / count * 1000,
+                'n_bytes': stat['n_bytes'],
+                'latency': latency,
+                'histogram_us': {2**i: n for i, n in enumerate(hist) if n},
+                }
+
+        return {'counters': counters, 'operations': operations}
+
+
+class MeasuredRemoteSession:
+    """
+    Wraps an s3func S3Session or HttpSession and records the latency (up to the response headers as the bodies are streamed), bytes, status, and retries of the requests.
     """
+    def __init__(self, remote_session, metrics, name):
+        """
+
+        """
+        self._remote_session = remote_session
+        self._metrics = metrics
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._remote_session, attr)
+
+    def _record(self, op, start, resp, key, n_bytes=None):
+        """
+
+        """
+        status = resp.status
+        if n_bytes is None:
+            n_bytes = resp.metadata.get('content_length', 0) if status // 100 == 2 else 0
+        if isinstance(resp.headers, dict):
+            retries = resp.headers.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if retries:
+                self._metrics.incr('remote.retries', retries)
+        error = status if status // 100 not in (2, 3) else None
+        self._metrics.record(f'remote.{op}', start, n_bytes, error, key=key, status=status, backend=self._name)
+
+    def get_object(self, key, *args, **kwargs):
+        start = time.perf_counter()
+        resp = self._remote_session.get_object(key, *args, **kwargs)
+        self._record('get', start, resp, key)
+
+        return resp
+
+    def put_object(self, key, obj, *args, **kwargs):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            n_bytes = len(obj)
+        else:
+            n_bytes = determine_file_obj_size(obj)
+        start = time.perf_counter()
+        resp = self._remote_session.put_object(key, obj, *args, **kwargs)
+        self._record('put', start, resp, key, n_bytes)
+
+        return resp
+
+    def delete_object(self, key, *args, **kwargs):
+        start = time.perf_counter()
+        resp = self._remote_session.delete_object(key, *args, **kwargs)
+        self._record('delete', start, resp, key, 0)
+
+        return resp
 
+
+class MeasuredLocalData:
     """
-    meta_in_remote = False
-    # get_remote_keys = False
+    Wraps the booklet local data file and records the latency and bytes of the reads, writes, and syncs.
+    """
+    def __init__(self, local_data, metrics):
+        """
 
-    if local_meta_path.exists():
-        with io.open(local_meta_path, 'rb') as f:
-            meta = orjson.loads(zstd.decompress(f.read()))
-    else:
-        meta = None
+        """
+        self._local_data = local_data
+        self._metrics = metrics
 
-    if remote_http_access or remote_s3_access:
-        if remote_http_access:
-            func = http_session.get_object
-            key = remote_url
-        else:
-            func = s3_session.get_object
-            key = remote_db_key
+    def __getattr__(self, attr):
+        return getattr(self._local_data, attr)
 
-        meta0 = func(key)
-        if meta0.status == 200:
-            if meta0.metadata['file_type'] != 's3dbm':
-                raise TypeError('The remote file is not an s3dbm file.')
-            remote_meta = orjson.loads(zstd.decompress(meta0.data))
-            meta_in_remote = True
+    def get(self, key, default=None):
+        start = time.perf_counter()
+        value = self._local_data.get(key)
+        self._metrics.record('local.read', start, len(value) if value is not None else 0)
+        if value is None:
+            return default
 
-            ## Determine if the remote keys file needs to be downloaded
-            if meta is None:
-                with open(local_meta_path, 'wb') as f:
-                    f.write(meta0.data)
-                meta = remote_meta
-            else:
-                remote_ts = remote_meta['last_modified']
-                local_ts = meta['last_modified']
-                if remote_ts > local_ts:
-                    get_remote_keys_file(local_meta_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access)
+        return value
 
-                    with open(local_meta_path, 'wb') as f:
-                        f.write(meta0.data)
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
 
-                    meta = remote_meta
-        elif meta0.status != 404:
-            raise urllib3.exceptions.HTTPError(meta0.error)
+        return value
 
-    if meta is None:
-        int_us = make_timestamp()
-        version_date = datetime.fromtimestamp(int(int_us*0.000001)).strftime('%Y%m%dT%H%M%SZ')
-        meta = {
-            'package_version': version,
-            'local_data_kwargs': local_storage_kwargs,
-            'value_serializer': value_serializer,
-            'last_modified': int_us,
-            'user_metadata': {},
-            'versions': [
-                {'version_date': version_date,
-                 'user_metadata': {}
-                 }
-                ]
-            }
-        with io.open(local_meta_path, 'wb') as f:
-            f.write(zstd.compress(orjson.dumps(meta, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)))
-    else:
-        version_date = meta['versions'][-1]['version_date']
+    def __setitem__(self, key, value):
+        start = time.perf_counter()
+        self._local_data[key] = value
+        self._metrics.record('local.write', start, len(value))
 
-    return meta, meta_in_remote, version_date
+    def __delitem__(self, key):
+        start = time.perf_counter()
+        del self._local_data[key]
+        self._metrics.record('local.delete', start)
 
+    def sync(self):
+        start = time.perf_counter()
+        self._local_data.sync()
+        self._metrics.record('local.sync', start)
 
-def init_local_storage(local_meta_path, flag, meta):
+    def __contains__(self, key):
+        return key in self._local_data
+
+    def __iter__(self):
+        return iter(self._local_data)
+
+    def __len__(self):
+        return len(self._local_data)
+
+    def __bool__(self):
+        return True
+
+
+class RetryPolicy:
     """
+    Retries the remote reads that failed with a connection error, an incomplete read, or a retriable status (429 and 5xx) with exponential backoff and full jitter. These are on top of the retries done by boto3 and urllib3 on the individual requests.
 
+    Requests can also be hedged to cut the tail latency: if the first request hasn't finished after hedge_after seconds, a duplicate request is sent and whichever finishes first is used. hedge_after can be a number of seconds or 'p95' to use the 95th percentile of the recent request latencies (hedging starts once enough latencies have been seen). Hedging increases the number of requests by roughly 5% with 'p95'.
+
+    The hedged requests run in a thread pool that is sized by the number of threads that make the requests (two each, for the first and the duplicate request), so that the first requests don't wait for a thread. The hedge delay also only starts once the first request has started.
     """
-    local_data_file_name = local_meta_path.name + '.data'
-    local_data_path = local_meta_path.parent.joinpath(local_data_file_name)
+    def __init__(self, retries: int=default_retries, backoff: float=default_retry_backoff, hedge_after=None, threads: int=20):
+        """
+
+        """
+        if retries < 0:
+            raise ValueError('retries must be >= 0.')
+        if (hedge_after is not None) and (hedge_after != 'p95') and not (isinstance(hedge_after, (int, float)) and hedge_after > 0):
+            raise ValueError("hedge_after must be None, a number of seconds > 0, or 'p95'.")
+
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.threads = threads
+        self._latencies = collections.deque(maxlen=hedge_n_latencies)
+        self._hedge_delay = None
+        self._n_new = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._counters = collections.Counter()
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name):
+        """
+        Increment a counter. The requests are made from many threads (the hedged requests and the uploaders), so the counters need their own lock.
+        """
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def is_retriable(self, error):
+        """
+
+        """
+        if isinstance(error, S3dbmHttpError):
+            return error.status in retry_statuses
+
+        import urllib3
+        if isinstance(error, urllib3.exceptions.HTTPError):
+            return True
+
+        try:
+            import botocore.exceptions
+        except ImportError:
+            return False
+
+        return isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))
+
+    def get_backoff(self, attempt):
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(retry_backoff_max, self.backoff * 2**attempt))
+
+    def _add_latency(self, seconds):
+        """
+
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+            self._n_new += 1
+            if (self._n_new >= hedge_min_latencies) and (len(self._latencies) >= hedge_min_latencies):
+                lats = sorted(self._latencies)
+                self._hedge_delay = lats[int(len(lats) * hedge_quantile)]
+                self._n_new = 0
+
+    def get_hedge_delay(self):
+        """
+        The number of seconds to wait before sending a duplicate request, or None if the requests shouldn't be hedged (yet).
+        """
+        if self.hedge_after == 'p95':
+            return self._hedge_delay
+
+        return self.hedge_after
+
+    def _timed(self, func):
+        """
+
+        """
+        start = time.perf_counter()
+        result = func()
+        self._add_latency(time.perf_counter() - start)
+
+        return result
+
+    def _hedged_call(self, func, delay, discard):
+        """
+        Run func and a duplicate of it if the first hasn't finished after delay seconds. The result of the request that loses is passed to discard.
+        """
+        ## The threads of the executor don't survive a fork, so a child process needs its own
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            with self._lock:
+                if self._executor_pid != pid:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads * 2)
+                    self._executor_pid = pid
+
+        started = threading.Event()
+
+        def first_func():
+            started.set()
+            return self._timed(func)
+
+        ## The time waiting for a thread isn't part of the request latency, so it doesn't count towards the delay
+        first = self._executor.submit(first_func)
+        started.wait()
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self._count('hedges')
+        second = self._executor.submit(self._timed, func)
+        futures = [first, second]
+        error = None
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                futures.remove(f)
+                if f.exception() is None:
+                    if f is second:
+                        self._count('hedge_wins')
+                    if discard is not None:
+                        for other in futures:
+                            other.add_done_callback(lambda o: discard(o.result()) if o.exception() is None else None)
+                    return f.result()
+                error = f.exception()
+
+        raise error
+
+    def call(self, func, hedge: bool=True, discard=None):
+        """
+        Call func (a remote request) with the retries and hedging.
+
+        Parameters
+        ----------
+        func : callable
+            The request that takes no arguments.
+        hedge : bool
+            Can the request be hedged? Requests whose responses are streamed to the caller can't be.
+        discard : callable or None
+            Called with the result of a hedged request that wasn't used (e.g. to release resources).
+        """
+        attempt = 0
+        while True:
+            try:
+                delay = self.get_hedge_delay() if hedge else None
+                if delay is None:
+                    return self._timed(func)
+                else:
+                    return self._hedged_call(func, delay, discard)
+            except Exception as error:
+                if (attempt >= self.retries) or (not self.is_retriable(error)):
+                    raise error
+                attempt += 1
+                self._count('retries')
+                time.sleep(self.get_backoff(attempt))
 
-    if local_data_path.exists():
-        if flag == 'n':
-            ## Overwrite local data file
-            with booklet.open(local_data_path, flag=flag, **meta['local_data_kwargs']) as f:
-                pass
-        # else:
-        #     ## Open existing file
-        #     f = booklet.open(local_data_path, flag=flag)
-    else:
-        ## Create local data file
-        with booklet.open(local_data_path, flag=flag, **meta['local_data_kwargs']) as f:
-            pass
+    def info(self):
+        """
+        The number of retries, hedged requests, and hedged requests that won, and the current hedge delay.
+        """
+        with self._counters_lock:
+            counters = dict(self._counters)
 
-    return local_data_path
+        return {'retries': counters.get('retries', 0), 'hedges': counters.get('hedges', 0), 'hedge_wins': counters.get('hedge_wins', 0), 'hedge_delay': self.get_hedge_delay()}
 
 
-def get_remote_keys_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access):
+default_retry_policy = RetryPolicy()
+
+
+class RemotePools:
     """
+    A process-wide registry of the s3func sessions keyed by the endpoint, credentials, and read timeout so that every Session and S3dbm of the process reuses the same connection pools (and TLS connections) rather than creating their own. The sessions handed out are shallow copies that share the client of the registry, so each can have its own bucket and stream setting.
+
+    s3func doesn't take a client or connection pool as an argument, so the pool size, the tcp keep-alive, and the copies rely on the attributes of its sessions (_client, _session, _stream, and bucket). That's why s3func is pinned to an exact version in setup.py.
 
+    The pools are cleared in a forked child as its sockets would otherwise be shared with the parent. Databases opened before a fork shouldn't be used by the child.
     """
-    if remote_http_access:
-        # remote_keys_url_path = remote_base_url.joinpath(remote_keys_name)
-        # remote_keys_key = host_url + str(remote_keys_url_path)
+    def __init__(self):
+        """
 
-        remote_keys_key = remote_url + '.remote_keys'
+        """
+        self._pools = {}
+        self._lock = threading.Lock()
 
-        func = http_session.get_object
-    else:
-        # key_path = pathlib.Path(remote_db_key)
-        # remote_keys_key = str(key_path.parent.joinpath(remote_keys_name))
+    @staticmethod
+    def _make_key(kind, connection_config, read_timeout):
+        """
 
-        remote_keys_key = remote_db_key + '.remote_keys'
+        """
+        if kind == 'http':
+            return kind, read_timeout
 
-        func = s3_session.get_object
+        secret = connection_config.get('aws_secret_access_key', connection_config.get('secret_access_key', connection_config.get('application_key', '')))
+        secret_hash = hashlib.blake2s(str(secret).encode()).hexdigest()
+        access_key = connection_config.get('aws_access_key_id', connection_config.get('access_key_id', connection_config.get('application_key_id')))
 
-    hash0 = func(remote_keys_key)
-    if hash0.status == 200:
-        with open(remote_keys_path, 'wb') as f:
-            shutil.copyfileobj(hash0.data, f)
-    else:
-        raise urllib3.exceptions.HTTPError(hash0.error)
+        return kind, connection_config.get('service_name'), connection_config.get('endpoint_url'), access_key, secret_hash, read_timeout
 
-    return True
+    @staticmethod
+    def _make_session(kind, connection_config, bucket, max_connections, read_timeout):
+        """
+
+        """
+        import s3func
 
+        if kind == 'http':
+            remote_session = s3func.HttpSession(max_connections, read_timeout=read_timeout)
+            pool_kw = remote_session._session.connection_pool_kw
+            pool_kw['maxsize'] = max_connections
+            if pool_keepalive:
+                import socket
+                from urllib3.connection import HTTPConnection
 
-def get_remote_value(local_data, remote_keys, key, remote_s3_access, remote_http_access, bucket=None, s3_session=None, http_session=None, host_url=None, remote_base_url=None):
+                pool_kw['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        else:
+            remote_session = s3func.S3Session(connection_config, bucket, max_connections, read_timeout=read_timeout)
+            if pool_keepalive:
+                ## s3func doesn't pass extra client options through, so the client is recreated with tcp keep-alive (the slow part of creating a client is only done once per process)
+                import boto3
+                import botocore.config
+
+                conn_config = s3func.utils.build_conn_config(connection_config, 's3')
+                conn_config['config'] = botocore.config.Config(max_pool_connections=max_connections, retries={'mode': 'adaptive', 'max_attempts': 3}, read_timeout=read_timeout, tcp_keepalive=True)
+                remote_session._client = boto3.client(**conn_config)
+
+        return remote_session
+
+    def get_session(self, kind: str, connection_config: dict=None, bucket: str=None, max_connections: int=10, read_timeout: int=120, stream: bool=True):
+        """
+        Get a session that uses the shared connection pool of the endpoint. The pool is (re)created with more connections if max_connections is more than it currently has.
+
+        Parameters
+        ----------
+        kind : str
+            Either 's3' or 'http'.
+        connection_config : dict or None
+            The s3func connection config for the 's3' kind.
+        bucket : str or None
+            The bucket of the 's3' kind.
+        max_connections : int
+            The number of connections needed by the user (e.g. the number of threads making requests).
+        read_timeout : int
+            The read timeout in seconds.
+        stream : bool
+            Should the response bodies be streamed?
+
+        Returns
+        -------
+        s3func.S3Session or s3func.HttpSession
+        """
+        key = self._make_key(kind, connection_config, read_timeout)
+        max_connections = max(min(max_connections, pool_max_connections), 1)
+
+        with self._lock:
+            pool = self._pools.get(key)
+            if (pool is None) or (pool[0] < max_connections):
+                pool = (max_connections, self._make_session(kind, connection_config, bucket, max_connections, read_timeout))
+                self._pools[key] = pool
+
+        remote_session = copy.copy(pool[1])
+        remote_session._stream = stream
+        if kind == 's3':
+            remote_session.bucket = bucket
+
+        return remote_session
+
+    def info(self):
+        """
+        The number of connections of each pool.
+        """
+        with self._lock:
+            return [{'kind': key[0], 'endpoint_url': key[2] if key[0] == 's3' else None, 'max_connections': pool[0]} for key, pool in self._pools.items()]
+
+    def clear(self):
+        """
+        Remove all of the pools. The sessions already handed out keep working with their pools.
+        """
+        with self._lock:
+            self._pools.clear()
+
+    def _after_fork(self):
+        """
+        Reset the registry in a forked child. The lock might have been held by another thread of the parent during the fork.
+        """
+        self._lock = threading.Lock()
+        self._pools = {}
+
+
+remote_pools = RemotePools()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=remote_pools._after_fork)
+
+
+class CoordinatorLock:
+    """
+    An exclusive lock on the lock file of a local cache that's shared by several processes (and threads). Only the holder can change the local files of the cache.
     """
+    def __init__(self, lock_path, blocking: bool=True):
+        """
+
+        """
+        self._lock_path = lock_path
+        self._blocking = blocking
+        self._file = None
+
+    def acquire(self):
+        """
+        Returns False if the lock isn't blocking and is held by someone else.
+        """
+        import portalocker
+
+        file = io.open(self._lock_path, 'a+b')
+        flags = portalocker.LOCK_EX
+        if not self._blocking:
+            flags = flags | portalocker.LOCK_NB
+        try:
+            portalocker.lock(file, flags)
+        except portalocker.exceptions.LockException:
+            file.close()
+            return False
+
+        self._file = file
+
+        return True
+
+    def release(self):
+        """
+
+        """
+        if self._file is not None:
+            import portalocker
+
+            portalocker.unlock(self._file)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
 
+
+def release_file_lock(booklet_file):
     """
-    if remote_http_access:
-        remote_key = host_url + str(remote_base_url.joinpath(key))
-        func = http_session.get_object
-    else:
-        remote_key = key
-        func = s3_session.get_object
+    booklet holds a shared lock on a file opened for reading for as long as it's open, which would block the writes of the other processes. Shared sessions release it and rely on the coordinator lock instead.
+    """
+    import portalocker
 
-    ## While loop due to issue of an incomplete read by urllib3
-    counter = 0
-    while True:
-        resp = func(remote_key)
+    portalocker.unlock(booklet_file._file)
 
-        if resp.status == 200:
-            try:
-                valb = resp.stream.read()
+    return booklet_file
+
+
+class SharedLocalData:
+    """
+    The local data of a shared session. The local data file is opened read only (without holding a file lock), so any number of processes can read it at once. Like booklet, the values set are only readable after a sync. They're then held in memory until they're handed off to the local data file under the coordinator lock, so each host keeps one copy of the cache rather than one per process.
+    """
+    def __init__(self, local_data_path, lock_path):
+        """
+
+        """
+        self._local_data_path = local_data_path
+        self._lock_path = lock_path
+        self._local_data = release_file_lock(booklet.VariableValue(local_data_path, flag='r'))
+        self._write_buffer = {}
+        self._pending = {}
+        self._pending_bytes = 0
+        self._thread_lock = threading.Lock()
+
+    def get(self, key, default=None):
+        value = self._pending.get(key)
+        if value is None:
+            value = self._local_data.get(key)
+            if value is None:
+                return default
+
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        with self._thread_lock:
+            self._write_buffer[key] = value
+
+    def __delitem__(self, key):
+        raise ValueError('The local data of a shared session is read only.')
+
+    def __contains__(self, key):
+        return (key in self._pending) or (key in self._local_data)
+
+    def keys(self):
+        pending = self._pending.copy()
+        yield from pending
+        for key in self._local_data.keys():
+            if key not in pending:
+                yield key
+
+    def items(self):
+        for key in self.keys():
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(1 for _ in self.keys())
+
+    def __bool__(self):
+        return True
+
+    def sync(self):
+        """
+        Make the values set readable and hand them off to the local data file if enough have accumulated.
+        """
+        with self._thread_lock:
+            for key, value in self._write_buffer.items():
+                old_value = self._pending.get(key)
+                if old_value is not None:
+                    self._pending_bytes -= len(old_value)
+                self._pending[key] = value
+                self._pending_bytes += len(value)
+            self._write_buffer.clear()
+
+            if self._pending_bytes >= shared_handoff_bytes:
+                self._handoff(self._pending_bytes >= shared_max_pending_bytes)
+
+    def _handoff(self, blocking):
+        """
+        Write the pending values to the local data file if this process can get the coordinator lock. Values that are already in the file with the same or a later timestamp (e.g. handed off by another process) are skipped.
+        """
+        lock = CoordinatorLock(self._lock_path, blocking)
+        if not lock.acquire():
+            return False
+
+        try:
+            with booklet.VariableValue(self._local_data_path, flag='w') as f:
+                for key, value in self._pending.items():
+                    old_value = f.get(key)
+                    if (old_value is None) or (parse_header(old_value)[0] < parse_header(value)[0]):
+                        f[key] = value
+        finally:
+            lock.release()
+
+        self._pending.clear()
+        self._pending_bytes = 0
+
+        return True
+
+    def close(self):
+        """
+
+        """
+        with self._thread_lock:
+            self._pending.update(self._write_buffer)
+            self._write_buffer.clear()
+            if self._pending:
+                self._handoff(True)
+        self._local_data.close()
+
+
+class LocalDataView:
+    """
+    A read only memory map of the local data file (booklet) to read the values without copying them. booklet only appends the data blocks, so the memoryviews that have been handed out stay valid after later writes. The file is mapped again when it has grown.
+    """
+    def __init__(self, local_data_path):
+        """
+
+        """
+        self._file = io.open(local_data_path, 'rb')
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._n_buckets = bytes_to_int(self._get_map()[21:25])
+
+    def _get_map(self, min_size=0):
+        """
+
+        """
+        mm = self._mmap
+        if (mm is None) or (len(mm) < min_size) or (len(mm) < os.fstat(self._file.fileno()).st_size):
+            with self._lock:
+                if (self._mmap is None) or (len(self._mmap) < os.fstat(self._file.fileno()).st_size):
+                    ## The old map isn't closed as memoryviews of it could still be in use
+                    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                mm = self._mmap
+
+        return mm
+
+    def get(self, key: str):
+        """
+        Returns a memoryview of the value (with its header) or None if the key isn't in the file. Only the values that have been synced are in the file.
+        """
+        blt = booklet.utils
+        mm = self._get_map()
+        key_hash = blt.hash_key(key.encode())
+        bucket_index_pos = blt.get_bucket_index_pos(blt.get_index_bucket(key_hash, self._n_buckets))
+        data_block_pos = bytes_to_int(mm[bucket_index_pos:bucket_index_pos + blt.n_bytes_file])
+
+        ## Follow the chain of data blocks of the bucket
+        index_len = blt.key_hash_len + blt.n_bytes_file
+        while data_block_pos:
+            if data_block_pos + index_len > len(mm):
+                mm = self._get_map(data_block_pos + index_len)
+            data_index = mm[data_block_pos:data_block_pos + index_len]
+            next_data_block_pos = bytes_to_int(data_index[blt.key_hash_len:])
+            if not next_data_block_pos:
+                return None
+            if data_index[:blt.key_hash_len] == key_hash:
                 break
-            except urllib3.exceptions.ProtocolError as error:
-                print(error)
-                counter += 1
-                if counter == 5:
-                    close_files(local_data, remote_keys)
-                    raise error
-        elif resp.status == 404:
-            raise S3dbmKeyError(f'{key} not found in remote.', [local_data, remote_keys])
-            break
+            if next_data_block_pos == 1:
+                return None
+            data_block_pos = next_data_block_pos
         else:
-            return S3dbmHttpError(f'{key} returned the http error {resp.status}.', [local_data, remote_keys])
+            return None
 
-    mod_time_int = make_timestamp(resp.metadata['upload_timestamp'])
-    mod_time_bytes = int_to_bytes(mod_time_int, 6)
+        key_len_pos = data_block_pos + index_len
+        lens = mm[key_len_pos:key_len_pos + blt.n_bytes_key + blt.n_bytes_value]
+        key_len = bytes_to_int(lens[:blt.n_bytes_key])
+        value_len = bytes_to_int(lens[blt.n_bytes_key:])
+        value_pos = key_len_pos + blt.n_bytes_key + blt.n_bytes_value + key_len
+        if value_pos + value_len > len(mm):
+            mm = self._get_map(value_pos + value_len)
 
-    val_md5 = hashlib.md5(valb).digest()
-    # obj_size_bytes = int_to_bytes(len(valb), 4)
+        return memoryview(mm)[value_pos:value_pos + value_len]
 
-    local_data[key] = mod_time_bytes + val_md5 + valb
+    def close(self):
+        """
+        The map itself is left to be garbage collected once the memoryviews of it are released.
+        """
+        self._mmap = None
+        self._file.close()
 
-    # if remote_keys:
 
-    #     remote_keys[key] = mod_time_bytes + val_md5 + obj_size_bytes
+class MemoryData(dict):
+    """
+    An in-memory stand in for a booklet file.
+    """
+    def sync(self):
+        pass
 
-    return valb
+    def close(self):
+        self.clear()
 
 
-def get_value(local_data, remote_keys, key, bucket=None, s3_client=None, session=None, host_url=None, remote_base_url=None):
+class ZstdSerializer:
+    """
+    A value serializer that compresses the output of the base serializer (e.g. pickle for pickle_zstd). It writes the same zstd frames as the booklet serializers, but large values are compressed with zstd's multithreaded mode and a trained dictionary is used if there is one. The dictionary id is written to the zstd frame header, so the values compressed with older dictionaries (or without a dictionary) can still be decompressed. The dictionaries are only loaded (by dict_loader, with the dictionary id) when they are first needed. The zstd contexts aren't thread safe, so they are created per thread.
     """
+    def __init__(self, base, dict_loader=None, dict_id: int=None):
+        """
+
+        """
+        self._base = base
+        self._dict_loader = dict_loader
+        self._dicts = {}
+        self._dicts_lock = threading.Lock()
+        self._dict_id = dict_id
+        self._local = threading.local()
+
+    def _get_dict(self, dict_id):
+        """
+
+        """
+        zstd_dict = self._dicts.get(dict_id)
+        if zstd_dict is None:
+            with self._dicts_lock:
+                zstd_dict = self._dicts.get(dict_id)
+                if zstd_dict is None:
+                    if self._dict_loader is None:
+                        raise S3dbmSerializeError(f'The zstd dictionary {dict_id} is not available.')
+                    zstd_dict = zstd.ZstdCompressionDict(self._dict_loader(dict_id))
+                    self._dicts[dict_id] = zstd_dict
+
+        return zstd_dict
+
+    def _get_compressor(self, mt):
+        """
+
+        """
+        name = 'mt_cctx' if mt else 'cctx'
+        cctx = getattr(self._local, name, None)
+        if cctx is None:
+            dict_data = self._get_dict(self._dict_id) if self._dict_id else None
+            cctx = zstd.ZstdCompressor(level=zstd_level, dict_data=dict_data, threads=-1 if mt else 0)
+            setattr(self._local, name, cctx)
+
+        return cctx
+
+    def _get_decompressor(self, dict_id):
+        """
+
+        """
+        dctxs = getattr(self._local, 'dctxs', None)
+        if dctxs is None:
+            dctxs = {}
+            self._local.dctxs = dctxs
+
+        dctx = dctxs.get(dict_id)
+        if dctx is None:
+            if dict_id == 0:
+                dctx = zstd.ZstdDecompressor()
+            else:
+                dctx = zstd.ZstdDecompressor(dict_data=self._get_dict(dict_id))
+            dctxs[dict_id] = dctx
+
+        return dctx
+
+    def compress(self, data):
+        """
+
+        """
+        return self._get_compressor(len(data) >= zstd_mt_min_size).compress(data)
+
+    def decompress(self, data):
+        """
+
+        """
+        dict_id = zstd.get_frame_parameters(data).dict_id
+
+        return self._get_decompressor(dict_id).decompress(data)
+
+    def dumps(self, obj):
+        return self.compress(self._base.dumps(obj))
+
+    def loads(self, data):
+        return self._base.loads(self.decompress(data))
+
 
+class BloomFilter:
     """
-    if key in local_data:
-        local_value_bytes = local_data[key]
-        value_bytes = local_value_bytes[22:]
-    else:
-        value_bytes = None
+    A bloom filter over a set of keys. A key that is not in the filter is definitely not in the set, while a key that is in the filter is in the set with a probability of 1 - error_rate. The bit positions are derived from a single blake2b digest by double hashing.
+    """
+    def __init__(self, n_keys: int, error_rate: float=bloom_error_rate, n_hashes: int=None, n_bits: int=None, bits: bytearray=None):
+        """
 
-    if remote_keys:
-        if key not in remote_keys:
-            return None
-            # close_files(local_data, remote_keys)
-            # raise S3dbmKeyError(f'{key} does not exist.')
+        """
+        if n_bits is None:
+            n = max(n_keys, 1)
+            n_bits = max(int(math.ceil(-n * math.log(error_rate) / (math.log(2) ** 2))), 64)
+            n_hashes = max(int(round(n_bits / n * math.log(2))), 1)
+        if bits is None:
+            bits = bytearray((n_bits + 7) // 8)
 
-        remote_value_bytes = remote_keys[key]
+        self.n_keys = n_keys
+        self._n_hashes = n_hashes
+        self._n_bits = n_bits
+        self._bits = bits
 
-        if value_bytes:
-            remote_md5 = remote_value_bytes[6:22]
-            local_md5 = local_value_bytes[6:22]
-            if remote_md5 != local_md5:
-                remote_mod_time_int = bytes_to_int(remote_value_bytes[:6])
-                local_mod_time_int = bytes_to_int(local_value_bytes[:6])
-                if remote_mod_time_int > local_mod_time_int:
-                    value_bytes = get_remote_value(local_data, remote_keys, key, bucket, s3_client, session, host_url, remote_base_url)
-        else:
-            value_bytes = get_remote_value(local_data, remote_keys, key, bucket, s3_client, session, host_url, remote_base_url)
+    def _positions(self, key: str):
+        """
 
-    # if value_bytes is None:
-    #     raise S3dbmKeyError(f'{key} does not exist.')
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        n_bits = self._n_bits
 
-    return value_bytes
+        return [(h1 + i * h2) % n_bits for i in range(self._n_hashes)]
 
+    def add(self, key: str):
+        """
 
-#################################################
-### local/remote changelog
+        """
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+
+        return True
+
+    @classmethod
+    def from_keys(cls, keys, n_keys: int, error_rate: float=bloom_error_rate):
+        """
+
+        """
+        bloom = cls(n_keys, error_rate)
+        for key in keys:
+            bloom.add(key)
+
+        return bloom
+
+    def save(self, bloom_path):
+        """
+
+        """
+        with io.open(bloom_path, 'wb') as f:
+            f.write(bloom_header.pack(bloom_magic, self._n_hashes, self._n_bits, self.n_keys))
+            f.write(self._bits)
 
+    @classmethod
+    def load(cls, bloom_path):
+        """
 
-def create_changelog(local_data_path, remote_keys_path, local_meta_path, n_buckets, meta_in_remote):
+        """
+        with io.open(bloom_path, 'rb') as f:
+            magic, n_hashes, n_bits, n_keys = bloom_header.unpack(f.read(bloom_header.size))
+            if magic != bloom_magic:
+                raise S3dbmTypeError(f'{bloom_path} is not a bloom filter file.')
+            bits = bytearray(f.read())
+
+        return cls(n_keys, n_hashes=n_hashes, n_bits=n_bits, bits=bits)
+
+
+class KeyIndexView:
     """
-    Only check and save by the microsecond timestamp. Might need to add in the md5 hash if this is not sufficient.
+    A read-only sequence over the sorted keys (as bytes) in a memory mapped key index file. Keys are only read when they are accessed, so bisect can be used directly on it.
     """
-    changelog_path = local_meta_path.parent.joinpath(local_meta_path.name + '.changelog')
-    with booklet.FixedValue(changelog_path, 'n', key_serializer='str', value_len=14, n_buckets=n_buckets) as f:
-        with booklet.VariableValue(local_data_path) as local_data:
-            if meta_in_remote:
-                # shutil.copyfile(remote_keys_path, temp_remote_keys_path)
-                # f = booklet.FixedValue(temp_remote_keys_path, 'w')
-                with booklet.VariableValue(remote_keys_path) as remote_keys:
-                    for key, local_val in local_data.items():
-                        local_bytes_us = local_val[:7]
-                        remote_val = remote_keys.get(key)
-                        if remote_val:
-                            local_int_us = bytes_to_int(local_bytes_us)
-                            remote_bytes_us = remote_val[:7]
-                            remote_int_us = bytes_to_int(remote_bytes_us)
-                            if local_int_us > remote_int_us:
-                                f[key] = local_bytes_us + remote_bytes_us
-                        else:
-                            f[key] = local_bytes_us + int_to_bytes(0, 7)
-            else:
-                # f = booklet.FixedValue(temp_remote_keys_path, 'n', key_serializer='str', value_len=26)
-                for key, local_val in local_data.items():
-                    local_bytes_us = local_val[:7]
-                    f[key] = local_bytes_us + int_to_bytes(0, 7)
+    def __init__(self, mm, n_keys, keys_len):
+        """
 
-    return changelog_path
+        """
+        offsets_pos = key_index_header_len + keys_len
+        self._mm = mm
+        self._n_keys = n_keys
+        self._offsets = memoryview(mm)[offsets_pos:offsets_pos + (n_keys + 1) * 8].cast('Q') if n_keys else None
 
+    def __len__(self):
+        return self._n_keys
 
-def view_changelog(changelog_path):
+    def __getitem__(self, i):
+        start = self._offsets[i]
+        end = self._offsets[i + 1]
+        return self._mm[key_index_header_len + start:key_index_header_len + end]
+
+    def release(self):
+        """
+
+        """
+        if self._offsets is not None:
+            self._offsets.release()
+            self._offsets = None
+
+
+def prefix_upper_bound(prefix: bytes):
     """
+    The smallest bytes greater than all bytes that start with prefix. Returns None if there is no upper bound.
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+
+    return prefix[:-1] + bytes([prefix[-1] + 1])
 
+
+class KeyIndex:
     """
-    with booklet.FixedValue(changelog_path) as f:
-        for key, val in f.items():
-            local_bytes_us = val[:7]
-            remote_bytes_us = val[7:]
-            local_int_us = bytes_to_int(local_bytes_us)
-            remote_int_us = bytes_to_int(remote_bytes_us)
-            if remote_int_us == 0:
-                remote_ts = None
-            else:
-                remote_ts = datetime.fromtimestamp(remote_int_us*0.000001)
-            dict1 = {
-                'key': key,
-                'remote_timestamp': remote_ts,
-                'local_timestamp': datetime.fromtimestamp(local_int_us*0.000001)}
-            yield dict1
+    A persistent sorted index of the keys. The keys are stored sorted (as utf-8, which sorts the same as the str) in a file with an offsets table at the end, so that any key can be found with a binary search of the memory mapped file. The keys added and removed since the file was written are held in memory and are merged into the queries. The file is rewritten on flush.
+
+    The file header records the remote keys file that the index was built against and a dirty flag that is set before the first change after a flush. If either doesn't match when opening, then the index needs to be rebuilt.
+    """
+    def __init__(self, index_path):
+        """
+
+        """
+        self._index_path = pathlib.Path(index_path)
+        self._added = set()
+        self._removed = set()
+        self._added_sorted = None
+        self._dirty = False
+        self._file = None
+        self._mm = None
+        self._view = None
+        self._stamp = None
+
+        if self._index_path.exists():
+            self._open()
+
+    def _open(self):
+        """
+
+        """
+        file = io.open(self._index_path, 'rb')
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, dirty, rk_size, rk_mtime, n_keys, keys_len = key_index_header.unpack(mm[:key_index_header_len])
+        if magic != key_index_magic:
+            mm.close()
+            file.close()
+            raise S3dbmTypeError(f'{self._index_path} is not a key index file.')
+
+        self._file = file
+        self._mm = mm
+        self._view = KeyIndexView(mm, n_keys, keys_len)
+        self._stamp = (rk_size, rk_mtime)
+        self._dirty = bool(dirty)
+
+    def _close(self):
+        """
+
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def is_current(self, stamp):
+        """
+        Returns True if the index file exists, was built against the same remote keys file, and wasn't left dirty.
+        """
+        return (self._view is not None) and (not self._dirty) and (self._stamp == stamp)
+
+    def __len__(self):
+        n_keys = len(self._view) if self._view is not None else 0
+        return n_keys + len(self._added) - len(self._removed)
+
+    def _index_contains(self, key_bytes):
+        """
+
+        """
+        view = self._view
+        if view is None:
+            return False
+        i = bisect.bisect_left(view, key_bytes)
+
+        return (i < len(view)) and (view[i] == key_bytes)
+
+    def _set_dirty(self):
+        """
+        Set the dirty flag in the file before the first change so that an index that wasn't flushed is rebuilt.
+        """
+        if not self._dirty:
+            self._dirty = True
+            if self._index_path.exists():
+                with io.open(self._index_path, 'r+b') as f:
+                    f.seek(len(key_index_magic))
+                    f.write(b'\x01')
+
+    def add(self, key: str):
+        """
+
+        """
+        self._set_dirty()
+        if key in self._removed:
+            self._removed.remove(key)
+        elif not self._index_contains(key.encode()):
+            self._added.add(key)
+            self._added_sorted = None
+
+    def remove(self, key: str):
+        """
+
+        """
+        self._set_dirty()
+        if key in self._added:
+            self._added.remove(key)
+            self._added_sorted = None
+        elif self._index_contains(key.encode()):
+            self._removed.add(key)
+
+    def _get_added_sorted(self):
+        """
+
+        """
+        if self._added_sorted is None:
+            self._added_sorted = sorted(key.encode() for key in self._added)
+
+        return self._added_sorted
+
+    def _iter_index(self, view, removed, start, end):
+        """
+
+        """
+        for i in range(start, end):
+            key_bytes = view[i]
+            if removed:
+                if key_bytes.decode() in removed:
+                    continue
+            yield key_bytes
+
+    def _iter_range(self, lower, lower_inclusive, upper):
+        """
+        Iterate over the keys as bytes from lower to upper (exclusive). None means unbounded.
+        """
+        view = self._view
+        added = self._get_added_sorted()
+
+        if lower is None:
+            start = 0
+            added_start = 0
+        elif lower_inclusive:
+            start = bisect.bisect_left(view, lower) if view is not None else 0
+            added_start = bisect.bisect_left(added, lower)
+        else:
+            start = bisect.bisect_right(view, lower) if view is not None else 0
+            added_start = bisect.bisect_right(added, lower)
+
+        if upper is None:
+            end = len(view) if view is not None else 0
+            added_end = len(added)
+        else:
+            end = bisect.bisect_left(view, upper) if view is not None else 0
+            added_end = bisect.bisect_left(added, upper)
+
+        if view is None:
+            index_iter = iter(())
+        else:
+            index_iter = self._iter_index(view, self._removed, start, end)
+
+        return heapq.merge(index_iter, added[added_start:added_end])
+
+    def iter_keys(self, prefix: str=None, start_after: str=None, end_before: str=None, delimiter: str=None):
+        """
+        Iterate over the keys in sorted order. Keys that start with prefix, are greater than start_after, and are less than end_before are returned. If a delimiter is passed, then the keys that contain the delimiter after the prefix are rolled up into a single common prefix (ending with the delimiter) like the S3 list_objects. Each common prefix only requires a single binary search to skip over, so the cost is O(log n + k).
+        """
+        lower = None
+        lower_inclusive = True
+        upper = None
+
+        if prefix:
+            prefix_bytes = prefix.encode()
+            lower = prefix_bytes
+            upper = prefix_upper_bound(prefix_bytes)
+        else:
+            prefix_bytes = b''
+
+        if start_after is not None:
+            start_after_bytes = start_after.encode()
+            if (lower is None) or (start_after_bytes >= lower):
+                lower = start_after_bytes
+                lower_inclusive = False
+
+        if end_before is not None:
+            end_before_bytes = end_before.encode()
+            if (upper is None) or (end_before_bytes < upper):
+                upper = end_before_bytes
+
+        if (lower is not None) and (upper is not None) and (lower >= upper):
+            return
+
+        if not delimiter:
+            for key_bytes in self._iter_range(lower, lower_inclusive, upper):
+                yield key_bytes.decode()
+            return
+
+        delimiter_bytes = delimiter.encode()
+        prefix_len = len(prefix_bytes)
+        while True:
+            common_prefix = None
+            for key_bytes in self._iter_range(lower, lower_inclusive, upper):
+                pos = key_bytes.find(delimiter_bytes, prefix_len)
+                if pos == -1:
+                    yield key_bytes.decode()
+                else:
+                    common_prefix = key_bytes[:pos + len(delimiter_bytes)]
+                    yield common_prefix.decode()
+                    break
+
+            if common_prefix is None:
+                break
+
+            ## Skip over all of the keys with the common prefix
+            lower = prefix_upper_bound(common_prefix)
+            if (lower is None) or ((upper is not None) and (lower >= upper)):
+                break
+            lower_inclusive = True
+
+    def sample(self, n: int):
+        """
+        A random sample of the keys that have been written to the index file.
+        """
+        view = self._view
+        if view is None:
+            return []
+        n = min(n, len(view))
+
+        return [view[i].decode() for i in random.sample(range(len(view)), n)]
+
+    def count(self, prefix: str=None):
+        """
+        Count the keys that start with prefix with two binary searches.
+        """
+        if not prefix:
+            return len(self)
+
+        prefix_bytes = prefix.encode()
+        upper = prefix_upper_bound(prefix_bytes)
+        view = self._view
+
+        n_keys = 0
+        if view is not None:
+            start = bisect.bisect_left(view, prefix_bytes)
+            end = bisect.bisect_left(view, upper) if upper is not None else len(view)
+            n_keys += end - start
+        for key in self._removed:
+            if key.startswith(prefix):
+                n_keys -= 1
+        added = self._get_added_sorted()
+        start = bisect.bisect_left(added, prefix_bytes)
+        end = bisect.bisect_left(added, upper) if upper is not None else len(added)
+        n_keys += end - start
+
+        return n_keys
+
+    def _write(self, keys_bytes_iter, stamp):
+        """
+        Write the sorted keys to a new file and replace the old one.
+        """
+        tmp_path = self._index_path.parent.joinpath(self._index_path.name + '.tmp')
+        offsets = array('Q', [0])
+        pos = 0
+        with io.open(tmp_path, 'wb') as f:
+            f.write(bytes(key_index_header_len))
+            for key_bytes in keys_bytes_iter:
+                f.write(key_bytes)
+                pos += len(key_bytes)
+                offsets.append(pos)
+            f.write(offsets.tobytes())
+            f.seek(0)
+            f.write(key_index_header.pack(key_index_magic, 0, stamp[0], stamp[1], len(offsets) - 1, pos))
+
+        ## The old file is left to be closed when it's no longer referenced as there could still be iterators over it
+        self._file = None
+        self._mm = None
+        self._view = None
+        os.replace(tmp_path, self._index_path)
+        self._added = set()
+        self._removed = set()
+        self._added_sorted = None
+        self._dirty = False
+        self._open()
+
+    def build(self, keys, stamp):
+        """
+        Build the index from scratch from an iterable of keys.
+        """
+        keys_bytes = sorted(set(key.encode() for key in keys))
+        self._write(keys_bytes, stamp)
+
+    def flush(self, stamp):
+        """
+        Merge the changes into the file if there are any changes or the remote keys file has changed.
+        """
+        if self._dirty or (self._stamp != stamp):
+            self._write(self._iter_range(None, True, None), stamp)
+
+    def close(self):
+        """
+
+        """
+        self._close()
+
+
+############################################
+### Functions
+
+
+def bytes_to_int(b, signed=False):
+    """
+    Remember for a single byte, I only need to do b[0] to get the int. And it's really fast as compared to the function here. This is only needed for bytes > 1.
+    """
+    return int.from_bytes(b, 'little', signed=signed)
+
+
+def int_to_bytes(i, byte_len, signed=False):
+    """
+
+    """
+    return i.to_bytes(byte_len, 'little', signed=signed)
+
+
+def make_timestamp(value=None):
+    """
+    Milliseconds should have at least 6 bytes for storage, while microseconds should have 7 bytes.
+    """
+    if value is None:
+        value = datetime.now(timezone.utc)
+
+    int_us = int(value.timestamp() * 1000000)
+
+    return int_us
+
+
+def make_header(valb, int_us=None):
+    """
+    Create the header that is prepended to the value bytes in the local data and stored as the value in the remote keys file.
+    """
+    if int_us is None:
+        int_us = make_timestamp()
+
+    return int_to_bytes(int_us, ts_len) + hashlib.md5(valb).digest()
+
+
+def parse_header(header):
+    """
+    Parse the header of a local value or a remote keys value. All reads of the header fields go through here (or headers_to_array for whole arrays of headers).
+
+    Returns
+    -------
+    timestamp in microseconds, md5 bytes
+    """
+    return bytes_to_int(header[:ts_len]), bytes(header[ts_len:header_len])
+
+
+def check_header_version(meta):
+    """
+    Databases without a header_version have version 1 headers.
+    """
+    if meta.get('header_version', 1) > header_version:
+        raise S3dbmValueError(f"The database has version {meta['header_version']} value headers, but this version of s3dbm only reads up to version {header_version}. Please update s3dbm.")
+
+
+def import_numpy():
+    """
+    Import numpy for the functions that need it. numpy is an optional dependency (the numpy extra).
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError('This requires numpy. Install it with e.g. pip install s3dbm[numpy].') from None
+
+    return np
+
+
+def header_dtype(value_len: int=header_len):
+    """
+    The numpy structured dtype of the parsed headers. The remote keys values of the packed layout also have the pack_id, offset, and length of the value in the pack, and the values of the content layout have the content_hash.
+    """
+    np = import_numpy()
+
+    fields = [('key', 'O'), ('timestamp', '<u8'), ('md5', 'S16')]
+    if value_len == packed_value_len:
+        fields.extend([('pack_id', '<u8'), ('offset', '<u8'), ('length', '<u8')])
+    elif value_len == content_value_len:
+        fields.append(('content_hash', f'S{content_hash_len}'))
+
+    return np.dtype(fields)
+
+
+def _le_uint_column(raw, start, length):
+    """
+    Convert a column of little endian unsigned ints of less than 8 bytes of a 2d uint8 array to uint64.
+    """
+    np = import_numpy()
+
+    out = np.zeros((raw.shape[0], 8), dtype='u1')
+    out[:, :length] = raw[:, start:start + length]
+
+    return out.view('<u8')[:, 0]
+
+
+def headers_to_array(keys, headers, value_len: int=header_len):
+    """
+    Parse the fixed width headers (or remote keys values) into a numpy structured array so that the headers of many keys can be compared at once.
+
+    Parameters
+    ----------
+    keys : list of str
+        The keys of the headers.
+    headers : list of bytes
+        The headers (or remote keys values), all value_len long.
+    value_len : int
+        The length of the headers.
+
+    Returns
+    -------
+    numpy structured array
+    """
+    np = import_numpy()
+
+    n = len(keys)
+    arr = np.empty(n, dtype=header_dtype(value_len))
+    raw = np.frombuffer(b''.join(headers), dtype='u1').reshape(n, value_len)
+
+    arr['key'] = keys
+    arr['timestamp'] = _le_uint_column(raw, 0, ts_len)
+    arr['md5'] = np.ascontiguousarray(raw[:, ts_len:header_len]).view(f'S{md5_len}')[:, 0]
+    if value_len == packed_value_len:
+        pos = header_len
+        arr['pack_id'] = _le_uint_column(raw, pos, ts_len)
+        pos += ts_len
+        arr['offset'] = _le_uint_column(raw, pos, pack_pos_len)
+        pos += pack_pos_len
+        arr['length'] = _le_uint_column(raw, pos, pack_pos_len)
+    elif value_len == content_value_len:
+        arr['content_hash'] = np.ascontiguousarray(raw[:, header_len:]).view(f'S{content_hash_len}')[:, 0]
+
+    return arr
+
+
+def load_remote_headers(remote_keys):
+    """
+    Load all of the remote keys values as a numpy structured array.
+    """
+    keys = []
+    values = []
+    value_len = None
+    for key, value in remote_keys.items():
+        keys.append(key)
+        values.append(value)
+        value_len = len(value)
+
+    return headers_to_array(keys, values, value_len or header_len)
+
+
+def load_local_headers(local_data, local_view=None):
+    """
+    Load the headers of all of the local values as a numpy structured array. If a LocalDataView is passed, only the headers are read rather than the whole values.
+    """
+    keys = []
+    headers = []
+    if local_view is None:
+        for key, value in local_data.items():
+            keys.append(key)
+            headers.append(value[:header_len])
+    else:
+        for key in local_data.keys():
+            view = local_view.get(key)
+            if view is not None:
+                keys.append(key)
+                headers.append(view[:header_len])
+
+    return headers_to_array(keys, headers, header_len)
+
+
+def get_zstd_base_serializer(value_serializer_code):
+    """
+    Get the serializer without the zstd compression (e.g. pickle for pickle_zstd). Returns None if the serializer doesn't use zstd or the base serializer isn't available.
+    """
+    serial_name_dict = booklet.serializers.serial_name_dict
+    name = None
+    for name0, code in serial_name_dict.items():
+        if code == value_serializer_code:
+            name = name0
+            break
+
+    if name == 'zstd':
+        base_name = 'bytes'
+    elif isinstance(name, str) and name.endswith('_zstd'):
+        base_name = name[:-5]
+    else:
+        return None
+
+    if base_name in serial_name_dict:
+        return booklet.serializers.serial_int_dict[serial_name_dict[base_name]]
+
+
+def init_value_serializer(value_serializer_code, meta, dict_loader=None):
+    """
+    Use the zstd serializer (with the trained dictionary if there is one) if the value serializer can be split into a base serializer and zstd.
+    """
+    base = get_zstd_base_serializer(value_serializer_code)
+    if base is not None:
+        return ZstdSerializer(base, dict_loader, meta.get('zstd_dict_id'))
+
+    return booklet.serializers.serial_int_dict[value_serializer_code]
+
+
+def train_zstd_dict(samples, dict_size, dict_ids):
+    """
+    Train a zstd dictionary from the uncompressed samples. The dictionary id must be different from the existing dictionaries as it's used to choose the dictionary when decompressing.
+
+    Returns
+    -------
+    dict id, dictionary bytes
+    """
+    for _ in range(3):
+        zstd_dict = zstd.train_dictionary(dict_size, samples, level=zstd_level)
+        dict_id = zstd_dict.dict_id()
+        if dict_id not in dict_ids:
+            return dict_id, zstd_dict.as_bytes()
+
+    raise S3dbmValueError('A zstd dictionary with a unique id could not be trained.')
+
+
+def make_zstd_dict_name(remote_db_name, dict_id):
+    """
+
+    """
+    return remote_db_name + '.zstd_dicts/' + str(dict_id)
+
+
+def make_zstd_dicts_path(local_meta_path):
+    """
+    The local folder of the zstd dictionaries.
+    """
+    return local_meta_path.parent.joinpath(local_meta_path.name + '.zstd_dicts')
+
+
+def save_zstd_dict(zstd_dicts_path, dict_id, dict_bytes):
+    """
+
+    """
+    zstd_dicts_path.mkdir(parents=True, exist_ok=True)
+    dict_path = zstd_dicts_path.joinpath(str(dict_id))
+    write_file_atomic(dict_path, dict_bytes)
+
+    return dict_path
+
+
+def load_zstd_dict(zstd_dicts_path, dict_id, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_db_name, retry_policy=None):
+    """
+    Load a zstd dictionary from the local folder, or download it and save it locally if it isn't there yet.
+    """
+    dict_path = zstd_dicts_path.joinpath(str(dict_id))
+    if dict_path.exists():
+        with io.open(dict_path, 'rb') as f:
+            return f.read()
+
+    if (s3_session is None) and (http_session is None):
+        raise S3dbmSerializeError(f'The zstd dictionary {dict_id} is not in the local folder and there is no remote to download it from.')
+
+    try:
+        _, dict_bytes, _ = download_value(make_zstd_dict_name(remote_db_name, dict_id), remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, retry_policy=retry_policy)
+    except S3dbmKeyError:
+        raise S3dbmSerializeError(f'The zstd dictionary {dict_id} is not in the remote.')
+
+    save_zstd_dict(zstd_dicts_path, dict_id, dict_bytes)
+
+    return dict_bytes
+
+
+def make_remote_key(remote_db_key, key):
+    """
+    The value objects are stored next to the remote db object.
+    """
+    return str(pathlib.PurePosixPath(remote_db_key).parent.joinpath(key))
+
+
+def write_metadata(local_meta_path, meta):
+    """
+
+    """
+    meta_bytes = zstd.compress(orjson.dumps(meta, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY))
+    with io.open(local_meta_path, 'wb') as f:
+        f.write(meta_bytes)
+
+    return meta_bytes
+
+
+def get_key_index_stamp(remote_keys_path):
+    """
+    The size and modification time of the remote keys file. The key index is rebuilt if these change.
+    """
+    remote_keys_path = pathlib.Path(remote_keys_path)
+    if remote_keys_path.exists():
+        stat = remote_keys_path.stat()
+        return (stat.st_size, stat.st_mtime_ns)
+    else:
+        return (0, 0)
+
+
+def close_files(local_data, remote_keys):
+    """
+
+    """
+    local_data.close()
+    if remote_keys:
+        remote_keys.close()
+
+
+def parse_url(url):
+    """
+    urllib3's url parser, which is imported on first use as urllib3 is slow to import.
+    """
+    import urllib3
+
+    return urllib3.util.parse_url(url)
+
+
+def get_remote_access(flag, bucket, connection_config, remote_url):
+    """
+    Determine the remote access from the parameters without creating any sessions.
+    """
+    remote_s3_access = False
+    remote_http_access = False
+    remote_base_url = None
+    host_url = None
+
+    if remote_url is not None:
+        url_grp = parse_url(remote_url)
+        if url_grp.scheme is not None:
+            url_path = pathlib.Path(url_grp.path)
+            remote_base_url = url_path.parent
+            host_url = url_grp.scheme + '://' + url_grp.netloc
+            remote_http_access = True
+        else:
+            print(f'{remote_url} is not a proper url.')
+    if (bucket is not None) and (connection_config is not None):
+        remote_s3_access = True
+
+    if (not remote_s3_access) and (flag != 'r'):
+        raise ValueError("If flag != 'r', then the appropriate remote write access parameters must be passed.")
+
+    return remote_s3_access, remote_http_access, host_url, remote_base_url
+
+
+def init_remote_config(flag, bucket, connection_config, remote_url, threads, read_timeout):
+    """
+
+    """
+    http_session = None
+    s3_session = None
+
+    remote_s3_access, remote_http_access, host_url, remote_base_url = get_remote_access(flag, bucket, connection_config, remote_url)
+
+    if remote_http_access:
+        http_session = remote_pools.get_session('http', None, None, threads, read_timeout, False)
+    if remote_s3_access:
+        s3_session = remote_pools.get_session('s3', connection_config, bucket, threads, read_timeout, False)
+
+    return http_session, s3_session, remote_s3_access, remote_http_access, host_url, remote_base_url
+
+
+def read_metadata(local_meta_path):
+    """
+
+    """
+    with io.open(local_meta_path, 'rb') as f:
+        meta = orjson.loads(zstd.decompress(f.read()))
+
+    return meta
+
+
+def check_remote_metadata(meta, meta_in_remote, bucket, connection_config, remote_url, remote_db_key, threads, read_timeout):
+    """
+    Check if the remote has been modified since the local metadata was downloaded or pushed. A conditional GET is used, so nothing is downloaded if the remote hasn't changed. This is used by the lazy sessions in a background thread.
+
+    Returns
+    -------
+    bool
+        True if the remote has been modified.
+    """
+    http_session, s3_session, remote_s3_access, remote_http_access, _, _ = init_remote_config('r', bucket, connection_config, remote_url, threads, read_timeout)
+    if not (remote_s3_access or remote_http_access):
+        return False
+
+    resp = get_object_if_modified(remote_db_key, remote_url, meta.get('remote_etag'), http_session, s3_session, remote_http_access)
+    if resp is None:
+        return False
+    elif resp.status == 404:
+        return meta_in_remote
+    elif resp.status != 200:
+        import urllib3
+        raise urllib3.exceptions.HTTPError(resp.error)
+
+    remote_meta = orjson.loads(zstd.decompress(resp.data))
+
+    return (not meta_in_remote) or (remote_meta['last_modified'] != meta['last_modified'])
+
+
+def get_object_if_modified(key, url, etag, http_session, s3_session, remote_http_access):
+    """
+    A GET request that only downloads the object if its ETag is different from etag (If-None-Match). Returns None if the object hasn't been modified.
+    """
+    from s3func.utils import S3Response, HttpResponse
+
+    if remote_http_access:
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = f'"{etag}"'
+        response = http_session._session.request('get', url, headers=headers, preload_content=not http_session._stream)
+        if response.status == 304:
+            response.release_conn()
+            return None
+        resp = HttpResponse(response, http_session._stream)
+        if 'ETag' in resp.headers:
+            resp.metadata['etag'] = resp.headers['ETag'].strip('"')
+    else:
+        params = {'Bucket': s3_session.bucket, 'Key': key}
+        if etag is not None:
+            params['IfNoneMatch'] = f'"{etag}"'
+        resp = S3Response(s3_session._client, 'get_object', s3_session._stream, **params)
+        if resp.status == 304:
+            return None
+
+    return resp
+
+
+def init_metadata(local_meta_path, remote_keys_path, http_session, s3_session, remote_s3_access, remote_http_access, remote_url, remote_db_key, value_serializer, local_storage_kwargs):
+    """
+
+    """
+    meta_in_remote = False
+    remote_last_modified = None
+    journal_changes = None
+    # get_remote_keys = False
+
+    if local_meta_path.exists():
+        meta = read_metadata(local_meta_path)
+    else:
+        meta = None
+
+    if remote_http_access or remote_s3_access:
+        ## The remote metadata is only downloaded if it has changed since the last open. The remote keys file only changes when the metadata changes, so it must also exist locally.
+        if (meta is not None) and remote_keys_path.exists():
+            etag = meta.get('remote_etag')
+        else:
+            etag = None
+
+        meta0 = get_object_if_modified(remote_db_key, remote_url, etag, http_session, s3_session, remote_http_access)
+        if meta0 is None:
+            meta_in_remote = True
+            remote_last_modified = meta['last_modified']
+        elif meta0.status == 200:
+            if meta0.metadata['file_type'] != 's3dbm':
+                raise TypeError('The remote file is not an s3dbm file.')
+            remote_meta = orjson.loads(zstd.decompress(meta0.data))
+            meta_in_remote = True
+            remote_last_modified = remote_meta['last_modified']
+
+            ## Determine if the remote keys file needs to be updated. Only the missing journal segments are applied if possible, otherwise the whole file is downloaded.
+            if (meta is None) or (remote_meta['last_modified'] > meta['last_modified']) or (not remote_keys_path.exists()):
+                if (meta is not None) and remote_keys_path.exists():
+                    journal_changes = apply_journal(remote_keys_path, meta['last_modified'], remote_meta, remote_db_key, remote_url, http_session, s3_session, remote_http_access)
+
+                if journal_changes is None:
+                    get_remote_keys_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access)
+                else:
+                    get_remote_bloom_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access)
+
+                meta = remote_meta
+                meta['remote_etag'] = meta0.metadata.get('etag')
+                write_metadata(local_meta_path, meta)
+            elif meta.get('remote_etag') != meta0.metadata.get('etag'):
+                meta['remote_etag'] = meta0.metadata.get('etag')
+                write_metadata(local_meta_path, meta)
+        elif meta0.status != 404:
+            import urllib3
+            raise urllib3.exceptions.HTTPError(meta0.error)
+
+    if meta is None:
+        int_us = make_timestamp()
+        version_date = datetime.fromtimestamp(int(int_us*0.000001)).strftime('%Y%m%dT%H%M%SZ')
+        meta = {
+            'package_version': version,
+            'header_version': header_version,
+            'local_data_kwargs': local_storage_kwargs,
+            'value_serializer': value_serializer,
+            'last_modified': int_us,
+            'user_metadata': {},
+            'versions': [
+                {'version_date': version_date,
+                 'user_metadata': {}
+                 }
+                ]
+            }
+        write_metadata(local_meta_path, meta)
+    else:
+        version_date = meta['versions'][-1]['version_date']
+
+    return meta, meta_in_remote, version_date, remote_last_modified, journal_changes
+
+
+def init_local_storage(local_meta_path, flag, meta):
+    """
+
+    """
+    local_data_file_name = local_meta_path.name + '.data'
+    local_data_path = local_meta_path.parent.joinpath(local_data_file_name)
+
+    if local_data_path.exists():
+        if flag == 'n':
+            ## Overwrite local data file
+            with booklet.open(local_data_path, flag=flag, **meta['local_data_kwargs']) as f:
+                pass
+        # else:
+        #     ## Open existing file
+        #     f = booklet.open(local_data_path, flag=flag)
+    else:
+        ## Create local data file. The local data is a cache of the remote, so it's created even when the flag is 'r'.
+        with booklet.open(local_data_path, flag='n', **meta['local_data_kwargs']) as f:
+            pass
+
+    return local_data_path
+
+
+def write_file_atomic(file_path, data):
+    """
+    Write the file to a temporary file and move it into place, so that processes that have the old file open keep reading the old file.
+    """
+    file_path = pathlib.Path(file_path)
+    tmp_path = file_path.parent.joinpath(f'{file_path.name}.{os.getpid()}.tmp')
+    with io.open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def get_remote_keys_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access):
+    """
+
+    """
+    if remote_http_access:
+        # remote_keys_url_path = remote_base_url.joinpath(remote_keys_name)
+        # remote_keys_key = host_url + str(remote_keys_url_path)
+
+        remote_keys_key = remote_url + '.remote_keys'
+
+        func = http_session.get_object
+    else:
+        # key_path = pathlib.Path(remote_db_key)
+        # remote_keys_key = str(key_path.parent.joinpath(remote_keys_name))
+
+        remote_keys_key = remote_db_key + '.remote_keys'
+
+        func = s3_session.get_object
+
+    hash0 = func(remote_keys_key)
+    if hash0.status == 200:
+        write_file_atomic(remote_keys_path, hash0.data)
+    else:
+        import urllib3
+        raise urllib3.exceptions.HTTPError(hash0.error)
+
+    get_remote_bloom_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access)
+
+    return True
+
+
+def get_remote_bloom_file(remote_keys_path, remote_db_key, remote_url, http_session, s3_session, remote_http_access):
+    """
+    The bloom filter must be downloaded after the remote keys so that it's newer. Older databases don't have one, so it's built locally in load_remote_bloom.
+    """
+    if remote_http_access:
+        bloom_key = remote_url + '.remote_keys.bloom'
+        func = http_session.get_object
+    else:
+        bloom_key = remote_db_key + '.remote_keys.bloom'
+        func = s3_session.get_object
+
+    bloom0 = func(bloom_key)
+    if bloom0.status == 200:
+        write_file_atomic(make_bloom_path(remote_keys_path), bloom0.data)
+    elif bloom0.status != 404:
+        import urllib3
+        raise urllib3.exceptions.HTTPError(bloom0.error)
+
+    return True
+
+
+def make_journal_key(remote_db_key, last_modified):
+    """
+
+    """
+    return remote_db_key + '.journal/' + str(last_modified)
+
+
+def find_journal_segments(local_last_modified, remote_meta):
+    """
+    Find the journal segments that need to be applied to get from the local last_modified to the remote. Returns None if the local is too far behind (or diverged) to use the journal.
+    """
+    journal = remote_meta.get('journal')
+    if not journal:
+        return None
+
+    for i, segment in enumerate(journal):
+        if segment['base'] == local_last_modified:
+            segments = journal[i:]
+            n_changes = sum(segment['n_changes'] for segment in segments)
+            if n_changes > remote_meta.get('n_keys', 0) * journal_max_changes_ratio:
+                return None
+            return segments
+
+    return None
+
+
+def apply_journal(remote_keys_path, local_last_modified, remote_meta, remote_db_key, remote_url, http_session, s3_session, remote_http_access):
+    """
+    Download the missing journal segments and apply them to the local copy of the remote keys file. All of the segments are downloaded before the file is changed. Returns the keys that were set and deleted, or None if the journal couldn't be used.
+    """
+    segments = find_journal_segments(local_last_modified, remote_meta)
+    if segments is None:
+        return None
+
+    if remote_http_access:
+        func = http_session.get_object
+        journal_db_key = remote_url
+    else:
+        func = s3_session.get_object
+        journal_db_key = remote_db_key
+
+    changes = []
+    for segment in segments:
+        resp = func(make_journal_key(journal_db_key, segment['last_modified']))
+        if resp.status != 200:
+            return None
+        changes.append(orjson.loads(zstd.decompress(resp.data)))
+
+    set_keys = {}
+    delete_keys = set()
+    for change in changes:
+        for key, header_hex in change['set']:
+            set_keys[key] = bytes.fromhex(header_hex)
+            delete_keys.discard(key)
+        for key in change['delete']:
+            set_keys.pop(key, None)
+            delete_keys.add(key)
+
+    with booklet.FixedValue(remote_keys_path) as rk:
+        n_buckets = rk._n_buckets
+        value_len = rk._value_len
+
+    rewrite_remote_keys(remote_keys_path, set_keys, delete_keys, n_buckets, value_len, True)
+
+    return list(set_keys), list(delete_keys)
+
+
+def rewrite_remote_keys(remote_keys_path, set_keys, delete_keys, n_buckets, value_len, keep_old=True):
+    """
+    Write the remote keys file with the changes applied to a temporary file and move it into place. Other processes (e.g. shared sessions) can have the remote keys file open and mapped, so it must never be changed in place. The old file keeps being read by them until they reopen it.
+    """
+    tmp_path = remote_keys_path.parent.joinpath(f'{remote_keys_path.name}.{os.getpid()}.tmp')
+    try:
+        with booklet.FixedValue(tmp_path, 'n', key_serializer='str', value_len=value_len, n_buckets=n_buckets) as new_rk:
+            if keep_old and remote_keys_path.exists():
+                with booklet.FixedValue(remote_keys_path) as rk:
+                    for key, header in rk.items():
+                        if (key not in set_keys) and (key not in delete_keys):
+                            new_rk[key] = header
+
+            for key, header in set_keys.items():
+                new_rk[key] = header
+
+        os.replace(tmp_path, remote_keys_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    return remote_keys_path
+
+
+def make_bloom_path(remote_keys_path):
+    """
+
+    """
+    return remote_keys_path.parent.joinpath(remote_keys_path.name + '.bloom')
+
+
+def save_remote_bloom(remote_keys, bloom_path):
+    """
+    Build the bloom filter from all of the remote keys and save it.
+    """
+    bloom = BloomFilter.from_keys(remote_keys.keys(), len(remote_keys))
+    bloom.save(bloom_path)
+
+    return bloom
+
+
+def load_remote_bloom(remote_keys, remote_keys_path, bloom_path):
+    """
+    Load the bloom filter of the remote keys into memory. It's rebuilt if it's missing, older than the remote keys file, or has a different number of keys.
+    """
+    if bloom_path.exists():
+        if bloom_path.stat().st_mtime_ns >= remote_keys_path.stat().st_mtime_ns:
+            bloom = BloomFilter.load(bloom_path)
+            if bloom.n_keys == len(remote_keys):
+                return bloom
+
+    return save_remote_bloom(remote_keys, bloom_path)
+
+
+def get_remote_response(key, remote_db_key, remote_http_access, s3_session=None, http_session=None, host_url=None, remote_base_url=None, range_start=None, range_end=None):
+    """
+    Request a remote value. The body of the response has not been read yet. range_start and range_end are inclusive byte positions for an http Range request.
+    """
+    if remote_http_access:
+        remote_key = host_url + str(remote_base_url.joinpath(key))
+        func = http_session.get_object
+    else:
+        remote_key = make_remote_key(remote_db_key, key)
+        func = s3_session.get_object
+
+    resp = func(remote_key, range_start=range_start, range_end=range_end)
+
+    if resp.status == 404:
+        release_stream(resp)
+        raise S3dbmKeyError(f'{key} not found in remote.')
+    elif (resp.status == 416) and (range_start is not None):
+        ## The range starts past the end of the value
+        pass
+    elif resp.status not in (200, 206):
+        release_stream(resp)
+        raise S3dbmHttpError(f'{key} returned the http error {resp.status}.', status=resp.status)
+
+    return resp
+
+
+def get_mod_time(resp):
+    """
+
+    """
+    if 'timestamp' in resp.metadata:
+        mod_time_int = int(resp.metadata['timestamp'])
+    else:
+        mod_time_int = make_timestamp(resp.metadata['upload_timestamp'])
+
+    return mod_time_int
+
+
+def download_value(key, remote_db_key, remote_http_access, s3_session=None, http_session=None, host_url=None, remote_base_url=None, byte_limiter=None, offset=None, length=None, retry_policy=None):
+    """
+    Download a value from the remote without touching the local data. If a byte_limiter is passed, the size of the value is acquired from the limiter before the body is read and must be released by the caller once the value is no longer held in memory. If offset and length are passed, then only those bytes of the object are requested (e.g. a value in a pack). The failed requests are retried (and slow requests hedged) by the retry_policy.
+
+    Returns
+    -------
+    mod_time_int, value bytes, n_bytes acquired from the byte_limiter
+    """
+    if retry_policy is None:
+        retry_policy = default_retry_policy
+
+    if offset is None:
+        range_start = None
+        range_end = None
+    elif length == 0:
+        return 0, b'', 0
+    else:
+        range_start = offset
+        range_end = offset + length - 1
+
+    def request():
+        resp = get_remote_response(key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, range_start, range_end)
+        if resp.status == 416:
+            release_stream(resp)
+            raise S3dbmHttpError(f'{key} is shorter than the requested range.', status=416)
+
+        n_bytes = 0
+        if byte_limiter is not None:
+            n_bytes = byte_limiter.acquire(resp.metadata.get('content_length', 0))
+        try:
+            valb = resp.stream.read()
+        except Exception as error:
+            if byte_limiter is not None:
+                byte_limiter.release(n_bytes)
+            raise error
+        finally:
+            release_stream(resp)
+
+        ## Some servers ignore the Range header and return the whole object
+        if (offset is not None) and (resp.status == 200):
+            valb = valb[offset:offset + length]
+
+        return get_mod_time(resp), valb, n_bytes
+
+    if byte_limiter is not None:
+        discard = lambda result: byte_limiter.release(result[2])
+    else:
+        discard = None
+
+    return retry_policy.call(request, discard=discard)
+
+
+def make_pack_name(remote_db_name, pack_id):
+    """
+    The pack objects are stored next to the remote db object like the values.
+    """
+    return remote_db_name + '.packs/' + str(pack_id)
+
+
+def make_content_name(remote_db_name, content_hash):
+    """
+
+    """
+    return remote_db_name + '.content/' + content_hash.hex()
+
+
+def hash_content(valb):
+    """
+
+    """
+    return hashlib.blake2b(valb, digest_size=content_hash_len).digest()
+
+
+def get_location(key, remote_value, remote_db_name=None):
+    """
+    Get the remote object of a value from its remote keys value. With the object layout it's the key itself, with the packed layout it's the pack with the offset and length of the value, and with the content layout it's the content hash.
+
+    Returns
+    -------
+    object name, offset or None, length or None
+    """
+    if len(remote_value) == content_value_len:
+        return make_content_name(remote_db_name, remote_value[header_len:]), None, None
+    elif len(remote_value) == packed_value_len:
+        pos = header_len
+        pack_id = bytes_to_int(remote_value[pos:pos + ts_len])
+        pos += ts_len
+        offset = bytes_to_int(remote_value[pos:pos + pack_pos_len])
+        pos += pack_pos_len
+        length = bytes_to_int(remote_value[pos:pos + pack_pos_len])
+
+        return make_pack_name(remote_db_name, pack_id), offset, length
+    else:
+        return key, None, None
+
+
+def release_stream(resp):
+    """
+    Return the connection of a streamed response back to the pool. A connection can only be reused once its body has been read, so small unread bodies (e.g. error messages) are drained first and connections with large unread bodies are closed.
+    """
+    stream = resp.stream
+    if stream is not None:
+        if hasattr(stream, 'release_conn'):
+            remaining = getattr(stream, 'length_remaining', None)
+            if (remaining is not None) and (remaining <= pool_max_drain_bytes):
+                stream.drain_conn()
+                stream.release_conn()
+            else:
+                stream.close()
+                stream.release_conn()
+        else:
+            stream.close()
+
+
+def get_remote_value(local_data, key, remote_db_key, remote_http_access, s3_session=None, http_session=None, host_url=None, remote_base_url=None, remote_value=None, remote_db_name=None, retry_policy=None):
+    """
+
+    """
+    if remote_value is None:
+        mod_time_int, valb, _ = download_value(key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, None, None, None, retry_policy)
+    else:
+        obj_name, offset, length = get_location(key, remote_value, remote_db_name)
+        _, valb, _ = download_value(obj_name, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, None, offset, length, retry_policy)
+        mod_time_int, _ = parse_header(remote_value)
+
+    local_data[key] = make_header(valb, mod_time_int) + valb
+
+    return valb
+
+
+def check_local_vs_remote(local_data, remote_keys, key):
+    """
+    Returns True if the local value needs to be replaced by the remote value.
+    """
+    local_val = local_data.get(key)
+    if local_val is None:
+        return True
+
+    return is_remote_newer(local_val, remote_keys[key])
+
+
+def is_remote_newer(local_val, remote_val):
+    """
+    Compare the headers of the local and remote values. Returns True if they differ and the remote is newer.
+    """
+    remote_mod_time_int, remote_md5 = parse_header(remote_val)
+    local_mod_time_int, local_md5 = parse_header(local_val)
+    if (remote_md5 != local_md5) and (remote_mod_time_int > local_mod_time_int):
+        return True
+
+    return False
+
+
+def get_value(local_data, remote_keys, key, remote_db_key=None, remote_http_access=False, s3_session=None, http_session=None, host_url=None, remote_base_url=None, remote_db_name=None, retry_policy=None):
+    """
+    If remote_keys is passed, then a key that isn't in the remote keys is missing even if it's in the local data. The local-only keys of a writer are read by passing remote_keys=None.
+    """
+    if key in local_data:
+        local_value_bytes = local_data[key]
+        value_bytes = local_value_bytes[header_len:]
+    else:
+        value_bytes = None
+
+    if remote_keys:
+        if key not in remote_keys:
+            return None
+            # close_files(local_data, remote_keys)
+            # raise S3dbmKeyError(f'{key} does not exist.')
+
+        remote_value_bytes = remote_keys[key]
+
+        if value_bytes is not None:
+            if is_remote_newer(local_value_bytes, remote_value_bytes):
+                value_bytes = get_remote_value(local_data, key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_value_bytes, remote_db_name, retry_policy)
+        else:
+            value_bytes = get_remote_value(local_data, key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_value_bytes, remote_db_name, retry_policy)
+
+    # if value_bytes is None:
+    #     raise S3dbmKeyError(f'{key} does not exist.')
+
+    return value_bytes
+
+
+def load_local_value(local_data, remote_keys, key):
+    """
+    Returns the local value bytes if they are current, False if the value needs to be downloaded from the remote, or None if the key doesn't exist.
+    """
+    local_val = local_data.get(key)
+
+    if (remote_keys is not None) and (key in remote_keys):
+        if local_val is None:
+            return False
+
+        if is_remote_newer(local_val, remote_keys[key]):
+            return False
+
+    elif local_val is None:
+        return None
+
+    return local_val[header_len:]
+
+
+def resolve_remote_value(local_data, remote_keys, key, future):
+    """
+    Get the downloaded value from the future and save it to the local data.
+    """
+    _, valb, _ = future.result()
+    mod_time_int, _ = parse_header(remote_keys[key])
+    local_data[key] = make_header(valb, mod_time_int) + valb
+
+    return valb
+
+
+def submit_download(executor, remote_keys, key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_db_name, byte_limiter=None, retry_policy=None):
+    """
+
+    """
+    obj_name, offset, length = get_location(key, remote_keys[key], remote_db_name)
+
+    return executor.submit(download_value, obj_name, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, byte_limiter, offset, length, retry_policy)
+
+
+def iter_values(local_data, remote_keys, keys, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, executor, window, ordered=True, remote_db_name=None, retry_policy=None):
+    """
+    Iterate over the keys and yield the key and value bytes. The values that need to come from the remote are prefetched through the executor, but only window keys are ahead of the consumer at any one time so memory use is constant regardless of the number of keys. If ordered, then the values are yielded in the order of the keys, otherwise they are yielded as soon as they are available. Keys that don't exist are skipped. All of the local data reads and writes happen in the calling thread.
+    """
+    if ordered:
+        queue = collections.deque()
+        for key in keys:
+            valb = load_local_value(local_data, remote_keys, key)
+            if valb is None:
+                continue
+            elif valb is False:
+                valb = submit_download(executor, remote_keys, key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_db_name, None, retry_policy)
+            queue.append((key, valb))
+
+            if len(queue) >= window:
+                key0, valb0 = queue.popleft()
+                if isinstance(valb0, concurrent.futures.Future):
+                    valb0 = resolve_remote_value(local_data, remote_keys, key0, valb0)
+                yield key0, valb0
+
+        while queue:
+            key0, valb0 = queue.popleft()
+            if isinstance(valb0, concurrent.futures.Future):
+                valb0 = resolve_remote_value(local_data, remote_keys, key0, valb0)
+            yield key0, valb0
+
+    else:
+        futures = {}
+        for key in keys:
+            valb = load_local_value(local_data, remote_keys, key)
+            if valb is None:
+                continue
+            elif valb is False:
+                f = submit_download(executor, remote_keys, key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, remote_db_name, None, retry_policy)
+                futures[f] = key
+
+                while len(futures) >= window:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        key0 = futures.pop(f)
+                        yield key0, resolve_remote_value(local_data, remote_keys, key0, f)
+            else:
+                yield key, valb
+
+        for f in concurrent.futures.as_completed(futures):
+            key0 = futures[f]
+            yield key0, resolve_remote_value(local_data, remote_keys, key0, f)
+
+
+def map_ordered(func, items, executor, window):
+    """
+    Run func on the items in the executor and yield the results in the order of the items. Only window items are submitted ahead of the consumer at any one time, so memory use is constant regardless of the number of items. If func fails, then the remaining futures are cancelled and the error is raised.
+    """
+    queue = collections.deque()
+    try:
+        for item in items:
+            queue.append(executor.submit(func, item))
+            if len(queue) >= window:
+                yield queue.popleft().result()
+
+        while queue:
+            yield queue.popleft().result()
+    finally:
+        for f in queue:
+            f.cancel()
+
+
+def plan_pack_requests(remote_keys, keys, remote_db_name):
+    """
+    Group the packed values by pack and merge the values that are next to each other (within pack_max_merge_gap) into single range requests of up to pack_max_request_size bytes.
+
+    Returns
+    -------
+    list of (pack name, start, length, list of (key, offset, length))
+    """
+    packs = collections.defaultdict(list)
+    for key in keys:
+        obj_name, offset, length = get_location(key, remote_keys[key], remote_db_name)
+        packs[obj_name].append((offset, length, key))
+
+    requests = []
+    for obj_name, values in packs.items():
+        values.sort()
+        members = []
+        start = None
+        end = None
+        for offset, length, key in values:
+            if members and ((offset - end) <= pack_max_merge_gap) and ((offset + length - start) <= pack_max_request_size):
+                members.append((key, offset, length))
+                end = max(end, offset + length)
+            else:
+                if members:
+                    requests.append((obj_name, start, end - start, members))
+                members = [(key, offset, length)]
+                start = offset
+                end = offset + length
+
+        if members:
+            requests.append((obj_name, start, end - start, members))
+
+    return requests
+
+
+def pull_values(local_data, remote_keys, keys, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, executor, max_requests, max_buffer_bytes, remote_db_name=None, retry_policy=None):
+    """
+    Download the remote values of the keys concurrently and write them to the local data. At most max_requests downloads are in flight at once and the downloaded values waiting to be written to the local data are capped at max_buffer_bytes. Packed values are merged into range requests per pack. All of the local data reads and writes happen in the calling thread.
+
+    Returns
+    -------
+    list of the keys that were pulled, list of the failed keys
+    """
+    byte_limiter = ByteLimiter(max_buffer_bytes)
+
+    object_keys = []
+    packed_keys = []
+    for key in keys:
+        if key not in remote_keys:
+            continue
+        if not check_local_vs_remote(local_data, remote_keys, key):
+            continue
+        remote_value = remote_keys[key]
+        if len(remote_value) == packed_value_len:
+            packed_keys.append(key)
+        else:
+            object_keys.append((key, get_location(key, remote_value, remote_db_name)[0], None, None, None))
+
+    requests = object_keys
+    for obj_name, start, length, members in plan_pack_requests(remote_keys, packed_keys, remote_db_name):
+        requests.append((None, obj_name, start, length, members))
+
+    futures = {}
+    pulled = []
+    failures = {}
+
+    for key, obj_name, start, length, members in requests:
+        while len(futures) >= max_requests:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            write_pulled_values(local_data, remote_keys, futures, done, byte_limiter, pulled, failures)
+
+        f = executor.submit(download_value, obj_name, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, byte_limiter, start, length, retry_policy)
+        futures[f] = (key, start, members)
+
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        write_pulled_values(local_data, remote_keys, futures, done, byte_limiter, pulled, failures)
+
+    return pulled, failures
+
+
+def write_pulled_values(local_data, remote_keys, futures, done, byte_limiter, pulled, failures):
+    """
+    A future either has a single key or the members of a merged pack request. The keys that failed are added to failures with their errors.
+    """
+    for f in done:
+        key, start, members = futures.pop(f)
+        if members is None:
+            members = [(key, None, None)]
+        try:
+            mod_time_int, valb, n_bytes = f.result()
+        except Exception as err:
+            for member in members:
+                failures[member[0]] = repr(err)
+            continue
+
+        for key, offset, length in members:
+            if offset is None:
+                member_valb = valb
+            else:
+                member_valb = valb[offset - start:offset - start + length]
+
+            ## Use the remote keys timestamp so that the local value matches the remote keys file
+            mod_time_int, _ = parse_header(remote_keys[key])
+            local_data[key] = make_header(member_valb, mod_time_int) + member_valb
+            pulled.append(key)
+
+        del valb
+        del member_valb
+        byte_limiter.release(n_bytes)
+
+
+#################################################
+### Byte ranges
+
+
+def download_range(key, start, end, remote_db_key, remote_http_access, s3_session=None, http_session=None, host_url=None, remote_base_url=None, retry_policy=None):
+    """
+    Download the bytes from start to end (exclusive) of a remote value. Fewer bytes are returned if the value ends before end.
+    """
+    if retry_policy is None:
+        retry_policy = default_retry_policy
+
+    def request():
+        resp = get_remote_response(key, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, start, end - 1)
+        if resp.status == 416:
+            release_stream(resp)
+            return b''
+
+        try:
+            valb = resp.stream.read()
+        finally:
+            release_stream(resp)
+
+        ## Some servers ignore the Range header and return the whole value
+        if resp.status == 200:
+            valb = valb[start:end]
+
+        return valb
+
+    return retry_policy.call(request)
+
+
+def find_range_gaps(segments, start, end):
+    """
+    Determine the parts of start to end that aren't covered by the (sorted) cached segments.
+    """
+    gaps = []
+    pos = start
+    for seg_start, seg_end in segments:
+        if seg_end <= pos:
+            continue
+        if seg_start >= end:
+            break
+        if seg_start > pos:
+            gaps.append((pos, seg_start))
+        pos = max(pos, seg_end)
+        if pos >= end:
+            break
+
+    if pos < end:
+        gaps.append((pos, end))
+
+    return gaps
+
+
+def get_range(local_ranges, remote_value, key, start, end, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, executor, remote_db_name=None, retry_policy=None):
+    """
+    Get the bytes from start to end (exclusive) of a remote value using the local range cache. The local range cache is a booklet file that has an index entry per key (the remote header of the value followed by the json list of cached segments) and an entry per cached segment (key + "\x00" + segment start). Only the parts of the range that haven't been cached are requested from the remote. If the remote header has changed, then the cached segments of the key are discarded.
+    """
+    remote_header = remote_value[:header_len]
+    obj_name, obj_offset, value_len = get_location(key, remote_value, remote_db_name)
+    if obj_offset is None:
+        obj_offset = 0
+    elif end > value_len:
+        ## Packed values must not read into the next value in the pack
+        end = value_len
+
+    index_val = local_ranges.get(key)
+    segments = []
+    if index_val is not None:
+        if index_val[:header_len] == remote_header:
+            segments = orjson.loads(index_val[header_len:])
+        else:
+            for seg_start, _ in orjson.loads(index_val[header_len:]):
+                try:
+                    del local_ranges[key + '\x00' + str(seg_start)]
+                except KeyError:
+                    pass
+
+    ## Download the missing parts
+    gaps = find_range_gaps(segments, start, end) if start < end else []
+    if gaps:
+        futures = {}
+        for gap_start, gap_end in gaps:
+            f = executor.submit(download_range, obj_name, obj_offset + gap_start, obj_offset + gap_end, remote_db_key, remote_http_access, s3_session, http_session, host_url, remote_base_url, retry_policy)
+            futures[f] = gap_start
+
+        new_segments = {}
+        for f in concurrent.futures.as_completed(futures):
+            gap_start = futures[f]
+            valb = f.result()
+            if valb:
+                new_segments[gap_start] = valb
+
+        for gap_start, valb in new_segments.items():
+            local_ranges[key + '\x00' + str(gap_start)] = valb
+            segments.append([gap_start, gap_start + len(valb)])
+
+        segments.sort()
+        local_ranges[key] = remote_header + orjson.dumps(segments)
+        local_ranges.sync()
+    else:
+        new_segments = {}
+
+    ## Assemble the range from the cached segments
+    range_bytes = bytearray()
+    pos = start
+    for seg_start, seg_end in segments:
+        if seg_end <= pos:
+            continue
+        if (seg_start > pos) or (pos >= end):
+            break
+        if seg_start in new_segments:
+            seg_valb = new_segments[seg_start]
+        else:
+            seg_valb = local_ranges[key + '\x00' + str(seg_start)]
+        range_bytes.extend(seg_valb[pos - seg_start:end - seg_start])
+        pos = min(seg_end, end)
+
+    return bytes(range_bytes)
+
+
+#################################################
+### local/remote changelog
+
+
+def scan_timestamps(file_path, fixed: bool=False):
+    """
+    Scan a booklet file for the keys, key hashes, and value timestamps without reading the rest of the values. The data blocks are read in file order and the deleted (or replaced) blocks are skipped like booklet's items. fixed must be True for a FixedValue file.
+
+    Returns
+    -------
+    list of key bytes, numpy array of the key hashes, numpy array of the timestamps
+    """
+    np = import_numpy()
+
+    blt = booklet.utils
+    index_len = blt.key_hash_len + blt.n_bytes_file
+    if fixed:
+        init_len = index_len + blt.n_bytes_key
+    else:
+        init_len = index_len + blt.n_bytes_key + blt.n_bytes_value
+
+    keys = []
+    key_hashes = bytearray()
+    timestamps = []
+    with io.open(file_path, 'rb') as file:
+        file_len = os.fstat(file.fileno()).st_size
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            n_buckets = bytes_to_int(mm[21:25])
+            fixed_value_len = bytes_to_int(mm[37:41])
+            pos = blt.sub_index_init_pos + (n_buckets * blt.n_bytes_file)
+            while pos < file_len:
+                init_block = mm[pos:pos + init_len]
+                key_len = bytes_to_int(init_block[index_len:index_len + blt.n_bytes_key])
+                if fixed:
+                    value_len = fixed_value_len
+                else:
+                    value_len = bytes_to_int(init_block[index_len + blt.n_bytes_key:])
+                key_pos = pos + init_len
+                value_pos = key_pos + key_len
+
+                ## A next data block position of 0 means that it was deleted
+                if init_block[blt.key_hash_len:index_len] != b'\x00\x00\x00\x00\x00\x00':
+                    keys.append(mm[key_pos:value_pos])
+                    key_hashes += init_block[:blt.key_hash_len]
+                    timestamps.append(parse_header(mm[value_pos:value_pos + header_len])[0])
+
+                pos = value_pos + value_len
+
+    key_hashes = np.frombuffer(bytes(key_hashes), dtype=f'S{blt.key_hash_len}')
+
+    return keys, key_hashes, np.array(timestamps, dtype='<u8')
+
+
+def create_changelog(local_data, remote_keys, local_meta_path, n_buckets, local_data_path=None, remote_keys_path=None, executor=None):
+    """
+    Only check and save by the microsecond timestamp. Might need to add in the md5 hash if this is not sufficient.
+    The local_data and remote_keys must be the open booklet objects as the files are locked while they are open.
+    If the file paths are passed (and numpy is installed), only the timestamps are scanned from the files (in parallel if an executor is passed) and the local and remote timestamps are compared as arrays matched by their key hashes. Otherwise every local value is read and looked up in the remote keys. Both produce the same changelog.
+    """
+    changelog_path = local_meta_path.parent.joinpath(local_meta_path.name + '.changelog')
+
+    if local_data_path is not None:
+        try:
+            import numpy as np
+        except ImportError:
+            local_data_path = None
+
+    with booklet.FixedValue(changelog_path, 'n', key_serializer='str', value_len=ts_len*2, n_buckets=n_buckets) as f:
+        if local_data_path is not None:
+            ## The local data and remote keys files are scanned at the same time
+            if executor is None:
+                local_scan = scan_timestamps(local_data_path)
+            else:
+                local_future = executor.submit(scan_timestamps, local_data_path)
+            if remote_keys is not None:
+                _, remote_hashes, remote_ts = scan_timestamps(remote_keys_path, True)
+            if executor is not None:
+                local_scan = local_future.result()
+
+            keys, local_hashes, local_ts = local_scan
+            if (remote_keys is not None) and len(remote_hashes):
+                order = np.argsort(remote_hashes)
+                remote_hashes = remote_hashes[order]
+                remote_ts = remote_ts[order]
+                idx = np.minimum(np.searchsorted(remote_hashes, local_hashes), len(remote_hashes) - 1)
+                in_remote = remote_hashes[idx] == local_hashes
+                matched_ts = np.where(in_remote, remote_ts[idx], 0)
+                changed = (~in_remote) | (local_ts > matched_ts)
+            else:
+                matched_ts = np.zeros(len(keys), dtype='<u8')
+                changed = np.ones(len(keys), dtype=bool)
+
+            for i in np.flatnonzero(changed).tolist():
+                f[keys[i].decode()] = int_to_bytes(int(local_ts[i]), ts_len) + int_to_bytes(int(matched_ts[i]), ts_len)
+
+        elif remote_keys is not None:
+            for key, local_val in local_data.items():
+                local_int_us, _ = parse_header(local_val)
+                remote_val = remote_keys.get(key)
+                if remote_val:
+                    remote_int_us, _ = parse_header(remote_val)
+                    if local_int_us > remote_int_us:
+                        f[key] = int_to_bytes(local_int_us, ts_len) + int_to_bytes(remote_int_us, ts_len)
+                else:
+                    f[key] = int_to_bytes(local_int_us, ts_len) + int_to_bytes(0, ts_len)
+        else:
+            for key, local_val in local_data.items():
+                local_int_us, _ = parse_header(local_val)
+                f[key] = int_to_bytes(local_int_us, ts_len) + int_to_bytes(0, ts_len)
+
+    return changelog_path
+
+
+def view_changelog(changelog_path):
+    """
+
+    """
+    with booklet.FixedValue(changelog_path) as f:
+        for key, val in f.items():
+            local_bytes_us = val[:ts_len]
+            remote_bytes_us = val[ts_len:]
+            local_int_us = bytes_to_int(local_bytes_us)
+            remote_int_us = bytes_to_int(remote_bytes_us)
+            if remote_int_us == 0:
+                remote_ts = None
+            else:
+                remote_ts = datetime.fromtimestamp(remote_int_us*0.000001)
+            dict1 = {
+                'key': key,
+                'remote_timestamp': remote_ts,
+                'local_timestamp': datetime.fromtimestamp(local_int_us*0.000001)}
+            yield dict1
+
+
+##############################################
+### Push to remote
+
+
+def check_upload_futures(futures, uploaded, failures, done):
+    """
+    Sort the finished upload futures into the uploaded headers or the failures (keys and their errors). Returns the number of bytes that were released.
+    """
+    n_bytes = 0
+    for f in done:
+        key, header, size = futures.pop(f)
+        n_bytes += size
+        try:
+            resp = f.result()
+            if resp.status // 100 == 2:
+                uploaded[key] = header
+            else:
+                failures[key] = f'http error {resp.status}'
+        except Exception as err:
+            failures[key] = repr(err)
+
+    return n_bytes
+
+
+def check_transfer_failures(failures, action):
+    """
+    Raise an S3dbmTransferError with the keys that failed and their errors (in the failures attribute).
+    """
+    if failures:
+        keys = sorted(failures)
+        message = f"{len(keys)} values failed to {action}: {', '.join(keys[:10])}"
+        if len(keys) > 10:
+            message += ', ...'
+        raise S3dbmTransferError(message, failures=failures)
+
+
+def upload_changes(local_data, changelog_path, s3_session, executor, remote_db_key, max_in_flight_bytes, keys=None):
+    """
+    Upload the values of the keys in the changelog to the remote. The uploads run concurrently in the executor, but the number of value bytes held by queued and running uploads is capped at max_in_flight_bytes. A value larger than max_in_flight_bytes is only submitted once all other uploads have finished.
+
+    Returns
+    -------
+    dict of the uploaded keys to their headers, list of the failed keys
+    """
+    if keys is not None:
+        keys = set(keys)
+
+    futures = {}
+    uploaded = {}
+    failures = {}
+    in_flight = 0
+
+    with booklet.FixedValue(changelog_path) as cl:
+        for key in cl.keys():
+            if (keys is not None) and (key not in keys):
+                continue
+
+            local_val = local_data[key]
+            header = local_val[:header_len]
+            valb = local_val[header_len:]
+            del local_val
+            size = len(valb)
+
+            while futures and ((in_flight + size) > max_in_flight_bytes):
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                in_flight -= check_upload_futures(futures, uploaded, failures, done)
+
+            mod_time_int, md5 = parse_header(header)
+            obj_meta = {'timestamp': str(mod_time_int), 'content-md5': md5.hex()}
+            f = executor.submit(s3_session.put_object, make_remote_key(remote_db_key, key), valb, obj_meta)
+            futures[f] = (key, header, size)
+            in_flight += size
+
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        in_flight -= check_upload_futures(futures, uploaded, failures, done)
+
+    return uploaded, failures
+
+
+def check_pack_futures(futures, uploaded, failures, packs, done):
+    """
+    Sort the finished pack upload futures into the uploaded remote values or the failures. Returns the number of bytes that were released.
+    """
+    n_bytes = 0
+    for f in done:
+        pack_id, members, size = futures.pop(f)
+        n_bytes += size
+        try:
+            resp = f.result()
+            error = None if resp.status // 100 == 2 else f'http error {resp.status}'
+        except Exception as err:
+            error = repr(err)
+
+        if error is None:
+            pack_id_bytes = int_to_bytes(pack_id, ts_len)
+            for key, header, offset, length in members:
+                uploaded[key] = header + pack_id_bytes + int_to_bytes(offset, pack_pos_len) + int_to_bytes(length, pack_pos_len)
+            packs[pack_id] = len(members)
+        else:
+            for member in members:
+                failures[member[0]] = error
+
+    return n_bytes
+
+
+def upload_packs(local_data, changelog_path, s3_session, executor, remote_db_key, max_in_flight_bytes, keys=None):
+    """
+    Upload the values of the keys in the changelog packed together into pack objects of up to pack_max_size bytes. The values are written into the packs in key order so that keys that are read together tend to be next to each other. The bytes held by queued and running uploads are capped at max_in_flight_bytes like upload_changes.
+
+    Returns
+    -------
+    dict of the uploaded keys to their remote values (header and pack location), list of the failed keys, dict of the new pack ids to their number of values
+    """
+    if keys is not None:
+        keys = set(keys)
+
+    remote_db_name = pathlib.PurePosixPath(remote_db_key).name
+
+    futures = {}
+    uploaded = {}
+    failures = {}
+    packs = {}
+    in_flight = 0
+    pack_id = 0
+
+    with booklet.FixedValue(changelog_path) as cl:
+        cl_keys = sorted(key for key in cl.keys() if (keys is None) or (key in keys))
+
+    pack = bytearray()
+    members = []
+    for i, key in enumerate(cl_keys):
+        local_val = local_data[key]
+        header = local_val[:header_len]
+        members.append((key, header, len(pack), len(local_val) - header_len))
+        pack.extend(memoryview(local_val)[header_len:])
+        del local_val
+
+        if (len(pack) >= pack_max_size) or (i == len(cl_keys) - 1):
+            size = len(pack)
+            while futures and ((in_flight + size) > max_in_flight_bytes):
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                in_flight -= check_pack_futures(futures, uploaded, failures, packs, done)
+
+            pack_id = max(make_timestamp(), pack_id + 1)
+            pack_key = make_remote_key(remote_db_key, make_pack_name(remote_db_name, pack_id))
+            f = executor.submit(s3_session.put_object, pack_key, bytes(pack), {'timestamp': str(pack_id)})
+            futures[f] = (pack_id, members, size)
+            in_flight += size
+
+            pack = bytearray()
+            members = []
+
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        in_flight -= check_pack_futures(futures, uploaded, failures, packs, done)
+
+    return uploaded, failures, packs
+
+
+def update_pack_counts(meta_packs, remote_keys, new_packs, uploaded, deletes, remote_db_name):
+    """
+    Update the number of live values in each pack. The values that were overwritten or deleted are removed from their old packs. Returns the names of the packs that no longer have any live values.
+    """
+    for pack_id, n_values in new_packs.items():
+        meta_packs[str(pack_id)] = n_values
+
+    empty = []
+    if remote_keys is not None:
+        for key in itertools.chain(uploaded, deletes):
+            remote_value = remote_keys.get(key)
+            if (remote_value is not None) and (len(remote_value) == packed_value_len):
+                pack_id = str(bytes_to_int(remote_value[header_len:header_len + ts_len]))
+                if pack_id in meta_packs:
+                    meta_packs[pack_id] -= 1
+                    if meta_packs[pack_id] <= 0:
+                        del meta_packs[pack_id]
+                        empty.append(make_pack_name(remote_db_name, pack_id))
+
+    return empty
+
+
+def check_content_futures(futures, uploaded, failures, done):
+    """
+    Sort the finished content upload futures into the uploaded remote values or the failures. All of the keys with the same content share an upload. Returns the number of bytes that were released.
+    """
+    n_bytes = 0
+    for f in done:
+        content_hash, members, size = futures.pop(f)
+        n_bytes += size
+        try:
+            resp = f.result()
+            error = None if resp.status // 100 == 2 else f'http error {resp.status}'
+        except Exception as err:
+            error = repr(err)
+
+        for key, header in members:
+            if error is None:
+                uploaded[key] = header + content_hash
+            else:
+                failures[key] = error
+
+    return n_bytes
+
+
+def count_content_hashes(remote_keys):
+    """
+    The number of remote keys that reference each content hash.
+    """
+    counts = collections.Counter()
+    if remote_keys is not None:
+        for remote_value in remote_keys.values():
+            if len(remote_value) == content_value_len:
+                counts[remote_value[header_len:]] += 1
+
+    return counts
+
+
+class ContentIndex:
+    """
+    A persistent index of the content hashes referenced by the remote keys of the content layout and the number of keys that reference each. The records are stored sorted by hash in a file, so that a hash can be found with a binary search of the memory mapped file. The changes of a push are applied by copying the unchanged runs of records between the changed hashes into a new file, so the remote keys don't need to be read on every push.
+
+    The file header records the remote keys file that the index was built against. If it doesn't match, then the index needs to be rebuilt.
+    """
+    def __init__(self, index_path):
+        """
+
+        """
+        self._index_path = pathlib.Path(index_path)
+        self._file = None
+        self._mm = None
+        self._n_hashes = 0
+        self._stamp = None
+
+        if self._index_path.exists():
+            self._open()
+
+    def _open(self):
+        """
+
+        """
+        file = io.open(self._index_path, 'rb')
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rk_size, rk_mtime, n_hashes = content_index_header.unpack(mm[:content_index_header_len])
+        if magic != content_index_magic:
+            mm.close()
+            file.close()
+            raise S3dbmTypeError(f'{self._index_path} is not a content index file.')
+
+        self._file = file
+        self._mm = mm
+        self._n_hashes = n_hashes
+        self._stamp = (rk_size, rk_mtime)
+
+    def _close(self):
+        """
+
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._n_hashes = 0
+        self._stamp = None
+
+    def _record_pos(self, i):
+        """
+
+        """
+        return content_index_header_len + i * content_index_record_len
+
+    def _find(self, content_hash):
+        """
+        The position of the content hash in the records, or where it would be inserted.
+        """
+        lo = 0
+        hi = self._n_hashes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self._record_pos(mid)
+            if self._mm[pos:pos + content_hash_len] < content_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _get_count(self, i, content_hash):
+        """
+
+        """
+        if i < self._n_hashes:
+            pos = self._record_pos(i)
+            if self._mm[pos:pos + content_hash_len] == content_hash:
+                return bytes_to_int(self._mm[pos + content_hash_len:pos + content_index_record_len])
+
+        return 0
+
+    def is_current(self, stamp):
+        """
+        Returns True if the index file exists and was built against the same remote keys file.
+        """
+        return (self._mm is not None) and (self._stamp == stamp)
+
+    def count(self, content_hash):
+        """
+        The number of remote keys that reference the content hash.
+        """
+        return self._get_count(self._find(content_hash), content_hash)
+
+    def __contains__(self, content_hash):
+        return self.count(content_hash) > 0
+
+    def __len__(self):
+        return self._n_hashes
+
+    def _write(self, write_records, stamp):
+        """
+        Write the records to a new file and replace the old one. write_records is called with the new file and returns the number of records that it wrote.
+        """
+        tmp_path = self._index_path.parent.joinpath(self._index_path.name + '.tmp')
+        try:
+            with io.open(tmp_path, 'wb') as f:
+                f.write(bytes(content_index_header_len))
+                n_hashes = write_records(f)
+                f.seek(0)
+                f.write(content_index_header.pack(content_index_magic, stamp[0], stamp[1], n_hashes))
+
+            self._close()
+            os.replace(tmp_path, self._index_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        self._open()
+
+    def build(self, counts, stamp):
+        """
+        Build the index from scratch from a dict of the content hashes to their counts.
+        """
+        def write_records(f):
+            n_hashes = 0
+            for content_hash in sorted(counts):
+                count = counts[content_hash]
+                if count > 0:
+                    f.write(content_hash + int_to_bytes(count, content_index_count_len))
+                    n_hashes += 1
+            return n_hashes
+
+        self._write(write_records, stamp)
+
+    def update(self, changes, stamp):
+        """
+        Apply the changes of the counts (a dict of the content hashes to the number of references added or removed).
+
+        Returns
+        -------
+        list of the content hashes that are no longer referenced
+        """
+        unreferenced = []
+
+        def write_records(f):
+            n_hashes = 0
+            prev = 0
+            for content_hash in sorted(changes):
+                i = self._find(content_hash)
+                if i > prev:
+                    f.write(self._mm[self._record_pos(prev):self._record_pos(i)])
+                    n_hashes += i - prev
+
+                old_count = self._get_count(i, content_hash)
+                if old_count:
+                    prev = i + 1
+                else:
+                    prev = i
+
+                count = old_count + changes[content_hash]
+                if count > 0:
+                    f.write(content_hash + int_to_bytes(count, content_index_count_len))
+                    n_hashes += 1
+                elif old_count:
+                    unreferenced.append(content_hash)
+
+            if self._n_hashes > prev:
+                f.write(self._mm[self._record_pos(prev):self._record_pos(self._n_hashes)])
+                n_hashes += self._n_hashes - prev
+
+            return n_hashes
+
+        self._write(write_records, stamp)
+
+        return unreferenced
+
+    def close(self):
+        """
+
+        """
+        self._close()
+
+
+def make_content_index_path(remote_keys_path):
+    """
+
+    """
+    return remote_keys_path.parent.joinpath(remote_keys_path.name + '.content')
+
+
+def open_content_index(remote_keys, remote_keys_path):
+    """
+    Open the content index of the remote keys and rebuild it if the remote keys file has changed since it was written.
+    """
+    content_index = ContentIndex(make_content_index_path(remote_keys_path))
+    stamp = get_key_index_stamp(remote_keys_path)
+    if not content_index.is_current(stamp):
+        content_index.build(count_content_hashes(remote_keys), stamp)
+
+    return content_index
+
+
+def upload_content(local_data, changelog_path, s3_session, executor, remote_db_key, max_in_flight_bytes, content_index, keys=None):
+    """
+    Upload the values of the keys in the changelog as objects named by their content hash. A value is only uploaded if its hash isn't already in the remote (the content index) or in this push, so keys with the same content share a single object. The in-flight bytes are capped like upload_changes.
+
+    Returns
+    -------
+    dict of the uploaded keys to their remote values (header and content hash), list of the failed keys
+    """
+    if keys is not None:
+        keys = set(keys)
+
+    remote_db_name = pathlib.PurePosixPath(remote_db_key).name
+
+    futures = {}
+    pending = {}
+    uploaded = {}
+    failures = {}
+    in_flight = 0
+
+    with booklet.FixedValue(changelog_path) as cl:
+        for key in cl.keys():
+            if (keys is not None) and (key not in keys):
+                continue
+
+            local_val = local_data[key]
+            header = local_val[:header_len]
+            valb = local_val[header_len:]
+            del local_val
+            content_hash = hash_content(valb)
+
+            if content_hash in content_index:
+                uploaded[key] = header + content_hash
+                continue
+            elif content_hash in pending:
+                pending[content_hash].append((key, header))
+                continue
+
+            size = len(valb)
+            while futures and ((in_flight + size) > max_in_flight_bytes):
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                in_flight -= check_content_futures(futures, uploaded, failures, done)
+
+            mod_time_int, md5 = parse_header(header)
+            obj_meta = {'timestamp': str(mod_time_int), 'content-md5': md5.hex()}
+            f = executor.submit(s3_session.put_object, make_remote_key(remote_db_key, make_content_name(remote_db_name, content_hash)), valb, obj_meta)
+            members = [(key, header)]
+            pending[content_hash] = members
+            futures[f] = (content_hash, members, size)
+            in_flight += size
+
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        in_flight -= check_content_futures(futures, uploaded, failures, done)
+
+    return uploaded, failures
+
+
+def update_content_index(content_index, uploaded, old_remote_keys_values, remote_keys_path, remote_db_name):
+    """
+    Apply the uploaded values and the overwritten and deleted values to the content index and find the content objects that are no longer referenced by any key.
+    """
+    changes = collections.Counter()
+    for remote_value in old_remote_keys_values:
+        if (remote_value is not None) and (len(remote_value) == content_value_len):
+            changes[remote_value[header_len:]] -= 1
+    for remote_value in uploaded.values():
+        changes[remote_value[header_len:]] += 1
+
+    unreferenced = content_index.update(changes, get_key_index_stamp(remote_keys_path))
+
+    return [make_content_name(remote_db_name, content_hash) for content_hash in unreferenced]
+
+
+def delete_remote_values(s3_session, executor, remote_db_key, deletes):
+    """
+
+    """
+    futures = {}
+    for key in deletes:
+        f = executor.submit(s3_session.delete_object, make_remote_key(remote_db_key, key))
+        futures[f] = key
+
+    failures = []
+    for f in concurrent.futures.as_completed(futures):
+        resp = f.result()
+        if resp.status // 100 != 2:
+            failures.append(futures[f])
+
+    return failures
+
+
+def update_remote_keys(remote_keys_path, uploaded, deletes, n_buckets, meta_in_remote, value_len=header_len):
+    """
+    Apply the uploaded headers and the deletes to the local copy of the remote keys file.
+    """
+    return rewrite_remote_keys(remote_keys_path, uploaded, set(deletes), n_buckets, value_len, meta_in_remote)
+
+
+def put_remote_file(s3_session, remote_key, file_path, metadata={}):
+    """
+
+    """
+    with io.open(file_path, 'rb') as f:
+        resp = s3_session.put_object(remote_key, f, dict(metadata))
+
+    if resp.status // 100 != 2:
+        raise S3dbmHttpError(f'{remote_key} failed to upload with the http error {resp.status}.')
+
+    return resp
+
+
+def put_journal_segment(s3_session, remote_db_key, base, last_modified, uploaded, deletes):
+    """
+    Upload the keys that were changed and deleted by a push as a journal segment. base is the remote last_modified before the push and last_modified is the one after.
+    """
+    segment = {
+        'base': base,
+        'last_modified': last_modified,
+        'set': [[key, header.hex()] for key, header in uploaded.items()],
+        'delete': list(deletes),
+        }
+    segment_key = make_journal_key(remote_db_key, last_modified)
+    resp = s3_session.put_object(segment_key, zstd.compress(orjson.dumps(segment)))
+    if resp.status // 100 != 2:
+        raise S3dbmHttpError(f'{segment_key} failed to upload with the http error {resp.status}.')
+
+    return {'base': base, 'last_modified': last_modified, 'n_changes': len(uploaded) + len(deletes)}
+
+
+def delete_journal_segments(s3_session, remote_db_key, segments):
+    """
+    Remove the journal segments that are no longer listed in the metadata.
+    """
+    failures = []
+    for segment in segments:
+        segment_key = make_journal_key(remote_db_key, segment['last_modified'])
+        resp = s3_session.delete_object(segment_key)
+        if resp.status // 100 != 2:
+            failures.append(segment_key)
+
+    return failures
+
+
+def push_metadata(local_meta_path, meta, s3_session, remote_db_key, last_modified=None):
+    """
+    The metadata object must be the last object uploaded during a push as the readers use its last_modified to determine if the remote has changed.
+    """
+    if last_modified is None:
+        last_modified = make_timestamp()
+    meta['last_modified'] = last_modified
+    meta.pop('remote_etag', None)
+    meta_bytes = write_metadata(local_meta_path, meta)
+
+    resp = s3_session.put_object(remote_db_key, meta_bytes, {'file_type': 's3dbm'})
+    if resp.status // 100 != 2:
+        raise S3dbmHttpError(f'{remote_db_key} failed to upload with the http error {resp.status}.')
+
+    ## The ETag of the upload lets the next open skip the metadata download
+    if 'etag' in resp.metadata:
+        meta['remote_etag'] = resp.metadata['etag']
+        write_metadata(local_meta_path, meta)
+
+    return resp
 
 
 
@@ -18,7 +18,12 @@ descrip = 'A python dbm-style interface to S3'
 if os.environ.get('READTHEDOCS', False) == 'True':
     INSTALL_REQUIRES = []
 else:
-    INSTALL_REQUIRES = ['boto3', 'pydantic', 'smart_open', 'zstandard']
+    # s3func is pinned exactly as utils.RemotePools depends on the attributes of its sessions (it doesn't take a client or connection pool as an argument)
+    # zstandard is required as the metadata and journal are zstd compressed, not only the values
+    INSTALL_REQUIRES = ['boto3', 'pydantic', 'smart_open', 'zstandard', 'booklet', 'orjson', 's3func==0.5.3']
+
+# numpy is only needed for the headers method and the faster changelog scan on push
+EXTRAS_REQUIRE = {'numpy': ['numpy'], 'test': ['numpy', 'pytest']}
 
 # Get the long description from the README file
 with open(os.path.join(here, 'README.rst'), encoding='utf-8') as f:
@@ -144,10 +149,7 @@ setup(
     #
     # Similar to `install_requires` above, these must be valid existing
     # projects.
-    #extras_require={  # Optional
-    #    'dev': ['check-manifest'],
-    #    'test': ['coverage'],
-    #},
+    extras_require=EXTRAS_REQUIRE,  # Optional
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.